@@ -8,6 +8,8 @@ from .embedding_service import embedding_service, EmbeddingService
 from .database import db, Database
 from .incident_router import router, IncidentRouter
 from .batch_processor import processor, BatchProcessor
+from .vector_index import local_index, LocalVectorIndex
+from .job_queue import job_runner, JobRunner
 
 __all__ = [
     'Config',
@@ -19,6 +21,10 @@ __all__ = [
     'IncidentRouter',
     'processor',
     'BatchProcessor',
+    'local_index',
+    'LocalVectorIndex',
+    'job_runner',
+    'JobRunner',
 ]
 
 __version__ = '2.0.0'
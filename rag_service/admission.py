@@ -0,0 +1,137 @@
+"""
+Admission Control
+Gioi han so request dang chay encode/rerank theo nhom endpoint, tu choi som khi qua tai
+
+- Moi nhom (routing: /suggest..., ideas: /check-duplicate, /similar-ideas) co
+  so slot dong thoi + hang doi co gioi han
+- Hang doi day -> tu choi ngay (429); doi qua ADMISSION_QUEUE_TIMEOUT -> 503.
+  Ca hai kem Retry-After (api.py chuyen Overloaded thanh HTTP response)
+- Degraded: khi con >= ADMISSION_DEGRADE_DEPTH request dang doi phia sau,
+  request duoc vao se bo qua rerank (re nhat, nhanh nhat de giai phong hang doi)
+- Chay tren event loop cua moi worker (asyncio), khong chia se giua cac worker
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict
+
+from config import Config
+from metrics import metrics
+
+ENDPOINT_CLASSES = ('routing', 'ideas')
+
+
+class Overloaded(Exception):
+    """Request bi tu choi do qua tai: status 429 (hang doi day) hoac 503 (doi qua lau)"""
+
+    def __init__(self, endpoint_class: str, status_code: int, reason: str, retry_after: int):
+        super().__init__(f"Service overloaded ({endpoint_class}: {reason}), retry after {retry_after}s")
+        self.endpoint_class = endpoint_class
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """Slot da cap cho 1 request. degraded=True -> bo qua stage tuy chon (rerank)"""
+    __slots__ = ('endpoint_class', 'degraded')
+
+    def __init__(self, endpoint_class: str, degraded: bool):
+        self.endpoint_class = endpoint_class
+        self.degraded = degraded
+
+
+class EndpointGate:
+    def __init__(self, name: str, max_concurrent: int, max_queue: int,
+                 queue_timeout: float, degrade_depth: int):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.degrade_depth = degrade_depth
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._active = 0
+        self._waiting = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._waiting
+
+    async def acquire(self, timeout: float = None) -> Ticket:
+        """timeout: thoi gian toi da request con cho duoc (vd deadline con lai)"""
+        if self._waiting >= self.max_queue:
+            self._shed('queue_full', 429)
+        if timeout is not None and timeout <= 0:
+            self._shed('deadline', 503)
+
+        wait = self.queue_timeout if timeout is None else min(self.queue_timeout, timeout)
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=wait)
+        except asyncio.TimeoutError:
+            self._shed('queue_timeout', 503)
+        finally:
+            self._waiting -= 1
+
+        self._active += 1
+        degraded = self._waiting >= self.degrade_depth
+        if degraded:
+            metrics.admission_degraded.inc(endpoint=self.name)
+        return Ticket(self.name, degraded)
+
+    def release(self):
+        self._active -= 1
+        self._semaphore.release()
+
+    def _shed(self, reason: str, status_code: int):
+        metrics.admission_shed.inc(endpoint=self.name, reason=reason)
+        raise Overloaded(self.name, status_code, reason, Config.ADMISSION_RETRY_AFTER)
+
+    def get_stats(self) -> Dict:
+        return {
+            'active': self._active,
+            'waiting': self._waiting,
+            'max_concurrent': self.max_concurrent,
+            'max_queue': self.max_queue,
+            'degrade_depth': self.degrade_depth,
+        }
+
+
+class AdmissionController:
+    def __init__(self):
+        self.enabled = Config.ADMISSION_ENABLED
+        self._gates = {
+            name: EndpointGate(
+                name,
+                max_concurrent=Config.ADMISSION_MAX_CONCURRENT,
+                max_queue=Config.ADMISSION_MAX_QUEUE,
+                queue_timeout=Config.ADMISSION_QUEUE_TIMEOUT,
+                degrade_depth=Config.ADMISSION_DEGRADE_DEPTH,
+            )
+            for name in ENDPOINT_CLASSES
+        }
+        for name, gate in self._gates.items():
+            metrics.queue_depth.set_function(lambda gate=gate: gate.queue_depth, queue=f'admission_{name}')
+
+    @asynccontextmanager
+    async def slot(self, endpoint_class: str, timeout: float = None):
+        """async with admission.slot('routing') as ticket: ... (raise Overloaded neu qua tai)"""
+        if not self.enabled:
+            yield Ticket(endpoint_class, degraded=False)
+            return
+
+        gate = self._gates[endpoint_class]
+        ticket = await gate.acquire(timeout)
+        try:
+            yield ticket
+        finally:
+            gate.release()
+
+    def get_stats(self) -> Dict:
+        return {
+            'enabled': self.enabled,
+            **{name: gate.get_stats() for name, gate in self._gates.items()},
+        }
+
+
+# Singleton instance
+admission = AdmissionController()
@@ -2,8 +2,15 @@
 FastAPI Application - RAG Incident Router
 REST API endpoints cho viec routing incidents tu dong bang AI
 """
-from fastapi import FastAPI, HTTPException, Query
+import os
+import time
+import uuid
+import asyncio
+import inspect
+from fastapi import FastAPI, HTTPException, Query, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from typing import Optional, List, Dict, Any
 
@@ -12,8 +19,24 @@ from incident_router import router
 from database import db
 from embedding_service import embedding_service
 from batch_processor import processor
-from llm_extractor import extract_core_issue
+from vector_index import local_index
+from prototype_router import department_prototypes
+from query_cache import query_cache, normalize_query
+from metrics import metrics
+from serialization import FastJSONResponse, dumps
+import logger
+import prefork
+from job_queue import job_runner, Job, JobConflictError, ACTIVE_STATUSES
+from admission import admission, Overloaded
+from deadline import Deadline, DeadlineExceeded
+from llm_extractor import (
+    extract_core_issue, try_extract_core_issue, extract_stream,
+    extraction_cache, boilerplate_stripper, circuit_breaker,
+    EMBEDDING_VERSION_RAW, EMBEDDING_VERSION_EXTRACTED, embedding_text_hash,
+    start_client, close_client, shutdown_clients, get_client_stats
+)
 
+log = logger.get_logger('api')
 
 # FastAPI App
 app = FastAPI(
@@ -21,7 +44,8 @@ app = FastAPI(
     description="API cho viec routing incidents tu dong bang AI",
     version="2.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=FastJSONResponse
 )
 
 app.add_middleware(
@@ -48,6 +72,8 @@ class DepartmentSuggestion(BaseModel):
     confidence: float = Field(ge=0, le=1)
     vote_count: int
     auto_assign: bool
+    # route="prototype": so incident da resolve tao nen prototype (vote_count = 0, khong co voting)
+    prototype_samples: Optional[int] = None
 
 
 class SuggestResponse(BaseModel):
@@ -57,6 +83,35 @@ class SuggestResponse(BaseModel):
     message: str
     auto_assign_info: Optional[Dict[str, Any]] = None
     department_scores: Optional[Dict[str, Any]] = None
+    skipped_stages: List[str] = []
+    # prototype: fast path theo centroid department (khong co similar_incidents), knn: kNN + voting
+    route: str = "knn"
+
+
+class SuggestBatchRequest(BaseModel):
+    """Nhieu incident trong 1 request (vd import tu MES)"""
+    items: List[SuggestRequest] = Field(..., min_length=1, max_length=Config.SUGGEST_BATCH_MAX_ITEMS)
+
+
+class SuggestBatchItem(BaseModel):
+    index: int
+    success: bool
+    suggestion: Optional[DepartmentSuggestion] = None
+    similar_incidents: List[Dict[str, Any]] = []
+    message: Optional[str] = None
+    auto_assign_info: Optional[Dict[str, Any]] = None
+    department_scores: Optional[Dict[str, Any]] = None
+    validation_error: Optional[str] = None
+    error: Optional[str] = None
+    skipped_stages: List[str] = []
+    route: str = "knn"
+
+
+class SuggestBatchResponse(BaseModel):
+    success: bool
+    count: int
+    failed: int
+    results: List[SuggestBatchItem]
 
 
 class AutoFillRequest(BaseModel):
@@ -84,6 +139,152 @@ class RAGSettingsResponse(BaseModel):
     recommendation: str
 
 
+# Gauges doc luc scrape /metrics
+metrics.queue_depth.set_function(job_runner.queue_depth, queue='jobs')
+
+
+@app.middleware("http")
+async def timing_middleware(request, call_next):
+    """
+    Latency theo route + header Server-Timing voi thoi gian tung stage cua request.
+    Dong thoi mo context log (request_id, sampling, debug header) cho request.
+    """
+    log_token, request_id = logger.start_request(request.headers)
+    token = metrics.start_request()
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        timings = metrics.end_request(token)
+        logger.end_request(log_token)
+
+    elapsed = time.perf_counter() - start
+    route = request.scope.get('route')
+    metrics.request_duration.observe(
+        elapsed,
+        method=request.method,
+        route=route.path if route is not None else 'unmatched',
+        status=response.status_code
+    )
+    response.headers['Server-Timing'] = metrics.server_timing(timings, elapsed * 1000)
+    response.headers['X-Request-ID'] = request_id
+    return response
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request, exc: Overloaded):
+    """Qua tai: tra 429/503 ngay kem Retry-After thay vi de request xep hang vo han"""
+    return FastJSONResponse(
+        {"detail": str(exc), "reason": exc.reason},
+        status_code=exc.status_code,
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_handler(request, exc: DeadlineExceeded):
+    """Het deadline o stage bat buoc: client (frontend) da bo cuoc, tra 504 ngay"""
+    return FastJSONResponse({"detail": str(exc), "stage": exc.stage}, status_code=504)
+
+
+# === Helpers ===
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# So item moi batch khi stream (encode/ANN theo batch, flush sau moi batch)
+STREAM_BATCH_SIZE = 32
+JOB_STREAM_POLL_SECONDS = 0.5
+
+
+def _ndjson_line(record: Dict) -> bytes:
+    return dumps(record) + b"\n"
+
+
+def _ndjson_response(records) -> StreamingResponse:
+    """
+    Stream NDJSON: moi record 1 dong, flush ngay khi generator yield.
+    Generator thuong chay tren threadpool (khong chan event loop).
+    """
+    if inspect.isasyncgen(records):
+        async def body():
+            async for record in records:
+                yield _ndjson_line(record)
+    else:
+        def body():
+            for record in records:
+                yield _ndjson_line(record)
+    return StreamingResponse(body(), media_type=NDJSON_MEDIA_TYPE)
+
+
+# Field responses/history cua idea - detail=compact (hoac fields khong can) thi khong doc tu DB
+IDEA_HISTORY_FIELDS = {'responses', 'workflow_history', 'final_resolution_detail', 'last_response'}
+
+
+def _parse_fields(fields: Optional[str]) -> Optional[set]:
+    """'id,title,similarity' -> {'id', 'title', 'similarity'} (luon giu id)"""
+    if not fields:
+        return None
+    return {f.strip() for f in fields.split(',') if f.strip()} | {'id'}
+
+
+def _needs_history(detail: str, fields: Optional[set]) -> bool:
+    if fields is not None:
+        return bool(fields & IDEA_HISTORY_FIELDS)
+    return detail == 'full'
+
+
+def _project(idea: Dict, fields: Optional[set]) -> Dict:
+    if fields is None:
+        return idea
+    return {k: v for k, v in idea.items() if k in fields}
+
+
+def _has_reranker() -> bool:
+    return bool(getattr(embedding_service, '_reranker', None))
+
+
+def _skipped_stages(ticket) -> List[str]:
+    return ["rerank"] if ticket.degraded and _has_reranker() else []
+
+
+def _rank_ideas(text: str, filters: Dict, candidate_limit: int, limit: int, rerank: bool = True) -> List[Dict]:
+    """
+    Encode + filtered ANN (lean: id, text, similarity) + rerank neu co reranker va rerank=True.
+    similarity = max(vector, rerank) de khong giam score cho exact match. CPU-bound: chay trong threadpool.
+    """
+    query_embedding = embedding_service.encode(text, is_query=True)
+    results = [dict(c) for c in local_index.find_similar_ideas(query_embedding, limit=candidate_limit, filters=filters)]
+
+    if results and rerank and _has_reranker():
+        import numpy as np
+        # Ghép description + expected_benefit cho reranking (nhất quán với cách tạo embedding)
+        candidate_texts = [
+            ' '.join(filter(None, [row.get('description', ''), row.get('expected_benefit', '')]))
+            for row in results
+        ]
+        # Sigmoid normalize (BGE reranker trả về raw logits)
+        rerank_scores = embedding_service.rerank(text, candidate_texts)
+        rerank_scores = (1 / (1 + np.exp(-np.array(rerank_scores)))).tolist()
+
+        for row, rerank_score in zip(results, rerank_scores):
+            vector_score = float(row['similarity']) if row['similarity'] else 0
+            row['vector_score'] = vector_score
+            row['rerank_score'] = rerank_score
+            row['similarity'] = max(vector_score, rerank_score)
+        results.sort(key=lambda x: x['similarity'], reverse=True)
+
+    return results[:limit]
+
+
+def _merge_in_ann_order(candidates: List[Dict], rows: List[Dict]) -> List[Dict]:
+    """Ghep rows da hydrate voi similarity tu ANN, giu thu tu gan nhat"""
+    by_id = {str(r['id']): r for r in rows}
+    merged = []
+    for c in candidates:
+        row = by_id.get(str(c['id']))
+        if row is not None:
+            merged.append({**row, 'similarity': c['similarity']})
+    return merged
+
+
 # === API Endpoints ===
 @app.get("/", tags=["Health"])
 async def root():
@@ -99,12 +300,28 @@ async def health_check():
             "status": "healthy",
             "database": "connected",
             "model": model_info["model_name"],
-            "embeddings": stats
+            "embeddings": stats,
+            "local_index": local_index.get_stats(),
+            "prototypes": department_prototypes.get_stats(),
+            "query_cache": query_cache.get_stats(),
+            "admission": admission.get_stats(),
+            "llm_cache": extraction_cache.get_stats(),
+            "llm_fastpath": boilerplate_stripper.get_stats(),
+            "llm_circuit": circuit_breaker.get_stats(),
+            "llm_client": get_client_stats(),
+            "logging": logger.get_stats(),
+            "worker": {"id": prefork.WORKER_ID, "pid": os.getpid(), **prefork.memory_footprint()}
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/metrics", tags=["Health"], response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Metrics dang Prometheus text format (latency tung stage, cache, auto-assign, queue)"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/test-extract", tags=["Test"])
 async def test_llm_extract(text: str = Query(..., description="Text để test extract")):
     """
@@ -132,16 +349,7 @@ async def test_similarity(
     query_embedding = embedding_service.encode(query, is_query=True)
     
     # Get all ideas with embeddings
-    with db.cursor() as cur:
-        cur.execute("""
-            SELECT id, title, description, expected_benefit,
-                   1 - (embedding <=> %s::vector) as similarity
-            FROM ideas
-            WHERE embedding IS NOT NULL
-            ORDER BY embedding <=> %s::vector
-            LIMIT 10
-        """, (query_embedding.tolist(), query_embedding.tolist()))
-        results = cur.fetchall()
+    results = local_index.find_similar_ideas(query_embedding, limit=10)
     
     # Format results
     items = []
@@ -161,24 +369,83 @@ async def test_similarity(
 
 
 @app.post("/suggest", response_model=SuggestResponse, tags=["Routing"])
-async def suggest_department(request: SuggestRequest):
+async def suggest_department(
+    request: SuggestRequest,
+    x_deadline_ms: Optional[str] = Header(None, description="Thoi gian client con cho (ms), mac dinh REQUEST_DEADLINE_MS")
+):
     """
     Goi y department cho incident moi.
     Su dung Multi-field matching + Voting/Average.
+    Stage tuy chon (wide retrieval, rerank) bi bo qua khi khong du deadline -> skipped_stages.
     """
-    result = router.suggest_department(
-        description=request.description,
-        location=request.location,
-        incident_type=request.incident_type,
-        priority=request.priority
-    )
+    deadline = Deadline.from_header(x_deadline_ms)
+    async with admission.slot('routing', timeout=deadline.remaining()) as ticket:
+        result = await run_in_threadpool(
+            router.suggest_department,
+            description=request.description,
+            location=request.location,
+            incident_type=request.incident_type,
+            priority=request.priority,
+            rerank=not ticket.degraded,
+            deadline=deadline
+        )
     return SuggestResponse(**result)
 
 
+@app.post("/suggest/batch", response_model=SuggestBatchResponse, tags=["Routing"])
+async def suggest_department_batch(
+    request: SuggestBatchRequest,
+    stream: bool = Query(False, description="Tra ve NDJSON: 1 dong/item khi xong moi batch, dong cuoi la summary")
+):
+    """
+    Goi y department cho nhieu incident trong 1 request.
+    Encode, ANN va rerank chay theo batch; ket qua theo thu tu input, loi tung item trong 'error'.
+    """
+    items = [item.model_dump() for item in request.items]
+    if stream:
+        return _ndjson_response(_suggest_batch_records(items))
+
+    async with admission.slot('routing') as ticket:
+        results = await run_in_threadpool(router.suggest_department_batch, items, not ticket.degraded)
+    entries = [SuggestBatchItem(index=i, **r) for i, r in enumerate(results)]
+    return SuggestBatchResponse(
+        success=True,
+        count=len(entries),
+        failed=sum(1 for e in entries if not e.success),
+        results=entries
+    )
+
+
+async def _suggest_batch_records(items: List[Dict]):
+    """
+    Route tung batch STREAM_BATCH_SIZE item, yield ket qua ngay sau moi batch.
+    Moi batch giu 1 slot 'routing' (nhu request khong stream); qua tai giua chung
+    -> header da gui, cac item con lai bao loi trong stream thay vi 429/503.
+    """
+    failed = 0
+    for start in range(0, len(items), STREAM_BATCH_SIZE):
+        chunk = items[start:start + STREAM_BATCH_SIZE]
+        try:
+            async with admission.slot('routing') as ticket:
+                results = await run_in_threadpool(router.suggest_department_batch, chunk, not ticket.degraded)
+        except Overloaded as e:
+            for index in range(start, len(items)):
+                failed += 1
+                yield {"type": "item", **SuggestBatchItem(index=index, success=False, error=str(e)).model_dump(mode="json")}
+            yield {"type": "summary", "success": False, "count": len(items), "failed": failed, "reason": e.reason}
+            return
+        for offset, result in enumerate(results):
+            entry = SuggestBatchItem(index=start + offset, **result)
+            failed += 0 if entry.success else 1
+            yield {"type": "item", **entry.model_dump(mode="json")}
+    yield {"type": "summary", "success": True, "count": len(items), "failed": failed}
+
+
 @app.post("/auto-fill", response_model=AutoFillResponse, tags=["Routing"])
 async def auto_fill_form(request: AutoFillRequest):
     """Tu dong dien form dua tren mo ta"""
-    result = router.auto_fill_form(request.description)
+    async with admission.slot('routing'):
+        result = await run_in_threadpool(router.auto_fill_form, request.description)
     return AutoFillResponse(**result)
 
 
@@ -188,7 +455,15 @@ async def find_similar_incidents(
     limit: int = Query(5, ge=1, le=20)
 ):
     """Tim cac incidents tuong tu"""
-    return router.find_similar_incidents(description, limit=limit)
+    cache_key = ('similar', normalize_query(description), limit)
+    cached = query_cache.get('incidents', cache_key)
+    if cached is not None:
+        return cached
+
+    async with admission.slot('routing'):
+        result = await run_in_threadpool(router.find_similar_incidents, description, limit=limit)
+    query_cache.set('incidents', cache_key, result)
+    return result
 
 
 class CheckDuplicateRequest(BaseModel):
@@ -211,10 +486,106 @@ class CheckDuplicateResponse(BaseModel):
     message_ja: str
     similar_ideas: List[Dict[str, Any]]
     workflow_history: List[Dict[str, Any]] = []
+    # cleaned: search tren text da lam sach; raw: extract khong doi text (hoac LLM loi);
+    # pending: LLM qua CHECK_DUPLICATE_EXTRACT_BUDGET_MS -> tra ket qua text goc (skipped_stages co llm_extract)
+    extraction: str = "cleaned"
+    skipped_stages: List[str] = []
+
+
+def _whitebox_settings() -> Dict:
+    """Nguong trung lap cua hop trang (system_settings)"""
+    with db.cursor() as cur:
+        cur.execute("""
+            SELECT key, value FROM system_settings 
+            WHERE key IN ('whitebox_idea_similarity_threshold', 'whitebox_opinion_similarity_threshold', 'allow_duplicate_with_confirmation')
+        """)
+        return {row['key']: row['value'] for row in cur.fetchall()}
+
+
+async def _rank_ideas_gated(text: str, filters: Dict, admitted: asyncio.Event = None) -> tuple:
+    """
+    Phase 1 cua check-duplicate: lean ANN + rerank top 10, trong admission slot 'ideas'.
+    admitted: set khi da co slot (search dang chay tren threadpool, khong con xep hang)
+    """
+    async with admission.slot('ideas') as ticket:
+        if admitted is not None:
+            admitted.set()
+        results = await run_in_threadpool(_rank_ideas, text, filters, 30, 10, not ticket.degraded)
+    return results, ticket
+
+
+# Task nen sau khi tra response (extraction vuot budget, nang cap embedding idea).
+# Giu reference tranh bi GC giua chung
+_background_tasks = set()
+
+
+def _keep_background(task: asyncio.Task):
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def _discard_result(task: asyncio.Task):
+    """Ket qua task khong con can: de chay xong o nen, nuot exception (khong log 'never retrieved')"""
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    _keep_background(task)
+
+
+async def _hedged_rank_ideas(raw_text: str, filters: Dict) -> tuple:
+    """
+    LLM extract song song voi search tren text goc. Tra ve (results, ticket, extraction):
+    - extract xong trong CHECK_DUPLICATE_HEDGE_MS (fast path cuc bo, cache): chi search text da lam sach
+    - xong trong CHECK_DUPLICATE_EXTRACT_BUDGET_MS: search lai tren text da lam sach ('cleaned')
+    - qua budget: tra ket qua text goc ('pending'), extract chay tiep de cache
+    p95 khong con phu thuoc latency LLM.
+    """
+    start = time.perf_counter()
+    extract_task = asyncio.ensure_future(extract_core_issue(raw_text))
+    await asyncio.wait({extract_task}, timeout=Config.CHECK_DUPLICATE_HEDGE_MS / 1000)
+
+    if extract_task.done():
+        search_text = extract_task.result()
+        results, ticket = await _rank_ideas_gated(search_text, filters)
+        outcome = 'fast'
+        extraction = 'cleaned' if search_text != raw_text else 'raw'
+    else:
+        raw_admitted = asyncio.Event()
+        raw_task = asyncio.ensure_future(_rank_ideas_gated(raw_text, filters, raw_admitted))
+        remaining = Config.CHECK_DUPLICATE_EXTRACT_BUDGET_MS / 1000 - (time.perf_counter() - start)
+        await asyncio.wait({extract_task}, timeout=max(0.0, remaining))
+
+        if not extract_task.done():
+            _keep_background(extract_task)
+            results, ticket = await raw_task
+            outcome = extraction = 'pending'
+        elif extract_task.result() == raw_text:
+            results, ticket = await raw_task
+            outcome = extraction = 'raw'
+        else:
+            # Ket qua text goc khong dung nua: con xep hang -> huy (nhuong slot), dang chay -> de
+            # chay xong o nen (huy giua chung khong dung duoc thread) va lam fallback khi qua tai
+            raw_queued = not raw_admitted.is_set()
+            if raw_queued:
+                raw_task.cancel()
+            _discard_result(raw_task)
+            try:
+                results, ticket = await _rank_ideas_gated(extract_task.result(), filters)
+                outcome = extraction = 'cleaned'
+            except Overloaded:
+                if raw_queued:
+                    raise
+                results, ticket = await raw_task
+                outcome = extraction = 'raw'
+
+    metrics.hedged_extraction.inc(outcome=outcome)
+    return results, ticket, extraction
 
 
 @app.post("/check-duplicate", response_model=CheckDuplicateResponse, tags=["White Box"])
-async def check_duplicate_idea(request: CheckDuplicateRequest):
+async def check_duplicate_idea(
+    request: CheckDuplicateRequest,
+    detail: str = Query("full", pattern="^(full|compact)$", description="compact: bo responses/workflow_history"),
+    fields: Optional[str] = Query(None, description="Chi tra ve cac field nay cua moi idea, vd: id,title,similarity")
+):
     """
     Kiem tra trung lap truoc khi gui y tuong/y kien.
     
@@ -223,15 +594,24 @@ async def check_duplicate_idea(request: CheckDuplicateRequest):
     - Y kien (opinion): similarity <= 90% moi duoc gui
     - Tren nguong: Canh bao trung lap, yeu cau xac nhan
     """
+    field_set = _parse_fields(fields)
+    with_history = _needs_history(detail, field_set)
     try:
-        # Get similarity thresholds from settings
-        with db.cursor() as cur:
-            cur.execute("""
-                SELECT key, value FROM system_settings 
-                WHERE key IN ('whitebox_idea_similarity_threshold', 'whitebox_opinion_similarity_threshold', 'allow_duplicate_with_confirmation')
-            """)
-            settings = {row['key']: row['value'] for row in cur.fetchall()}
-        
+        # Ghép description + expected_benefit để search (nhất quán với cách tạo embedding)
+        search_parts = [request.description]
+        if request.expected_benefit:
+            search_parts.append(request.expected_benefit)
+        raw_text = ' '.join(search_parts)
+
+        # Doc settings va LLM extract chay song song voi search
+        settings_task = asyncio.ensure_future(run_in_threadpool(_whitebox_settings))
+        try:
+            results, ticket, extraction = await _hedged_rank_ideas(raw_text, {'ideabox_type': request.ideabox_type})
+        except BaseException:
+            settings_task.cancel()
+            raise
+        settings = await settings_task
+
         # Default thresholds
         idea_threshold = float(settings.get('whitebox_idea_similarity_threshold', '0.60'))
         opinion_threshold = float(settings.get('whitebox_opinion_similarity_threshold', '0.90'))
@@ -246,115 +626,18 @@ async def check_duplicate_idea(request: CheckDuplicateRequest):
         # Determine threshold based on subtype
         threshold = idea_threshold if request.whitebox_subtype == 'idea' else opinion_threshold
         
-        # Ghép description + expected_benefit để search (nhất quán với cách tạo embedding)
-        search_parts = [request.description]
-        if request.expected_benefit:
-            search_parts.append(request.expected_benefit)
-        search_text = ' '.join(search_parts)
-        
-        # Dùng LLM extract để đồng bộ với cách tạo embedding
-        search_text = await extract_core_issue(search_text)
-        
-        # Generate embedding
-        query_embedding = embedding_service.encode(search_text, is_query=True)
-        
-        # Search for similar ideas with full history and final_resolution
-        with db.cursor() as cur:
-            cur.execute("""
-                SELECT 
-                    i.id,
-                    i.title,
-                    i.description,
-                    i.expected_benefit,
-                    i.status,
-                    i.category,
-                    i.difficulty,
-                    i.ideabox_type,
-                    i.whitebox_subtype,
-                    i.workflow_stage,
-                    i.support_count,
-                    i.remind_count,
-                    i.created_at,
-                    i.updated_at,
-                    i.reviewed_at,
-                    i.implemented_at,
-                    i.final_resolution,
-                    i.final_resolution_ja,
-                    u.full_name as submitter_name,
-                    d.name as department_name,
-                    d.code as department_code,
-                    1 - (i.embedding <=> %s::vector) as similarity,
-                    (SELECT COUNT(*) FROM idea_supports WHERE idea_id = i.id) as total_supports,
-                    (SELECT json_agg(json_build_object(
-                        'response', ir.response,
-                        'created_at', ir.created_at,
-                        'responder_name', ru.full_name,
-                        'responder_role', ru.role,
-                        'is_final_resolution', COALESCE(ir.is_final_resolution, false),
-                        'response_type', COALESCE(ir.response_type, 'comment')
-                    ) ORDER BY ir.created_at DESC)
-                    FROM idea_responses ir
-                    LEFT JOIN users ru ON ir.user_id = ru.id
-                    WHERE ir.idea_id = i.id
-                    LIMIT 10) as responses,
-                    (SELECT json_agg(json_build_object(
-                        'action', ih.action,
-                        'details', ih.details,
-                        'created_at', ih.created_at,
-                        'performed_by_name', tu.full_name
-                    ) ORDER BY ih.created_at DESC)
-                    FROM idea_history ih
-                    LEFT JOIN users tu ON ih.performed_by = tu.id
-                    WHERE ih.idea_id = i.id
-                    LIMIT 15) as workflow_history,
-                    (SELECT ir.response FROM idea_responses ir
-                     WHERE ir.idea_id = i.id AND ir.is_final_resolution = true
-                     ORDER BY ir.created_at DESC LIMIT 1) as final_resolution_response
-                FROM ideas i
-                LEFT JOIN users u ON i.submitter_id = u.id
-                LEFT JOIN departments d ON i.department_id = d.id
-                WHERE i.embedding IS NOT NULL
-                  AND i.ideabox_type = %s
-                ORDER BY i.embedding <=> %s::vector
-                LIMIT 30
-            """, (query_embedding.tolist(), request.ideabox_type, query_embedding.tolist()))
-            
-            results = cur.fetchall()
-        
-        # === RERANKING STEP ===
-        # Nếu có Reranker tiếng Việt, dùng để cải thiện ranking
-        if results and hasattr(embedding_service, '_reranker') and embedding_service._reranker:
-            import numpy as np
-            # Ghép description + expected_benefit cho reranking (nhất quán với cách tạo embedding)
-            candidate_texts = [
-                ' '.join(filter(None, [row.get('description', ''), row.get('expected_benefit', '')]))
-                for row in results
-            ]
-            
-            # Rerank với query gốc
-            rerank_scores = embedding_service.rerank(search_text, candidate_texts)
-            
-            # Sigmoid normalize (BGE reranker trả về raw logits)
-            rerank_scores = (1 / (1 + np.exp(-np.array(rerank_scores)))).tolist()
-            
-            # Kết hợp vector score và rerank score: lấy MAX để không giảm score cho exact match
-            results_with_rerank = []
-            for i, row in enumerate(results):
-                row_dict = dict(row)
-                vector_score = float(row['similarity']) if row['similarity'] else 0
-                rerank_score = rerank_scores[i]
-                # Dùng max để tránh giảm score khi text giống nhau
-                row_dict['similarity'] = max(vector_score, rerank_score)
-                row_dict['vector_score'] = vector_score
-                row_dict['rerank_score'] = rerank_score
-                results_with_rerank.append(row_dict)
-            
-            # Sort theo combined score và lấy top 10
-            results = sorted(results_with_rerank, key=lambda x: x['similarity'], reverse=True)[:10]
-            print(f"[RAG] Reranked {len(candidate_texts)} candidates, keeping top 10")
-        else:
-            # Không có reranker, giữ nguyên top 10
-            results = [dict(r) for r in results[:10]]
+        # Phase 2: chi hydrate cac idea duoc tra ve (top 5 > min threshold) bang 1 query batched
+        survivors = [r for r in results if r['similarity'] and float(r['similarity']) > 0.1][:5]
+        hydrate_start = time.perf_counter()
+        cards = await run_in_threadpool(
+            db.get_idea_cards, [str(r['id']) for r in survivors], with_history=with_history
+        )
+        results = _merge_in_ann_order(survivors, list(cards.values()))
+        hydrate_ms = (time.perf_counter() - hydrate_start) * 1000
+        log.info(
+            "check_duplicate", hydrate_ms=round(hydrate_ms, 1), ideas=len(results),
+            degraded=ticket.degraded, extraction=extraction
+        )
         
         similar_ideas = []
         max_similarity = 0.0
@@ -371,19 +654,6 @@ async def check_duplicate_idea(request: CheckDuplicateRequest):
                 final_resolution = row.get('final_resolution') or row.get('final_resolution_response')
                 final_resolution_ja = row.get('final_resolution_ja')
                 
-                # Find the final resolution response from responses array
-                final_resolution_detail = None
-                responses = row['responses'] or []
-                for resp in responses:
-                    if resp and resp.get('is_final_resolution'):
-                        final_resolution_detail = {
-                            'response': resp.get('response'),
-                            'responder_name': resp.get('responder_name'),
-                            'responder_role': resp.get('responder_role'),
-                            'created_at': resp.get('created_at')
-                        }
-                        break
-                
                 idea_data = {
                     "id": str(row['id']),
                     # UI mapping: description -> title, expected_benefit -> content
@@ -405,19 +675,34 @@ async def check_duplicate_idea(request: CheckDuplicateRequest):
                     "support_count": row['support_count'] or 0,
                     "remind_count": row['remind_count'] or 0,
                     "total_supports": row['total_supports'] or 0,
-                    "created_at": row['created_at'].isoformat() if row['created_at'] else None,
-                    "updated_at": row['updated_at'].isoformat() if row['updated_at'] else None,
-                    "reviewed_at": row['reviewed_at'].isoformat() if row['reviewed_at'] else None,
-                    "implemented_at": row['implemented_at'].isoformat() if row['implemented_at'] else None,
+                    "created_at": row.get('created_at'),
+                    "updated_at": row.get('updated_at'),
+                    "reviewed_at": row.get('reviewed_at'),
+                    "implemented_at": row.get('implemented_at'),
                     "has_resolution": row['status'] in ['implemented', 'approved'] or final_resolution is not None,
                     # NEW: Final resolution fields
                     "final_resolution": final_resolution,
                     "final_resolution_ja": final_resolution_ja,
-                    "final_resolution_detail": final_resolution_detail,
-                    "last_response": responses[0].get('response') if responses else None,
-                    "responses": responses,
-                    "workflow_history": row['workflow_history'] or []
                 }
+                if with_history:
+                    # Find the final resolution response from responses array
+                    final_resolution_detail = None
+                    responses = row['responses'] or []
+                    for resp in responses:
+                        if resp and resp.get('is_final_resolution'):
+                            final_resolution_detail = {
+                                'response': resp.get('response'),
+                                'responder_name': resp.get('responder_name'),
+                                'responder_role': resp.get('responder_role'),
+                                'created_at': resp.get('created_at')
+                            }
+                            break
+                    idea_data.update({
+                        "final_resolution_detail": final_resolution_detail,
+                        "last_response": responses[0].get('response') if responses else None,
+                        "responses": responses,
+                        "workflow_history": row['workflow_history'] or []
+                    })
                 similar_ideas.append(idea_data)
         
         # Determine if duplicate
@@ -440,20 +725,25 @@ async def check_duplicate_idea(request: CheckDuplicateRequest):
             message = f"Ý tưởng/ý kiến này đã tồn tại ({round(max_similarity * 100)}%). Không thể gửi."
             message_ja = f"このアイデア/意見は既に存在します（{round(max_similarity * 100)}%）。送信できません。"
         
-        return CheckDuplicateResponse(
-            is_duplicate=is_duplicate,
-            can_submit=can_submit or needs_confirmation,
-            needs_confirmation=needs_confirmation,
-            similarity_threshold=threshold,
-            max_similarity=max_similarity,
-            message=message,
-            message_ja=message_ja,
-            similar_ideas=similar_ideas[:5],  # Top 5 similar
-            workflow_history=similar_ideas[0]['workflow_history'] if similar_ideas else []
-        )
+        # Tra ve truc tiep (khong validate lai payload qua response_model)
+        return FastJSONResponse({
+            "is_duplicate": is_duplicate,
+            "can_submit": can_submit or needs_confirmation,
+            "needs_confirmation": needs_confirmation,
+            "similarity_threshold": threshold,
+            "max_similarity": max_similarity,
+            "message": message,
+            "message_ja": message_ja,
+            "similar_ideas": [_project(idea, field_set) for idea in similar_ideas[:5]],  # Top 5 similar
+            "workflow_history": similar_ideas[0].get('workflow_history', []) if similar_ideas else [],
+            "extraction": extraction,
+            "skipped_stages": _skipped_stages(ticket) + (["llm_extract"] if extraction == "pending" else [])
+        })
         
+    except Overloaded:
+        raise
     except Exception as e:
-        print(f"[ERROR] Check duplicate failed: {e}")
+        log.error("check_duplicate_failed", error=str(e))
         # Return safe default on error
         return CheckDuplicateResponse(
             is_duplicate=False,
@@ -473,117 +763,57 @@ async def find_similar_ideas(
     query: str = Query(..., min_length=3, description="Noi dung tim kiem"),
     limit: int = Query(5, ge=1, le=20),
     ideabox_type: str = Query("white", description="Loai hom: 'white' hoac 'pink'"),
-    whitebox_subtype: str = Query(None, description="Loai: 'idea' hoac 'opinion'")
+    whitebox_subtype: str = Query(None, description="Loai: 'idea' hoac 'opinion'"),
+    detail: str = Query("full", pattern="^(full|compact)$", description="compact: bo responses/workflow_history"),
+    fields: Optional[str] = Query(None, description="Chi tra ve cac field nay cua moi idea, vd: id,title,similarity")
 ):
     """
     Tim cac ideas tuong tu bang vector search - Enhanced version.
-    Tra ve thong tin chi tiet bao gom lich su workflow va responses.
+    Tra ve thong tin chi tiet bao gom lich su workflow va responses
+    (detail=compact hoac fields=... cho payload gon, vd goi y luc dang go).
     """
+    field_set = _parse_fields(fields)
+    with_history = _needs_history(detail, field_set)
+    cache_key = (
+        'similar-ideas', normalize_query(query), limit, ideabox_type or None, whitebox_subtype or None,
+        with_history, tuple(sorted(field_set)) if field_set else None
+    )
+    cached = query_cache.get('ideas', cache_key)
+    if cached is not None:
+        return FastJSONResponse({**cached, "query": query})
+
+    async with admission.slot('ideas') as ticket:
+        response = await run_in_threadpool(
+            _search_similar_ideas, query, limit, ideabox_type, whitebox_subtype,
+            with_history, field_set, not ticket.degraded
+        )
+    if response.get("search_type") == "vector" and not ticket.degraded:
+        # Ket qua degraded (khong rerank) hoac fallback text search khong dua vao cache
+        query_cache.set('ideas', cache_key, response)
+    return FastJSONResponse(response)
+
+
+def _search_similar_ideas(
+    query: str,
+    limit: int,
+    ideabox_type: Optional[str],
+    whitebox_subtype: Optional[str],
+    with_history: bool,
+    field_set: Optional[set],
+    rerank: bool
+) -> Dict:
+    """Vector search + hydrate cho /similar-ideas (chay trong threadpool), fallback text search"""
     try:
-        # Generate embedding for query
-        query_embedding = embedding_service.encode(query, is_query=True)
-        embedding_list = query_embedding.tolist()
-        
-        # Build filter conditions - use positional params carefully
-        filter_conditions = ["i.embedding IS NOT NULL"]
-        extra_params = []
-        
-        if ideabox_type:
-            filter_conditions.append(f"i.ideabox_type = '{ideabox_type}'::ideabox_type")
-        
-        if whitebox_subtype:
-            filter_conditions.append(f"i.whitebox_subtype = '{whitebox_subtype}'::whitebox_subtype")
-        
-        # Final params: embedding1, embedding2, limit (nhân 3 để rerank)
-        rerank_limit = limit * 3 if limit else 30
-        params = [embedding_list, embedding_list, rerank_limit]
-        
-        # Search in ideas table with pgvector - with more fields and history
-        with db.cursor() as cur:
-            cur.execute(f"""
-                SELECT 
-                    i.id,
-                    i.title,
-                    i.description,
-                    i.expected_benefit,
-                    i.status,
-                    i.category,
-                    i.difficulty,
-                    i.ideabox_type,
-                    i.whitebox_subtype,
-                    i.workflow_stage,
-                    i.support_count,
-                    i.remind_count,
-                    i.handler_level,
-                    i.created_at,
-                    i.updated_at,
-                    i.reviewed_at,
-                    i.implemented_at,
-                    u.full_name as submitter_name,
-                    d.name as department_name,
-                    i.like_count,
-                    1 - (i.embedding <=> %s::vector) as similarity,
-                    (SELECT COUNT(*) FROM ideas i2 
-                     WHERE i2.status = 'implemented' 
-                     AND i2.category = i.category) as implemented_count,
-                    (SELECT json_agg(json_build_object(
-                        'response', ir.response,
-                        'created_at', ir.created_at,
-                        'responder_name', ru.full_name
-                    ) ORDER BY ir.created_at DESC)
-                    FROM idea_responses ir
-                    LEFT JOIN users ru ON ir.user_id = ru.id
-                    WHERE ir.idea_id = i.id
-                    LIMIT 10) as responses,
-                    (SELECT json_agg(json_build_object(
-                        'action', ih.action,
-                        'details', ih.details,
-                        'created_at', ih.created_at,
-                        'performed_by_name', tu.full_name
-                    ) ORDER BY ih.created_at DESC)
-                    FROM idea_history ih
-                    LEFT JOIN users tu ON ih.performed_by = tu.id
-                    WHERE ih.idea_id = i.id
-                    LIMIT 10) as workflow_history,
-                    ws.stage_name,
-                    ws.stage_name_ja,
-                    ws.color as stage_color
-                FROM ideas i
-                LEFT JOIN users u ON i.submitter_id = u.id
-                LEFT JOIN departments d ON i.department_id = d.id
-                LEFT JOIN idea_workflow_stages ws ON i.workflow_stage = ws.stage_code
-                WHERE {' AND '.join(filter_conditions)}
-                ORDER BY i.embedding <=> %s::vector
-                LIMIT %s
-            """, tuple(params))
-            
-            results = cur.fetchall()
+        # Filtered ANN: metadata filter push xuong vector query (lay x3 de rerank)
+        results = _rank_ideas(
+            query,
+            {'ideabox_type': ideabox_type or None, 'whitebox_subtype': whitebox_subtype or None},
+            limit * 3 if limit else 30, limit, rerank
+        )
         
-        # === RERANKING STEP ===
-        if results and hasattr(embedding_service, '_reranker') and embedding_service._reranker:
-            import numpy as np
-            # Ghép description + expected_benefit cho reranking (nhất quán với cách tạo embedding)
-            candidate_texts = [
-                ' '.join(filter(None, [row.get('description', ''), row.get('expected_benefit', '')]))
-                for row in results
-            ]
-            
-            rerank_scores = embedding_service.rerank(query, candidate_texts)
-            rerank_scores = (1 / (1 + np.exp(-np.array(rerank_scores)))).tolist()
-            
-            # Kết hợp vector score và rerank score: lấy MAX để không giảm score cho exact match
-            results_with_rerank = []
-            for i, row in enumerate(results):
-                row_dict = dict(row)
-                vector_score = float(row['similarity']) if row['similarity'] else 0
-                rerank_score = rerank_scores[i]
-                row_dict['similarity'] = max(vector_score, rerank_score)
-                results_with_rerank.append(row_dict)
-            
-            results = sorted(results_with_rerank, key=lambda x: x['similarity'], reverse=True)[:limit]
-            print(f"[RAG] Reranked {len(candidate_texts)} candidates for find_similar_ideas")
-        else:
-            results = [dict(r) for r in results[:limit]]
+        # Hydrate ket qua cuoi tu idea card (1 lookup theo primary key)
+        cards = db.get_idea_cards([str(r['id']) for r in results], with_history=with_history)
+        results = _merge_in_ann_order(results, list(cards.values()))
         
         ideas = []
         for row in results:
@@ -592,7 +822,7 @@ async def find_similar_ideas(
                 # Determine relevance level based on thresholds
                 relevance_level = "critical" if similarity > 0.9 else "high" if similarity > 0.7 else "medium" if similarity > 0.5 else "low"
                 
-                ideas.append({
+                idea = {
                     "id": str(row['id']),
                     # UI mapping: description -> title, expected_benefit -> content
                     "title": row['description'],
@@ -615,17 +845,19 @@ async def find_similar_ideas(
                     "support_count": row['support_count'] or 0,
                     "remind_count": row['remind_count'] or 0,
                     "like_count": row['like_count'] or 0,
-                    "created_at": row['created_at'].isoformat() if row['created_at'] else None,
-                    "updated_at": row['updated_at'].isoformat() if row['updated_at'] else None,
-                    "reviewed_at": row['reviewed_at'].isoformat() if row['reviewed_at'] else None,
-                    "implemented_at": row['implemented_at'].isoformat() if row['implemented_at'] else None,
+                    "created_at": row.get('created_at'),
+                    "updated_at": row.get('updated_at'),
+                    "reviewed_at": row.get('reviewed_at'),
+                    "implemented_at": row.get('implemented_at'),
                     "implemented_in_category": row['implemented_count'] or 0,
-                    "responses": row['responses'] or [],
-                    "workflow_history": row['workflow_history'] or [],
                     "has_resolution": row['status'] in ['implemented', 'approved']
-                })
+                }
+                if with_history:
+                    idea["responses"] = row['responses'] or []
+                    idea["workflow_history"] = row['workflow_history'] or []
+                ideas.append(_project(idea, field_set))
         
-        return {
+        response = {
             "success": True,
             "query": query,
             "count": len(ideas),
@@ -634,10 +866,12 @@ async def find_similar_ideas(
             "filters": {
                 "ideabox_type": ideabox_type,
                 "whitebox_subtype": whitebox_subtype
-            }
+            },
+            "skipped_stages": [] if rerank or not _has_reranker() else ["rerank"]
         }
+        return response
     except Exception as e:
-        print(f"[ERROR] Vector search failed: {e}")
+        log.warning("similar_ideas_vector_search_failed", error=str(e), fallback="text_search")
         # Fallback to text search if vector search fails
         try:
             with db.cursor() as cur:
@@ -704,13 +938,159 @@ async def get_embedding_stats():
     return db.count_embeddings()
 
 
-@app.post("/process-batch", tags=["Admin"])
+def _run_process_batch(job, batch_size: int, max_records: Optional[int], resume: bool) -> dict:
+    """Job nen cho /process-batch"""
+    def on_start(backfill_job: dict):
+        remaining = backfill_job['total'] - (backfill_job['processed'] or 0) - (backfill_job['failed'] or 0)
+        job.set_total(min(remaining, max_records) if max_records else remaining)
+
+    result = processor.process_all(
+        batch_size=batch_size,
+        max_records=max_records,
+        resume=resume,
+        on_start=on_start,
+        on_progress=job.report,
+        on_items=job.emit,
+        should_stop=lambda: job.cancelled,
+        show_progress=False
+    )
+    if result.get('processed'):
+        local_index.request_sync()
+        query_cache.bump('incidents')
+    return result
+
+
+async def _submit(kind: str, fn, key: str, **params) -> Job:
+    """Submit job nen; 409 neu cung key dang chay o bat ky worker nao (single-flight)"""
+    try:
+        return await run_in_threadpool(job_runner.submit, kind, fn, key=key, **params)
+    except JobConflictError as e:
+        raise HTTPException(
+            status_code=409,
+            detail={"message": str(e), "job_id": e.job_id, "status_url": f"/jobs/{e.job_id}"}
+        )
+
+
+async def _enqueue(kind: str, fn, key: str, **params) -> dict:
+    """Enqueue job nen, tra ve job_id ngay"""
+    job = await _submit(kind, fn, key, **params)
+    return {
+        "success": True,
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
+        "stream_url": f"/jobs/{job.id}/stream"
+    }
+
+
+async def _job_records(job: Job):
+    """Tail ket qua tung item cua job, dong cuoi la trang thai job (summary)"""
+    seq = 0
+    while True:
+        finished = job.finished
+        records, missed, seq = job.events_after(seq)
+        if missed:
+            yield {"type": "gap", "missed": missed}
+        for record in records:
+            yield {"type": "item", **record}
+        if finished:
+            yield {"type": "summary", **job.to_dict()}
+            return
+        await asyncio.sleep(JOB_STREAM_POLL_SECONDS)
+
+
+async def _remote_job_records(job_id: str):
+    """
+    Job chay o worker khac: ket qua tung item chi co trong bo nho worker do ->
+    poll trang thai trong Postgres, chi tra dong summary khi job xong
+    """
+    yield {"type": "info", "message": "Job dang chay o worker khac, chi co summary"}
+    while True:
+        state = await run_in_threadpool(job_runner.get_dict, job_id)
+        if state is None or state['status'] not in ACTIVE_STATUSES:
+            yield {"type": "summary", **(state or {"job_id": job_id, "status": "not_found"})}
+            return
+        await asyncio.sleep(JOB_STREAM_POLL_SECONDS)
+
+
+@app.post("/process-batch", status_code=202, tags=["Admin"])
 async def process_batch(
     batch_size: int = Query(50, ge=10, le=200),
-    max_records: Optional[int] = Query(None, ge=1)
+    max_records: Optional[int] = Query(None, ge=1),
+    resume: bool = Query(True, description="Tiep tuc job dang do neu co"),
+    stream: bool = Query(False, description="Giu ket noi va stream NDJSON ket qua tung incident")
+):
+    """
+    Tao embeddings cho cac incidents chua co - chay nen, tra ve job_id ngay.
+    Theo doi tien do tai GET /jobs/{job_id} hoac GET /jobs/{job_id}/stream.
+    """
+    params = dict(batch_size=batch_size, max_records=max_records, resume=resume)
+    if stream:
+        job = await _submit('process-batch', _run_process_batch, key='backfill:incidents', **params)
+        return _ndjson_response(_job_records(job))
+    return await _enqueue('process-batch', _run_process_batch, key='backfill:incidents', **params)
+
+
+@app.get("/jobs", tags=["Jobs"])
+async def list_jobs(kind: Optional[str] = Query(None, description="'process-batch' hoac 'ideas-embeddings'")):
+    """Danh sach job nen (moi nhat truoc)"""
+    return {"jobs": await run_in_threadpool(job_runner.list, kind)}
+
+
+@app.get("/jobs/{job_id}", tags=["Jobs"])
+async def get_job(job_id: str):
+    """Tien do, throughput va ETA cua 1 job nen (job chay o bat ky worker nao)"""
+    state = await run_in_threadpool(job_runner.get_dict, job_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return state
+
+
+@app.get("/jobs/{job_id}/stream", tags=["Jobs"])
+async def stream_job(job_id: str):
+    """Stream NDJSON ket qua tung item cua job, ket thuc bang 1 dong summary khi job xong"""
+    job = job_runner.get(job_id)
+    if job is not None:
+        return _ndjson_response(_job_records(job))
+    if await run_in_threadpool(job_runner.get_dict, job_id) is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return _ndjson_response(_remote_job_records(job_id))
+
+
+@app.post("/jobs/{job_id}/cancel", tags=["Jobs"])
+async def cancel_job(job_id: str):
+    """Yeu cau huy job - job dung sau batch/item hien tai"""
+    state = await run_in_threadpool(job_runner.cancel, job_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return state
+
+
+@app.get("/backfill/jobs", tags=["Admin"])
+async def list_backfill_jobs(
+    target: Optional[str] = Query(None, description="Loc theo bang: 'incidents' hoac 'ideas'"),
+    limit: int = Query(20, ge=1, le=100)
 ):
-    """Tao embeddings cho cac incidents chua co"""
-    return processor.process_all(batch_size=batch_size, max_records=max_records)
+    """Danh sach cac backfill job gan nhat"""
+    return {"jobs": db.list_backfill_jobs(target=target, limit=limit)}
+
+
+@app.get("/backfill/runs/{run_id}", tags=["Admin"])
+async def get_backfill_run(run_id: str):
+    """Tien do gop cua 1 lan backfill song song (parallel_backfill.py)"""
+    summary = db.get_backfill_run(run_id)
+    if summary['status'] == 'not_found':
+        raise HTTPException(status_code=404, detail=f"Run {run_id} not found")
+    return summary
+
+
+@app.get("/backfill/jobs/{job_id}", tags=["Admin"])
+async def get_backfill_job(job_id: str):
+    """Trang thai 1 backfill job (cursor, tien do, cac row loi)"""
+    job = processor.get_job_status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job
 
 
 @app.post("/create-embedding/{incident_id}", tags=["Webhook"])
@@ -723,8 +1103,10 @@ async def create_embedding_for_incident(incident_id: str):
     try:
         with db.cursor() as cur:
             cur.execute("""
-                SELECT id, description, assigned_department_id, status
-                FROM incidents WHERE id = %s::uuid
+                SELECT i.id, i.description, i.assigned_department_id, i.status, d.name as department_name
+                FROM incidents i
+                LEFT JOIN departments d ON i.assigned_department_id = d.id
+                WHERE i.id = %s::uuid
             """, (incident_id,))
             incident = cur.fetchone()
 
@@ -740,6 +1122,11 @@ async def create_embedding_for_incident(incident_id: str):
         success = db.save_embedding(incident_id, embedding)
 
         if success:
+            local_index.request_sync()
+            query_cache.bump('incidents')
+            department_prototypes.add(
+                incident_id, incident["assigned_department_id"], incident["department_name"], embedding
+            )
             return {
                 "success": True, 
                 "incident_id": incident_id, 
@@ -822,7 +1209,7 @@ async def update_rag_settings(request: RAGSettingsRequest):
 # === Ideas Embedding Management ===
 
 class GenerateIdeasEmbeddingResponse(BaseModel):
-    """Response cho generate ideas embeddings"""
+    """Ket qua job generate ideas embeddings"""
     success: bool
     processed: int
     failed: int
@@ -830,93 +1217,209 @@ class GenerateIdeasEmbeddingResponse(BaseModel):
     message: str
 
 
-@app.post("/ideas/generate-embeddings", response_model=GenerateIdeasEmbeddingResponse, tags=["Ideas"])
-async def generate_ideas_embeddings(limit: int = Query(100, ge=1, le=1000)):
+def _encode_and_save_ideas(batch: List[tuple]) -> List[dict]:
     """
-    Generate embeddings cho cac ideas chua co embedding.
-    Nen chay sau khi them ideas moi vao database.
+    Encode 1 batch (id, text goc, text da lam sach hoac None) + bulk UPDATE, batch loi thi ghi tung row.
+    Extract loi (None) -> encode text goc, version 'raw'. Tra ve ket qua tung idea
     """
+    ids = [idea_id for idea_id, _, _ in batch]
     try:
-        # Count ideas without embedding
-        with db.cursor() as cur:
-            cur.execute("SELECT COUNT(*) FROM ideas WHERE embedding IS NULL")
-            total_without = cur.fetchone()['count']
-        
-        if total_without == 0:
-            return GenerateIdeasEmbeddingResponse(
-                success=True,
-                processed=0,
-                failed=0,
-                total_without_embedding=0,
-                message="Tat ca ideas da co embedding"
-            )
-        
-        # Get ideas without embedding
-        with db.cursor() as cur:
-            cur.execute("""
-                SELECT id, title, description, expected_benefit
-                FROM ideas 
-                WHERE embedding IS NULL
-                LIMIT %s
-            """, (limit,))
-            ideas = cur.fetchall()
-        
-        processed = 0
-        failed = 0
-        
-        for idea in ideas:
-            try:
-                # Combine text fields for embedding (bỏ title, chỉ dùng description + expected_benefit)
-                text_parts = []
-                if idea['description']:
-                    text_parts.append(idea['description'])
-                if idea['expected_benefit']:
-                    text_parts.append(idea['expected_benefit'])
-                
-                combined_text = ' '.join(text_parts)
-                
-                if len(combined_text) < 10:
-                    failed += 1
-                    continue
-                
-                # Dùng LLM để trích xuất vấn đề chính (loại bỏ "mong xem xét"...)
-                extracted_text = await extract_core_issue(combined_text)
-                
-                # Generate embedding từ text đã được làm sạch
-                embedding = embedding_service.encode(extracted_text)
-                
-                # Save to database
-                with db.cursor() as cur:
-                    cur.execute("""
-                        UPDATE ideas 
-                        SET embedding = %s::vector
-                        WHERE id = %s
-                    """, (embedding.tolist(), idea['id']))
-                
-                processed += 1
-                
-            except Exception as e:
-                print(f"[ERROR] Failed to process idea {idea['id']}: {e}")
-                failed += 1
-        
-        remaining = total_without - processed - failed
-        message = f"Da xu ly {processed} ideas."
-        if failed > 0:
-            message += f" {failed} that bai."
-        if remaining > 0:
-            message += f" Con {remaining} ideas can xu ly."
-        
+        embeddings = embedding_service.encode([raw if text is None else text for _, raw, text in batch])
+    except Exception as e:
+        log.error("index_ideas_encode_failed", count=len(batch), error=str(e))
+        return [{"id": idea_id, "status": "error", "error": f"encode failed: {e}"} for idea_id in ids]
+
+    data = [
+        {
+            'id': idea_id,
+            'embedding': emb,
+            'version': EMBEDDING_VERSION_RAW if text is None else EMBEDDING_VERSION_EXTRACTED,
+            'text_hash': embedding_text_hash(raw),
+        }
+        for (idea_id, raw, text), emb in zip(batch, embeddings)
+    ]
+    errors = {}
+    if db.save_embeddings_batch(data, table='ideas') != len(data):
+        errors = {str(fid): reason for fid, reason in db.save_embeddings_rowwise(data, table='ideas')}
+    return [
+        {"id": idea_id, "status": "error", "error": errors[idea_id]} if idea_id in errors
+        else {"id": idea_id, "status": "indexed"}
+        for idea_id in ids
+    ]
+
+
+async def _generate_ideas_embeddings(job, limit: int) -> dict:
+    """Job nen cho /ideas/generate-embeddings"""
+    # Count ideas without embedding
+    with db.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM ideas WHERE embedding IS NULL")
+        total_without = cur.fetchone()['count']
+    
+    if total_without == 0:
+        job.set_total(0)
         return GenerateIdeasEmbeddingResponse(
             success=True,
-            processed=processed,
-            failed=failed,
-            total_without_embedding=remaining,
-            message=message
-        )
-        
-    except Exception as e:
-        print(f"[ERROR] Generate ideas embeddings failed: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+            processed=0,
+            failed=0,
+            total_without_embedding=0,
+            message="Tat ca ideas da co embedding"
+        ).model_dump()
+    
+    # Get ideas without embedding
+    with db.cursor() as cur:
+        cur.execute("""
+            SELECT id, title, description, expected_benefit
+            FROM ideas 
+            WHERE embedding IS NULL
+            LIMIT %s
+        """, (limit,))
+        ideas = cur.fetchall()
+    
+    job.set_total(len(ideas))
+    processed = 0
+    failed = 0
+
+    # Combine text fields for embedding (bỏ title, chỉ dùng description + expected_benefit)
+    items = []
+    for idea in ideas:
+        combined_text = ' '.join(filter(None, [idea['description'], idea['expected_benefit']]))
+        if len(combined_text) < 10:
+            failed += 1
+            job.report(failed=1)
+            job.emit([{"id": str(idea['id']), "status": "too_short"}])
+            continue
+        items.append((str(idea['id']), combined_text))
+    raw_texts = dict(items)
+
+    async def flush(batch: List[tuple]):
+        nonlocal processed, failed
+        records = await asyncio.to_thread(_encode_and_save_ideas, batch)
+        indexed = sum(1 for r in records if r["status"] == "indexed")
+        processed += indexed
+        failed += len(records) - indexed
+        job.report(done=indexed, failed=len(records) - indexed)
+        job.emit(records)
+
+    # Pipeline: LLM extract song song (rate limit + retry) -> gom STREAM_BATCH_SIZE
+    # -> encode 1 lan + bulk UPDATE, trong khi cac extraction khac van chay.
+    # Khong fallback: extract loi -> ghi embedding text goc ('raw'), /ideas/upgrade-embeddings lam lai
+    batch = []
+    stream = extract_stream(items, fallback=False)
+    try:
+        async for idea_id, extracted_text in stream:
+            batch.append((idea_id, raw_texts[idea_id], extracted_text))
+            if len(batch) >= STREAM_BATCH_SIZE:
+                await flush(batch)
+                batch = []
+            if job.cancelled:
+                break
+        if batch:
+            await flush(batch)
+    finally:
+        await stream.aclose()
+        # Job chay tren event loop rieng (job_runner) -> dong client cua loop nay
+        await close_client()
+
+    if processed:
+        local_index.request_sync()
+        query_cache.bump('ideas')
+    
+    remaining = total_without - processed - failed
+    message = f"Da xu ly {processed} ideas."
+    if failed > 0:
+        message += f" {failed} that bai."
+    if job.cancelled:
+        message += " Da huy."
+    if remaining > 0:
+        message += f" Con {remaining} ideas can xu ly."
+    
+    return GenerateIdeasEmbeddingResponse(
+        success=True,
+        processed=processed,
+        failed=failed,
+        total_without_embedding=remaining,
+        message=message
+    ).model_dump()
+
+
+@app.post("/ideas/generate-embeddings", status_code=202, tags=["Ideas"])
+async def generate_ideas_embeddings(limit: int = Query(100, ge=1, le=1000)):
+    """
+    Generate embeddings cho cac ideas chua co embedding - chay nen, tra ve job_id ngay.
+    Nen chay sau khi them ideas moi vao database.
+    Ket qua (GenerateIdeasEmbeddingResponse) nam trong GET /jobs/{job_id}.
+    """
+    return await _enqueue('ideas-embeddings', _generate_ideas_embeddings, key='backfill:ideas', limit=limit)
+
+
+async def _upgrade_ideas_embeddings(job, limit: int) -> dict:
+    """
+    Job nen cho /ideas/upgrade-embeddings: nang cap ideas chua o EMBEDDING_VERSION_EXTRACTED
+    (raw do /ideas/index chua kip extract, prompt cu, backfill cu). Chay lai an toan:
+    row da nang cap hoac da bi index lai voi text khac se bi UPDATE bo qua
+    """
+    ideas = await asyncio.to_thread(db.get_ideas_for_embedding_upgrade, EMBEDDING_VERSION_EXTRACTED, limit)
+    job.set_total(len(ideas))
+    counts = {"upgraded": 0, "unchanged": 0, "deferred": 0, "too_short": 0}
+
+    items, expected = [], {}
+    for idea in ideas:
+        combined_text = ' '.join(filter(None, [idea['description'], idea['expected_benefit']]))
+        if len(combined_text) < 10:
+            counts["too_short"] += 1
+            job.report(failed=1)
+            job.emit([{"id": idea['id'], "status": "too_short"}])
+            continue
+        items.append((idea['id'], combined_text))
+        expected[idea['id']] = (combined_text, idea['embedding_text_hash'])
+
+    async def flush(batch: List[tuple]):
+        upgraded = set(await asyncio.to_thread(_encode_and_upgrade_ideas, batch))
+        records = [
+            {"id": idea_id, "status": "upgraded" if idea_id in upgraded else "unchanged"}
+            for idea_id, *_ in batch
+        ]
+        counts["upgraded"] += len(upgraded)
+        counts["unchanged"] += len(batch) - len(upgraded)
+        job.report(done=len(batch))
+        job.emit(records)
+
+    # Khong fallback: extract that bai -> giu embedding hien tai, lan chay sau lam lai
+    batch = []
+    stream = extract_stream(items, fallback=False)
+    try:
+        async for idea_id, extracted_text in stream:
+            if extracted_text is None:
+                counts["deferred"] += 1
+                job.report(failed=1)
+                job.emit([{"id": idea_id, "status": "deferred"}])
+            else:
+                raw_text, expected_hash = expected[idea_id]
+                batch.append((idea_id, raw_text, extracted_text, expected_hash))
+            if len(batch) >= STREAM_BATCH_SIZE:
+                await flush(batch)
+                batch = []
+            if job.cancelled:
+                break
+        if batch:
+            await flush(batch)
+    finally:
+        await stream.aclose()
+        await close_client()
+
+    if counts["upgraded"]:
+        local_index.request_sync()
+        query_cache.bump('ideas')
+    return {"success": True, "total": len(ideas), "version": EMBEDDING_VERSION_EXTRACTED, **counts}
+
+
+@app.post("/ideas/upgrade-embeddings", status_code=202, tags=["Ideas"])
+async def upgrade_ideas_embeddings(limit: int = Query(500, ge=1, le=5000)):
+    """
+    Nang cap embedding text goc (raw) / prompt cu len embedding text da extract - chay nen,
+    tra ve job_id ngay. Idempotent: chay lai chi xu ly cac row chua o version hien tai.
+    """
+    return await _enqueue('ideas-upgrade', _upgrade_ideas_embeddings, key='upgrade:ideas', limit=limit)
 
 
 @app.get("/ideas/embedding-stats", tags=["Ideas"])
@@ -938,6 +1441,7 @@ async def get_ideas_embedding_stats():
                 FROM ideas
             """)
             stats = cur.fetchone()
+        versions = db.count_idea_embedding_versions()
         
         return {
             "success": True,
@@ -951,11 +1455,14 @@ async def get_ideas_embedding_stats():
                     "pink_box": stats['pink_box'],
                     "ideas": stats['ideas'],
                     "opinions": stats['opinions']
-                }
+                },
+                # raw / extracted:<prompt> / unknown (ghi boi backfill cu)
+                "by_embedding_version": versions,
+                "pending_upgrade": sum(c for v, c in versions.items() if v != EMBEDDING_VERSION_EXTRACTED)
             }
         }
     except Exception as e:
-        print(f"[ERROR] Get ideas embedding stats failed: {e}")
+        log.error("ideas_embedding_stats_failed", error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -971,6 +1478,58 @@ class IndexIdeaResponse(BaseModel):
     idea_id: str
     message: str
     embedding_created: bool
+    # raw: embedding text gốc (upgrade_pending -> đang nâng cấp nền), extracted:<prompt>: text đã extract
+    embedding_version: Optional[str] = None
+    upgrade_pending: bool = False
+
+
+def _task_result(task: asyncio.Task):
+    """Ket qua task neu da xong va khong loi, nguoc lai None"""
+    if not task.done() or task.cancelled() or task.exception() is not None:
+        return None
+    return task.result()
+
+
+def _encode_and_upgrade_ideas(batch: List[tuple]) -> List[str]:
+    """
+    Pha 2: batch [(idea_id, raw_text, extracted_text, expected_hash)] -> encode cac text da doi
+    (text khong doi chi cap nhat version), 1 UPDATE co dieu kien. Tra ve id da nang cap.
+    """
+    changed = [item for item in batch if item[2] != item[1]]
+    embeddings = embedding_service.encode([item[2] for item in changed]) if changed else []
+    by_id = {item[0]: emb for item, emb in zip(changed, embeddings)}
+    return db.upgrade_idea_embeddings([
+        {
+            'id': idea_id,
+            'embedding': by_id.get(idea_id),
+            'version': EMBEDDING_VERSION_EXTRACTED,
+            'text_hash': embedding_text_hash(raw_text),
+            'expected_hash': expected_hash,
+        }
+        for idea_id, raw_text, _, expected_hash in batch
+    ])
+
+
+async def _upgrade_idea_embedding(idea_id: str, raw_text: str, text_hash: str, extract_task: asyncio.Task):
+    """
+    Pha 2 cua /ideas/index: doi extract xong -> nang cap embedding text goc len text da extract.
+    Row da bi index lai voi text khac hoac da nang cap -> no-op. Extract that bai -> giu 'raw',
+    /ideas/upgrade-embeddings lam lai sau.
+    """
+    try:
+        extracted = await extract_task
+        if extracted is None:
+            log.warning("idea_embedding_upgrade_deferred", idea_id=idea_id)
+            return
+        upgraded = await run_in_threadpool(
+            _encode_and_upgrade_ideas, [(idea_id, raw_text, extracted, text_hash)]
+        )
+        if upgraded:
+            local_index.request_sync()
+            query_cache.bump('ideas')
+        log.info("idea_embedding_upgraded", idea_id=idea_id, upgraded=bool(upgraded))
+    except Exception as e:
+        log.error("idea_embedding_upgrade_failed", idea_id=idea_id, error=str(e))
 
 
 @app.post("/ideas/index", response_model=IndexIdeaResponse, tags=["Ideas"])
@@ -1011,103 +1570,158 @@ async def index_single_idea(request: IndexIdeaRequest):
                 embedding_created=False
             )
         
-        # Dùng LLM để trích xuất vấn đề chính (loại bỏ "mong xem xét"...)
-        extracted_text = await extract_core_issue(combined_text)
-        
-        # Generate embedding từ text đã được làm sạch
-        embedding = embedding_service.encode(extracted_text)
-        
-        # Save to database
-        with db.cursor() as cur:
-            cur.execute("""
-                UPDATE ideas 
-                SET embedding = %s::vector
-                WHERE id = %s
-            """, (embedding.tolist(), idea_id))
+        # Dùng LLM để trích xuất vấn đề chính (loại bỏ "mong xem xét"...).
+        # Xong ngay (fast path cục bộ, cache) -> ghi embedding đã extract luôn; không thì
+        # pha 1 ghi embedding text gốc để idea tìm được ngay, pha 2 nâng cấp nền khi LLM trả lời
+        text_hash = embedding_text_hash(combined_text)
+        extract_task = asyncio.ensure_future(try_extract_core_issue(combined_text))
+        await asyncio.wait({extract_task}, timeout=Config.IDEA_INDEX_HEDGE_MS / 1000)
+        extracted_text = _task_result(extract_task)
+
+        if extracted_text is not None:
+            version, embed_text = EMBEDDING_VERSION_EXTRACTED, extracted_text
+        else:
+            version, embed_text = EMBEDDING_VERSION_RAW, combined_text
+        embedding = await run_in_threadpool(embedding_service.encode, embed_text)
+        await run_in_threadpool(db.save_idea_embedding, idea_id, embedding, version, text_hash)
         
-        print(f"[RAG] Indexed idea {idea_id} ({idea['title'][:50]}...) - status: {idea['status']}")
+        local_index.request_sync()
+        query_cache.bump('ideas')
+
+        upgrade_pending = not extract_task.done()
+        if upgrade_pending:
+            _keep_background(asyncio.ensure_future(
+                _upgrade_idea_embedding(idea_id, combined_text, text_hash, extract_task)
+            ))
+        log.info("idea_indexed", idea_id=idea_id, status=idea['status'], embedding_version=version)
         
         return IndexIdeaResponse(
             success=True,
             idea_id=idea_id,
             message=f"Đã index idea '{idea['title'][:50]}' thành công",
-            embedding_created=True
+            embedding_created=True,
+            embedding_version=version,
+            upgrade_pending=upgrade_pending
         )
         
     except HTTPException:
         raise
     except Exception as e:
-        print(f"[ERROR] Index single idea failed: {e}")
+        log.error("index_idea_failed", idea_id=idea_id, error=str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/ideas/index-batch", tags=["Ideas"])
-async def index_ideas_batch(idea_ids: List[str]):
+def _index_ideas_records(idea_ids: List[str]):
     """
-    Index nhiều ideas cùng lúc.
+    Index ideas theo batch: 1 query doc, 1 lan encode, 1 lan ghi moi STREAM_BATCH_SIZE ideas.
+    Yield ket qua tung idea (theo thu tu input) ngay sau moi batch, dong cuoi la summary.
     """
-    results = {
-        "success": True,
-        "total": len(idea_ids),
-        "processed": 0,
-        "failed": 0,
-        "details": []
-    }
-    
-    for idea_id in idea_ids:
+    processed = 0
+    failed = 0
+
+    for start in range(0, len(idea_ids), STREAM_BATCH_SIZE):
+        chunk = idea_ids[start:start + STREAM_BATCH_SIZE]
+        keys = {}
+        for idea_id in chunk:
+            try:
+                keys[idea_id] = str(uuid.UUID(str(idea_id)))
+            except ValueError:
+                keys[idea_id] = None
+
         try:
-            # Get idea from database
             with db.cursor() as cur:
                 cur.execute("""
-                    SELECT id, title, description, expected_benefit
+                    SELECT id::text as id, title, description, expected_benefit
                     FROM ideas 
-                    WHERE id = %s
-                """, (idea_id,))
-                idea = cur.fetchone()
-            
-            if not idea:
-                results["failed"] += 1
-                results["details"].append({"id": idea_id, "status": "not_found"})
-                continue
-            
+                    WHERE id = ANY(%s::uuid[])
+                """, ([k for k in keys.values() if k],))
+                ideas = {row['id']: row for row in cur.fetchall()}
+
             # Combine text fields
-            text_parts = []
-            if idea['title']:
-                text_parts.append(idea['title'])
-            if idea['description']:
-                text_parts.append(idea['description'])
-            if idea['expected_benefit']:
-                text_parts.append(idea['expected_benefit'])
-            
-            combined_text = ' '.join(text_parts)
-            
-            if len(combined_text) < 10:
-                results["failed"] += 1
-                results["details"].append({"id": idea_id, "status": "too_short"})
-                continue
-            
-            # Generate and save embedding
-            embedding = embedding_service.encode(combined_text)
-            with db.cursor() as cur:
-                cur.execute("""
-                    UPDATE ideas 
-                    SET embedding = %s::vector
-                    WHERE id = %s
-                """, (embedding.tolist(), idea_id))
-            
-            results["processed"] += 1
-            results["details"].append({"id": idea_id, "status": "indexed"})
-            
+            texts = {}
+            for key, idea in ideas.items():
+                combined_text = ' '.join(filter(None, [idea['title'], idea['description'], idea['expected_benefit']]))
+                if len(combined_text) >= 10:
+                    texts[key] = combined_text
+
+            # Generate and save embeddings (1 lan encode cho ca batch)
+            errors = {}
+            if texts:
+                embeddings = embedding_service.encode(list(texts.values()))
+                # Text goc (chua extract) -> version 'raw', hash moi: upgrade dang cho cua /ideas/index
+                # (hash cu) khong ghi de, /ideas/upgrade-embeddings se nang cap lai
+                data = [
+                    {'id': key, 'embedding': emb, 'version': EMBEDDING_VERSION_RAW, 'text_hash': embedding_text_hash(text)}
+                    for (key, text), emb in zip(texts.items(), embeddings)
+                ]
+                if db.save_embeddings_batch(data, table='ideas') != len(data):
+                    errors = {str(fid): reason for fid, reason in db.save_embeddings_rowwise(data, table='ideas')}
         except Exception as e:
-            results["failed"] += 1
-            results["details"].append({"id": idea_id, "status": "error", "error": str(e)})
-    
-    return results
+            for idea_id in chunk:
+                failed += 1
+                yield {"type": "item", "id": idea_id, "status": "error", "error": str(e)}
+            continue
+
+        for idea_id in chunk:
+            key = keys[idea_id]
+            if key is None or key not in ideas:
+                record = {"id": idea_id, "status": "not_found"}
+            elif key not in texts:
+                record = {"id": idea_id, "status": "too_short"}
+            elif key in errors:
+                record = {"id": idea_id, "status": "error", "error": errors[key]}
+            else:
+                record = {"id": idea_id, "status": "indexed"}
+
+            if record["status"] == "indexed":
+                processed += 1
+            else:
+                failed += 1
+            yield {"type": "item", **record}
+
+    if processed:
+        local_index.request_sync()
+        query_cache.bump('ideas')
+    yield {"type": "summary", "success": True, "total": len(idea_ids), "processed": processed, "failed": failed}
+
+
+@app.post("/ideas/index-batch", tags=["Ideas"])
+async def index_ideas_batch(
+    idea_ids: List[str],
+    stream: bool = Query(False, description="Tra ve NDJSON: 1 dong/idea khi xong moi batch, dong cuoi la summary")
+):
+    """
+    Index nhiều ideas cùng lúc.
+    """
+    if stream:
+        return _ndjson_response(_index_ideas_records(idea_ids))
+
+    def collect() -> dict:
+        results = {"success": True, "total": len(idea_ids), "processed": 0, "failed": 0, "details": []}
+        for record in _index_ideas_records(idea_ids):
+            kind = record.pop("type")
+            if kind == "summary":
+                results.update(processed=record["processed"], failed=record["failed"])
+            else:
+                results["details"].append(record)
+        return results
+
+    return await run_in_threadpool(collect)
 
 
 # === Startup/Shutdown ===
 @app.on_event("startup")
 async def startup_event():
+    if prefork.WORKER_ID is not None:
+        # Worker cua prefork server: schema + banner da chay o master
+        mem = prefork.memory_footprint()
+        print(f"[OK] Worker {prefork.WORKER_ID} ready (pid={os.getpid()}, "
+              f"rss={mem['rss_mb']}MB, pss={mem['pss_mb']}MB, shared={mem['shared_mb']}MB)")
+        local_index.start()
+        department_prototypes.start()
+        await start_client()
+        return
+
     print("\n" + "=" * 50)
     print("RAG Incident Router API v2.0")
     print("=" * 50)
@@ -1119,11 +1733,17 @@ async def startup_event():
     print(f"Embeddings: {stats['with_embedding']}/{stats['total']}")
     print(f"Docs: http://localhost:{Config.API_PORT}/docs")
     print("=" * 50 + "\n")
+    local_index.start()
+    department_prototypes.start()
+    await start_client()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     print("\nShutting down...")
+    job_runner.shutdown()
+    local_index.stop()
+    await shutdown_clients()
 
 
 if __name__ == "__main__":
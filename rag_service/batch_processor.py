@@ -1,72 +1,219 @@
 """
 Batch Processor
-Tao embeddings cho nhieu incidents cung luc
+Tao embeddings cho nhieu incidents/ideas cung luc
+
+Backfill chay nhu 1 job persistent:
+- Duyet bang theo id (keyset cursor) -> row loi khong bi lay lai, vong lap luon ket thuc
+- Row loi duoc ghi vao rag_backfill_failures kem ly do
+- Checkpoint sau moi batch -> restart tiep tuc tu cursor da luu
 """
 import time
-from typing import Optional
+from typing import Callable, Dict, List, Optional
 from tqdm import tqdm
 
+from config import Config
 from database import db
 from embedding_service import embedding_service
+from llm_extractor import (
+    extract_batch_sync, embedding_text_hash, EMBEDDING_VERSION_RAW, EMBEDDING_VERSION_EXTRACTED
+)
+
+
+class BackfillInProgress(Exception):
+    """Job dang duoc process/worker khac chay (heartbeat con moi)"""
+
+    def __init__(self, job: Dict):
+        super().__init__(f"Backfill job {job['id']} ({job['target']}) is already running")
+        self.job = job
 
 
 class BatchProcessor:
     """Xu ly batch tao embeddings"""
 
-    def process_all(self, batch_size: int = 50, max_records: Optional[int] = None) -> dict:
-        """Tao embeddings cho tat ca incidents chua co"""
-        stats = db.count_embeddings()
-        to_process = stats['without_embedding']
+    def process_all(
+        self,
+        batch_size: int = 50,
+        max_records: Optional[int] = None,
+        resume: bool = True,
+        only_missing: bool = True,
+        target: str = 'incidents',
+        job_id: Optional[str] = None,
+        extract: bool = False,
+        max_rate: Optional[float] = None,
+        on_progress: Optional[Callable[[int, int], None]] = None,
+        on_items: Optional[Callable[[List[Dict]], None]] = None,
+        on_start: Optional[Callable[[dict], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+        show_progress: bool = True
+    ) -> dict:
+        """
+        Tao embeddings cho tat ca records chua co (only_missing=False: re-embed toan bo).
+        resume=True: tiep tuc job dang do neu co, nguoc lai tao job moi.
+        job_id: chay tiep 1 job cu the (vd 1 shard cua backfill song song).
+        max_records: dung sau khi xu ly du so luong, job o trang thai 'paused' de chay tiep lan sau.
+        extract: dung LLM trich xuat van de chinh truoc khi encode (chi ap dung cho ideas).
+        max_rate: gioi han records/giay (throttle de nhuong CPU cho routing).
+        on_progress(saved, failed): goi sau moi batch voi so luong cua batch do.
+        on_items(records): goi sau moi batch voi ket qua tung row ({'id', 'status', 'error'}).
+        on_start(job): goi 1 lan voi backfill job (da tao hoac resume).
+        should_stop(): tra ve True de dung sau batch hien tai (job o trang thai 'cancelled').
+        """
+        # Nhan job nguyen tu trong Postgres: 2 process khong chay cung 1 khoang id
+        if job_id:
+            job = db.claim_backfill_job_by_id(job_id, Config.BACKFILL_STALE_SECONDS)
+            if job is None:
+                existing = db.get_backfill_job(job_id)
+                if existing is None:
+                    raise ValueError(f"Backfill job {job_id} not found")
+                if existing['status'] == 'completed':
+                    return {'success': True, 'job_id': job_id, 'status': 'completed', 'processed': 0,
+                            'message': f'Backfill job {job_id} da xong'}
+                raise BackfillInProgress(existing)
+            target, only_missing = job['target'], job['only_missing']
+            state = 'resumed' if job['cursor_id'] else 'created'
+        else:
+            state, job = db.claim_backfill_job(
+                target, batch_size, only_missing, resume, Config.BACKFILL_STALE_SECONDS
+            )
+            if state == 'busy':
+                raise BackfillInProgress(job)
+            if state == 'empty':
+                return {
+                    'success': True,
+                    'processed': 0,
+                    'message': f'Tat ca {target} da co embedding'
+                }
 
-        if max_records:
-            to_process = min(to_process, max_records)
+        if state == 'created':
+            print(f"Backfill job {job['id']}: {job['total']} {target} (batch_size={batch_size})")
+        else:
+            print(f"Resuming backfill job {job['id']} from cursor {job['cursor_id']} "
+                  f"({job['processed']}/{job['total']} done)")
 
-        if to_process == 0:
-            return {
-                'success': True,
-                'processed': 0,
-                'message': 'Tat ca incidents da co embedding'
-            }
+        job_id = str(job['id'])
+        cursor_id = str(job['cursor_id']) if job['cursor_id'] else None
+        range_start = str(job['range_start']) if job.get('range_start') else None
+        range_end = str(job['range_end']) if job.get('range_end') else None
+        processed = job['processed'] or 0
+        failed = job['failed'] or 0
+        run_count = 0
+        status = 'completed'
 
-        print(f"Processing {to_process} incidents (batch_size={batch_size})...")
+        if on_start:
+            on_start(job)
 
         start = time.time()
-        processed = 0
-        failed = 0
+        progress = tqdm(total=job['total'], initial=processed + failed, desc="Processing",
+                        disable=not show_progress)
 
-        # Tinh so batches
-        num_batches = (to_process + batch_size - 1) // batch_size
+        try:
+            while True:
+                if max_records and run_count >= max_records:
+                    status = 'paused'
+                    break
+                if should_stop and should_stop():
+                    status = 'cancelled'
+                    break
 
-        for _ in tqdm(range(num_batches), desc="Processing"):
-            # Lay batch incidents
-            incidents = db.get_incidents_without_embedding(limit=batch_size)
-            if not incidents:
-                break
+                limit = min(batch_size, max_records - run_count) if max_records else batch_size
+                records = db.get_records_after(
+                    target, cursor_id, limit=limit, only_missing=only_missing,
+                    range_start=range_start, range_end=range_end
+                )
+                if not records:
+                    break
 
-            # Tao embeddings
-            texts = [inc['description'] for inc in incidents]
-            embeddings = embedding_service.encode(texts)
+                saved, failures = self._process_batch(target, records, extract)
+
+                cursor_id = records[-1]['id']
+                processed += saved
+                failed += len(failures)
+                run_count += len(records)
+                db.checkpoint_backfill_job(job_id, cursor_id, processed, failed, failures)
+                progress.update(len(records))
+                if on_progress:
+                    on_progress(saved, len(failures))
+                if on_items:
+                    on_items(self._item_results(records, failures))
 
-            # Luu vao database
-            data = [
-                {'id': inc['id'], 'embedding': emb}
-                for inc, emb in zip(incidents, embeddings)
-            ]
-            saved = db.save_embeddings_batch(data)
+                if max_rate:
+                    # Ngu cho den khi toc do trung binh <= max_rate
+                    delay = run_count / max_rate - (time.time() - start)
+                    if delay > 0:
+                        time.sleep(delay)
 
-            processed += saved
-            failed += len(incidents) - saved
+        except BaseException as e:
+            # Ke ca Ctrl+C: danh dau de lan sau resume tu checkpoint cuoi
+            db.finish_backfill_job(job_id, 'interrupted', error=str(e) or type(e).__name__)
+            raise
+        finally:
+            progress.close()
 
+        db.finish_backfill_job(job_id, status)
         elapsed = time.time() - start
 
         return {
             'success': True,
+            'job_id': job_id,
+            'status': status,
             'processed': processed,
             'failed': failed,
             'time_seconds': elapsed,
-            'speed': processed / elapsed if elapsed > 0 else 0
+            'speed': run_count / elapsed if elapsed > 0 else 0
         }
 
+    def _process_batch(self, target: str, records: list, extract: bool = False) -> tuple:
+        """Encode + luu 1 batch. Tra ve (so row da luu, [(id, ly do loi)])"""
+        texts = [r['text'] for r in records]
+        versions = [EMBEDDING_VERSION_RAW] * len(records)
+        try:
+            if extract and target == 'ideas':
+                # Dong bo voi /ideas/index: embedding ideas tao tu text da lam sach
+                # (song song + rate limit + retry tren loop nen cua llm_extractor).
+                # Extract loi -> encode text goc, version 'raw' de /ideas/upgrade-embeddings lam lai
+                extracted = extract_batch_sync(texts, fallback=False)
+                versions = [EMBEDDING_VERSION_RAW if e is None else EMBEDDING_VERSION_EXTRACTED for e in extracted]
+                texts = [t if e is None else e for t, e in zip(texts, extracted)]
+            embeddings = embedding_service.encode(texts)
+        except Exception as e:
+            return 0, [(r['id'], f"encode failed: {e}") for r in records]
+
+        data = [
+            {'id': r['id'], 'embedding': emb}
+            for r, emb in zip(records, embeddings)
+        ]
+        if target == 'ideas':
+            for d, r, version in zip(data, records, versions):
+                d['version'] = version
+                d['text_hash'] = embedding_text_hash(r['text'])
+        saved = db.save_embeddings_batch(data, table=target)
+        if saved == len(data):
+            return saved, []
+
+        # Batch loi -> luu tung row de tach row hong ra
+        failures = db.save_embeddings_rowwise(data, table=target)
+        return len(data) - len(failures), failures
+
+    def _item_results(self, records: list, failures: list) -> List[Dict]:
+        """Ket qua tung row cua 1 batch theo thu tu records"""
+        reasons = {str(fid): reason for fid, reason in failures}
+        results = []
+        for r in records:
+            rid = str(r['id'])
+            if rid in reasons:
+                results.append({'id': rid, 'status': 'error', 'error': reasons[rid]})
+            else:
+                results.append({'id': rid, 'status': 'indexed'})
+        return results
+
+    def get_job_status(self, job_id: str) -> Optional[dict]:
+        """Trang thai job + vai row loi gan nhat"""
+        job = db.get_backfill_job(job_id)
+        if job is None:
+            return None
+        job['failures'] = db.get_backfill_failures(job_id, limit=20)
+        return job
+
     def process_single(self, incident_id: str, description: str) -> bool:
         """Tao embedding cho 1 incident"""
         embedding = embedding_service.encode(description)
@@ -81,7 +228,7 @@ if __name__ == "__main__":
     print("\n" + "="*50)
     print("BATCH PROCESSOR - TAO EMBEDDINGS")
     print("="*50 + "\n")
-    
+
     # Hien thi thong ke hien tai
     stats = db.count_embeddings()
     print(f"Thong ke hien tai:")
@@ -89,16 +236,17 @@ if __name__ == "__main__":
     print(f"  - Da co embedding: {stats['with_embedding']}")
     print(f"  - Chua co embedding: {stats['without_embedding']}")
     print(f"  - Tien do: {stats['percentage']:.1f}%\n")
-    
+
     if stats['without_embedding'] > 0:
         print("Bat dau xu ly...\n")
         result = processor.process_all(batch_size=50)
         print(f"\nKet qua:")
+        print(f"  - Job: {result.get('job_id', '-')} ({result.get('status', 'completed')})")
         print(f"  - Da xu ly: {result['processed']} incidents")
         print(f"  - That bai: {result.get('failed', 0)}")
         print(f"  - Thoi gian: {result.get('time_seconds', 0):.2f}s")
         print(f"  - Toc do: {result.get('speed', 0):.1f} records/s")
-        
+
         # Hien thi thong ke sau khi xu ly
         stats_after = db.count_embeddings()
         print(f"\nThong ke sau xu ly:")
@@ -19,21 +19,97 @@ class Config:
     DB_NAME = os.getenv("DB_NAME")
     DB_USER = os.getenv("DB_USER")
     DB_PASSWORD = os.getenv("DB_PASSWORD")
+    # Pool connection moi worker: tong connection = DB_POOL_SIZE x so worker (< max_connections)
+    DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+    DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))  # giay cho connection ranh
 
     # Model
     MODEL_NAME = os.getenv("MODEL_NAME", "phobert-v6-denso")
     MODEL_DIR = os.getenv("MODEL_DIR", "phobert_v6_denso_onnx_compressed")
     VECTOR_DIM = int(os.getenv("VECTOR_DIM", "768"))
+    # So thread inference moi process (0 = mac dinh cua ONNX Runtime/torch)
+    INFERENCE_THREADS = int(os.getenv("INFERENCE_THREADS", "0"))
 
     # Search
     DEFAULT_LIMIT = int(os.getenv("DEFAULT_LIMIT", "5"))
     MIN_SIMILARITY = float(os.getenv("MIN_SIMILARITY", "0.1"))
+    # Cache response /similar-ideas, /similar (invalidate theo generation cua index)
+    QUERY_CACHE_ENABLED = os.getenv("QUERY_CACHE_ENABLED", "true").lower() == "true"
+    QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "1000"))
+    QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+    QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "300"))
+    # Chu ky doc lai generation dung chung (Postgres) = do tre de bump o worker khac co hieu luc
+    QUERY_CACHE_GENERATION_POLL = float(os.getenv("QUERY_CACHE_GENERATION_POLL", "1"))
+    # So incident toi da moi request /suggest/batch
+    SUGGEST_BATCH_MAX_ITEMS = int(os.getenv("SUGGEST_BATCH_MAX_ITEMS", "500"))
+
+    # Deadline cho /suggest (header X-Deadline-Ms ghi de, toi da REQUEST_DEADLINE_MAX_MS)
+    REQUEST_DEADLINE_MS = float(os.getenv("REQUEST_DEADLINE_MS", "2000"))
+    REQUEST_DEADLINE_MAX_MS = float(os.getenv("REQUEST_DEADLINE_MAX_MS", "10000"))
+
+    # Admission control cho endpoint encode/rerank (moi nhom: routing, ideas)
+    ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+    ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "4"))
+    ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+    ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "1.5"))
+    # So request dang doi >= nguong nay -> bo qua rerank
+    ADMISSION_DEGRADE_DEPTH = int(os.getenv("ADMISSION_DEGRADE_DEPTH", "16"))
+    ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "2"))
+
+    # /check-duplicate: LLM extract chay song song voi search tren text goc
+    # Xong trong HEDGE_MS (fast path cuc bo, cache) -> chi search 1 lan tren text da lam sach
+    CHECK_DUPLICATE_HEDGE_MS = float(os.getenv("CHECK_DUPLICATE_HEDGE_MS", "25"))
+    # Xong trong BUDGET_MS -> search lai tren text da lam sach, khong thi tra ket qua text goc
+    CHECK_DUPLICATE_EXTRACT_BUDGET_MS = float(os.getenv("CHECK_DUPLICATE_EXTRACT_BUDGET_MS", "400"))
+    # /ideas/index: extract xong trong HEDGE_MS -> ghi embedding da extract ngay (1 pha),
+    # khong thi ghi embedding text goc roi nang cap nen
+    IDEA_INDEX_HEDGE_MS = float(os.getenv("IDEA_INDEX_HEDGE_MS", "25"))
 
     # Auto-assign
     AUTO_ASSIGN_ENABLED = os.getenv("AUTO_ASSIGN_ENABLED", "true").lower() == "true"
     AUTO_ASSIGN_THRESHOLD = float(os.getenv("AUTO_ASSIGN_THRESHOLD", "0.75"))
     AUTO_ASSIGN_MIN_SAMPLES = int(os.getenv("AUTO_ASSIGN_MIN_SAMPLES", "20"))
 
+    # Local vector index (memory-mapped, optional) - Postgres van la source of truth
+    LOCAL_INDEX_ENABLED = os.getenv("LOCAL_INDEX_ENABLED", "false").lower() == "true"
+    LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "local_index")
+    LOCAL_INDEX_SYNC_INTERVAL = float(os.getenv("LOCAL_INDEX_SYNC_INTERVAL", "30"))
+    LOCAL_INDEX_REBUILD_INTERVAL = float(os.getenv("LOCAL_INDEX_REBUILD_INTERVAL", "3600"))
+    # Moi lan sync quet lai tu (watermark - OVERLAP): >= transaction ghi dai nhat
+    LOCAL_INDEX_SYNC_OVERLAP = float(os.getenv("LOCAL_INDEX_SYNC_OVERLAP", "300"))
+
+    # Prototype routing: centroid embedding/department lam fast path truoc kNN + voting
+    PROTOTYPE_ROUTING_ENABLED = os.getenv("PROTOTYPE_ROUTING_ENABLED", "false").lower() == "true"
+    PROTOTYPE_CENTROIDS = int(os.getenv("PROTOTYPE_CENTROIDS", "1"))  # > 1: k-means/department
+    # Fast path chi khi similarity >= MIN_SIMILARITY va hon department thu 2 >= MIN_MARGIN
+    PROTOTYPE_MIN_SIMILARITY = float(os.getenv("PROTOTYPE_MIN_SIMILARITY", "0.6"))
+    PROTOTYPE_MIN_MARGIN = float(os.getenv("PROTOTYPE_MIN_MARGIN", "0.08"))
+    PROTOTYPE_MIN_SAMPLES = int(os.getenv("PROTOTYPE_MIN_SAMPLES", "10"))
+    PROTOTYPE_REBUILD_INTERVAL = float(os.getenv("PROTOTYPE_REBUILD_INTERVAL", "600"))
+
+    # Background jobs (process-batch, generate ideas embeddings)
+    JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+    # Trang thai job trong Postgres: ghi tien do moi HEARTBEAT_INTERVAL giay,
+    # job khong co heartbeat qua STALE_SECONDS (worker chet) -> 'interrupted', key duoc giai phong
+    JOB_HEARTBEAT_INTERVAL = float(os.getenv("JOB_HEARTBEAT_INTERVAL", "2"))
+    JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "30"))
+    # Backfill job 'running' chi duoc process khac resume khi checkpoint cuoi cu hon muc nay
+    BACKFILL_STALE_SECONDS = float(os.getenv("BACKFILL_STALE_SECONDS", "300"))
+
+    # Logging (JSON, ghi qua queue/thread rieng)
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()  # json | text
+    # Ti le request duoc ghi log INFO (WARNING/ERROR luon ghi)
+    LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
+    # Header bat debug dump (bang diem department...) cho 1 request
+    LOG_DEBUG_HEADER = os.getenv("LOG_DEBUG_HEADER", "X-Debug-Scores")
+
+    # Production server (python main.py --prod): prefork nhieu worker
+    RUN_MODE = os.getenv("RUN_MODE", "dev").lower()  # dev (reload) | prod
+    WORKERS = int(os.getenv("WORKERS", "0"))  # 0 = 1/2 so core
+    GRACEFUL_TIMEOUT = float(os.getenv("GRACEFUL_TIMEOUT", "30"))
+
     # API
     API_HOST = os.getenv("API_HOST", "0.0.0.0")
     API_PORT = int(os.getenv("API_PORT", "8001"))
@@ -51,6 +127,10 @@ class Config:
     def get_tokenizer_path(cls) -> Path:
         return cls.get_model_dir()
 
+    @classmethod
+    def get_local_index_dir(cls) -> Path:
+        return Path(__file__).parent / cls.LOCAL_INDEX_DIR
+
     @classmethod
     def get_db_url(cls) -> str:
         return f"postgresql://{cls.DB_USER}:{cls.DB_PASSWORD}@{cls.DB_HOST}:{cls.DB_PORT}/{cls.DB_NAME}"
@@ -2,6 +2,8 @@
 Database Service
 Ket noi PostgreSQL voi pgvector extension
 """
+import json
+import threading
 import numpy as np
 from typing import List, Dict, Optional
 from contextlib import contextmanager
@@ -9,6 +11,7 @@ from contextlib import contextmanager
 try:
     import psycopg2
     from psycopg2.extras import RealDictCursor, execute_values
+    from psycopg2.pool import ThreadedConnectionPool, PoolError
     HAS_PSYCOPG2 = True
 except ImportError:
     HAS_PSYCOPG2 = False
@@ -20,63 +23,230 @@ except ImportError:
     HAS_PGVECTOR = False
 
 from config import Config
+from metrics import metrics
+from logger import get_logger
+from deadline import Deadline, DeadlineExceeded
+
+log = get_logger('database')
+
+
+# Cac cot metadata duoc phep push xuong vector query: ten cot -> kieu Postgres (None = text)
+INCIDENT_FILTER_COLUMNS = {
+    'incident_type': 'incident_type',
+    'priority': 'incident_priority',
+    'status': 'incident_status',
+    'location': None,
+    'assigned_department_id': 'uuid',
+}
+
+IDEA_FILTER_COLUMNS = {
+    'ideabox_type': 'ideabox_type',
+    'whitebox_subtype': 'whitebox_subtype',
+    'status': 'idea_status',
+    'category': 'idea_category',
+}
+
+ZERO_UUID = '00000000-0000-0000-0000-000000000000'
+
+# Bang co the backfill embedding: text dung de encode + dieu kien text hop le
+BACKFILL_TARGETS = {
+    'incidents': {
+        'text': "description",
+        'valid': "description IS NOT NULL AND LENGTH(TRIM(description)) > 5",
+    },
+    'ideas': {
+        'text': "CONCAT_WS(' ', description, expected_benefit)",
+        'valid': "LENGTH(TRIM(CONCAT_WS(' ', description, expected_benefit))) >= 10",
+    },
+}
+
+# Cot rag_jobs tra ve cho job_queue (thoi gian dang epoch giong Job.to_dict)
+JOB_COLUMNS = """
+    id::text as id, kind, key, status, params, total, done, failed, result, error,
+    cancel_requested, worker_pid,
+    EXTRACT(EPOCH FROM created_at)::float as created_at,
+    EXTRACT(EPOCH FROM started_at)::float as started_at,
+    EXTRACT(EPOCH FROM finished_at)::float as finished_at,
+    EXTRACT(EPOCH FROM NOW() - heartbeat_at)::float as heartbeat_age
+"""
+
+
+def _json_dumps(value) -> str:
+    """Ket qua job co the chua datetime/UUID (vd backfill job) -> str"""
+    return json.dumps(value, default=str)
+
+
+# Partial HNSW index cho tung hom y tuong (filter cung cua moi idea search)
+IDEABOX_TYPES = ('white', 'pink')
+
+# Cot cua ideas co trong idea card (UPDATE cot khac, vd embedding, khong build lai card)
+IDEA_CARD_COLUMNS = (
+    'title', 'description', 'expected_benefit', 'status', 'category', 'difficulty',
+    'ideabox_type', 'whitebox_subtype', 'workflow_stage', 'handler_level',
+    'support_count', 'remind_count', 'like_count', 'reviewed_at', 'implemented_at',
+    'final_resolution', 'final_resolution_ja', 'submitter_id', 'department_id',
+)
+# Bang con (co cot idea_id) anh huong toi card
+IDEA_CARD_CHILD_TABLES = ('idea_responses', 'idea_history', 'idea_supports')
+
+
+def open_connection():
+    """
+    Mo 1 connection moi da dang ky vector type.
+    Dung cho thread/process can connection rieng (khong chia se transaction voi singleton db).
+    """
+    if not HAS_PSYCOPG2:
+        raise ImportError("psycopg2 not installed")
+
+    conn = psycopg2.connect(
+        host=Config.DB_HOST,
+        port=Config.DB_PORT,
+        database=Config.DB_NAME,
+        user=Config.DB_USER,
+        password=Config.DB_PASSWORD
+    )
+
+    if HAS_PGVECTOR:
+        try:
+            register_vector(conn)
+        except psycopg2.ProgrammingError:
+            conn.rollback()  # Will be fixed in setup_schema()
+    return conn
+
+
+if HAS_PSYCOPG2:
+    class _ConnectionPool(ThreadedConnectionPool):
+        """
+        ThreadedConnectionPool mo connection qua open_connection (co vector type) va
+        cho (toi da timeout giay) khi het connection thay vi raise PoolError ngay
+        """
+
+        def __init__(self, minconn: int, maxconn: int, timeout: float):
+            self._slots = threading.BoundedSemaphore(maxconn)
+            self._timeout = timeout
+            super().__init__(minconn, maxconn)
+            # minconn chi la so connection mo san; psycopg2 close connection tra ve khi da co
+            # >= minconn connection ranh -> giu lai toi maxconn (khong reconnect moi lan muon)
+            self.minconn = maxconn
+
+        def _connect(self, key=None):
+            conn = open_connection()
+            if key is not None:
+                self._used[key] = conn
+                self._rused[id(conn)] = key
+            else:
+                self._pool.append(conn)
+            return conn
+
+        def checkout(self):
+            if not self._slots.acquire(timeout=self._timeout):
+                raise PoolError(f"connection pool exhausted (waited {self._timeout}s)")
+            try:
+                conn = self.getconn()
+                if conn.closed:
+                    self.putconn(conn, close=True)
+                    conn = self.getconn()
+                return conn
+            except BaseException:
+                self._slots.release()
+                raise
+
+        def checkin(self, conn, broken: bool = False):
+            try:
+                self.putconn(conn, close=broken or bool(conn.closed))
+            finally:
+                self._slots.release()
 
 
 class Database:
     """Database connection va vector operations"""
     _instance: Optional['Database'] = None
-    _conn = None
+    _local: Optional[threading.local] = None
+    _pool: Optional['_ConnectionPool'] = None
+    _iterative_scan: Optional[bool] = None
+    _backfill_ready = False
+    _jobs_ready = False
+    _cache_generations_ready = False
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super().__new__(cls)
+            cls._instance._local = threading.local()
             cls._instance._connect()
         return cls._instance
 
     def _connect(self):
-        """Ket noi database va dang ky vector type"""
+        """
+        Tao pool connection cua process (DB_POOL_MIN..DB_POOL_SIZE connection).
+        Moi thread muon connection trong luc dung cursor roi tra lai: so connection
+        toi Postgres bi chan boi DB_POOL_SIZE x so worker, khong theo so thread.
+        """
         if not HAS_PSYCOPG2:
             raise ImportError("psycopg2 not installed")
 
         try:
-            self._conn = psycopg2.connect(
-                host=Config.DB_HOST,
-                port=Config.DB_PORT,
-                database=Config.DB_NAME,
-                user=Config.DB_USER,
-                password=Config.DB_PASSWORD
+            self._pool = _ConnectionPool(
+                min(Config.DB_POOL_MIN, Config.DB_POOL_SIZE), Config.DB_POOL_SIZE, Config.DB_POOL_TIMEOUT
             )
-
-            if HAS_PGVECTOR:
-                try:
-                    register_vector(self._conn)
-                except psycopg2.ProgrammingError:
-                    pass  # Will be fixed in setup_schema()
         except psycopg2.OperationalError as e:
             print(f"[ERROR] Database connection failed: {e}")
             raise
 
+    def reset_after_fork(self):
+        """
+        Worker (process con) khong dung lai connection cua master:
+        bo pool/thread-local cu (khong close - socket thuoc master), tao pool rieng cho worker.
+        """
+        self._local = threading.local()
+        self._connect()
+
+    def close(self):
+        """Dong moi connection cua pool (vd master truoc khi fork worker)"""
+        if self._pool is not None and not self._pool.closed:
+            self._pool.closeall()
+        self._pool = None
+        self._local = threading.local()
+
     def reconnect(self):
-        """Reconnect neu connection bi mat"""
-        if self._conn:
-            try:
-                self._conn.close()
-            except:
-                pass
+        """Tao lai pool neu connection bi mat"""
+        try:
+            self.close()
+        except Exception:
+            pass
         self._connect()
 
     @contextmanager
     def cursor(self):
-        """Context manager cho cursor voi auto-commit/rollback"""
-        cur = self._conn.cursor(cursor_factory=RealDictCursor)
+        """
+        Context manager cho cursor voi auto-commit/rollback.
+        Connection muon tu pool va tra lai khi ra khoi block ngoai cung; cursor() long nhau
+        trong cung thread dung lai connection dang muon (khong tu chan minh khi pool het).
+        """
+        conn = getattr(self._local, 'conn', None)
+        owner = conn is None
+        if owner:
+            if self._pool is None:
+                self._connect()
+            # Thoi gian cho connection ranh cua pool (+ connect khi pool chua du connection)
+            with metrics.timer('db_pool_wait'):
+                conn = self._pool.checkout()
+            self._local.conn = conn
+        broken = False
+        cur = conn.cursor(cursor_factory=RealDictCursor)
         try:
             yield cur
-            self._conn.commit()
+            conn.commit()
         except Exception as e:
-            self._conn.rollback()
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
             raise e
         finally:
             cur.close()
+            if owner:
+                self._local.conn = None
+                self._pool.checkin(conn, broken=broken)
 
     def check_extension(self) -> bool:
         """Kiem tra pgvector extension"""
@@ -113,7 +283,7 @@ class Database:
                 # Re-register vector type for current connection
                 if HAS_PGVECTOR:
                     try:
-                        register_vector(self._conn)
+                        register_vector(cur.connection)
                     except Exception as e:
                         print(f"[WARN] Failed to register vector type: {e}")
 
@@ -156,6 +326,12 @@ class Database:
                     WITH (m = 16, ef_construction = 64)
                 """)
 
+                self._setup_idea_indexes(cur)
+                self._setup_idea_category_stats(cur)
+                self._setup_idea_cards(cur)
+                self._setup_llm_extraction_cache(cur)
+                self._setup_idea_embedding_versions(cur)
+
             print("[OK] Schema setup complete!")
             return True
 
@@ -163,6 +339,389 @@ class Database:
             print(f"[ERROR] Schema setup failed: {e}")
             return False
 
+    def _setup_idea_indexes(self, cur):
+        """
+        HNSW index cho ideas: 1 index tong + partial index theo ideabox_type.
+        Filter ideabox_type luon co trong idea search -> planner dung partial index,
+        top-k khong bi hut khi 1 hom chiem phan nho du lieu.
+        """
+        cur.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = 'ideas'
+                AND column_name = 'embedding'
+            )
+        """)
+        if not cur.fetchone()['exists']:
+            return
+
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_ideas_embedding_hnsw
+            ON ideas USING hnsw (embedding vector_cosine_ops)
+            WITH (m = 16, ef_construction = 64)
+        """)
+        for box in IDEABOX_TYPES:
+            cur.execute(f"""
+                CREATE INDEX IF NOT EXISTS idx_ideas_embedding_hnsw_{box}
+                ON ideas USING hnsw (embedding vector_cosine_ops)
+                WITH (m = 16, ef_construction = 64)
+                WHERE ideabox_type = '{box}'
+            """)
+
+    def _setup_idea_embedding_versions(self, cur):
+        """
+        Index ideas 2 pha: embedding_version = 'raw' (text goc, ghi ngay) hoac 'extracted:<prompt>'
+        (text da extract, nang cap nen); embedding_text_hash = hash text goc cua embedding hien tai.
+        NULL = ghi boi backfill/batch cu, chua ro version.
+        """
+        cur.execute("""
+            ALTER TABLE ideas
+                ADD COLUMN IF NOT EXISTS embedding_version TEXT,
+                ADD COLUMN IF NOT EXISTS embedding_text_hash TEXT
+        """)
+
+    def _setup_llm_extraction_cache(self, cur):
+        """Cache ket qua LLM extract (key = hash text + prompt version + model), xem llm_extractor"""
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS rag_llm_extractions (
+                cache_key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                extracted TEXT NOT NULL,
+                latency_ms REAL NOT NULL DEFAULT 0,
+                hits INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                last_hit_at TIMESTAMPTZ
+            )
+        """)
+
+    def get_llm_extraction(self, cache_key: str, touch: bool = True) -> Optional[Dict]:
+        """Doc ket qua extract da cache (touch=True: tang hits). None neu chua co"""
+        with self.cursor() as cur:
+            if not touch:
+                cur.execute("""
+                    SELECT extracted, latency_ms FROM rag_llm_extractions WHERE cache_key = %s
+                """, (cache_key,))
+                return cur.fetchone()
+            cur.execute("""
+                UPDATE rag_llm_extractions
+                SET hits = hits + 1, last_hit_at = NOW()
+                WHERE cache_key = %s
+                RETURNING extracted, latency_ms
+            """, (cache_key,))
+            return cur.fetchone()
+
+    def save_llm_extraction(self, cache_key: str, model: str, prompt_version: str,
+                            extracted: str, latency_ms: float):
+        with self.cursor() as cur:
+            cur.execute("""
+                INSERT INTO rag_llm_extractions (cache_key, model, prompt_version, extracted, latency_ms)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (cache_key) DO UPDATE
+                SET extracted = EXCLUDED.extracted, latency_ms = EXCLUDED.latency_ms, created_at = NOW()
+            """, (cache_key, model, prompt_version, extracted, latency_ms))
+
+    def _setup_idea_category_stats(self, cur):
+        """
+        Bang tong hop so idea 'implemented' theo category cho /similar-ideas.
+        Trigger tren ideas cap nhat tang/giam khi status hoac category thay doi,
+        moi lan setup tinh lai toan bo de sua lech (vd du lieu import truc tiep).
+        """
+        cur.execute("SELECT to_regclass('ideas') IS NOT NULL as exists")
+        if not cur.fetchone()['exists']:
+            return
+
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS rag_idea_category_stats (
+                category TEXT PRIMARY KEY,
+                implemented_count INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        """)
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION rag_sync_idea_category_stats() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.status = 'implemented' AND OLD.category IS NOT NULL THEN
+                    UPDATE rag_idea_category_stats
+                    SET implemented_count = GREATEST(implemented_count - 1, 0), updated_at = NOW()
+                    WHERE category = OLD.category::text;
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.status = 'implemented' AND NEW.category IS NOT NULL THEN
+                    INSERT INTO rag_idea_category_stats (category, implemented_count)
+                    VALUES (NEW.category::text, 1)
+                    ON CONFLICT (category) DO UPDATE
+                    SET implemented_count = rag_idea_category_stats.implemented_count + 1, updated_at = NOW();
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+        cur.execute("DROP TRIGGER IF EXISTS trg_rag_idea_category_stats ON ideas")
+        cur.execute("""
+            CREATE TRIGGER trg_rag_idea_category_stats
+            AFTER INSERT OR DELETE OR UPDATE OF status, category ON ideas
+            FOR EACH ROW EXECUTE FUNCTION rag_sync_idea_category_stats()
+        """)
+        self._refresh_idea_category_stats(cur)
+
+    def _refresh_idea_category_stats(self, cur):
+        """Tinh lai toan bo bang tong hop (1 lan quet ideas)"""
+        cur.execute("""
+            INSERT INTO rag_idea_category_stats (category, implemented_count)
+            SELECT c.category, COALESCE(n.cnt, 0)
+            FROM (SELECT DISTINCT category::text as category FROM ideas WHERE category IS NOT NULL) c
+            LEFT JOIN (
+                SELECT category::text as category, COUNT(*) as cnt
+                FROM ideas
+                WHERE status = 'implemented' AND category IS NOT NULL
+                GROUP BY category
+            ) n ON n.category = c.category
+            ON CONFLICT (category) DO UPDATE
+            SET implemented_count = EXCLUDED.implemented_count, updated_at = NOW()
+        """)
+
+    def refresh_idea_category_stats(self) -> bool:
+        """Refresh thu cong (vd sau khi sua du lieu ma khong qua trigger)"""
+        try:
+            with self.cursor() as cur:
+                self._refresh_idea_category_stats(cur)
+            return True
+        except Exception as e:
+            print(f"[ERROR] Refresh idea category stats failed: {e}")
+            return False
+
+    def _setup_idea_cards(self, cur):
+        """
+        Card store cho search hydration: 1 row JSON dung san moi idea, build luc ghi
+        (trigger tren ideas, idea_responses, idea_history, idea_supports) thay vi luc doc.
+        Doi ten user/department/stage khong co trigger -> refresh_idea_cards() de build lai.
+        """
+        cur.execute("SELECT to_regclass('ideas') IS NOT NULL as exists")
+        if not cur.fetchone()['exists']:
+            return
+
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS rag_idea_cards (
+                idea_id UUID PRIMARY KEY REFERENCES ideas(id) ON DELETE CASCADE,
+                card JSONB NOT NULL,
+                refreshed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        """)
+        # plpgsql: bang phu (idea_supports, idea_workflow_stages) chi duoc kiem tra luc chay
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION rag_build_idea_card(p_id UUID) RETURNS JSONB AS $$
+            BEGIN
+                RETURN (
+                    SELECT jsonb_build_object(
+                        'id', i.id,
+                        'title', i.title,
+                        'description', i.description,
+                        'expected_benefit', i.expected_benefit,
+                        'status', i.status,
+                        'category', i.category,
+                        'difficulty', i.difficulty,
+                        'ideabox_type', i.ideabox_type,
+                        'whitebox_subtype', i.whitebox_subtype,
+                        'workflow_stage', i.workflow_stage,
+                        'handler_level', i.handler_level,
+                        'support_count', i.support_count,
+                        'remind_count', i.remind_count,
+                        'like_count', i.like_count,
+                        'created_at', i.created_at,
+                        'updated_at', i.updated_at,
+                        'reviewed_at', i.reviewed_at,
+                        'implemented_at', i.implemented_at,
+                        'final_resolution', i.final_resolution,
+                        'final_resolution_ja', i.final_resolution_ja,
+                        'submitter_name', u.full_name,
+                        'department_name', d.name,
+                        'department_code', d.code,
+                        'stage_name', ws.stage_name,
+                        'stage_name_ja', ws.stage_name_ja,
+                        'stage_color', ws.color,
+                        'total_supports', (
+                            SELECT COUNT(*) FROM idea_supports s WHERE s.idea_id = i.id
+                        ),
+                        'responses', COALESCE((
+                            SELECT jsonb_agg(jsonb_build_object(
+                                'response', ir.response,
+                                'created_at', ir.created_at,
+                                'responder_name', ru.full_name,
+                                'responder_role', ru.role,
+                                'is_final_resolution', COALESCE(ir.is_final_resolution, false),
+                                'response_type', COALESCE(ir.response_type, 'comment')
+                            ) ORDER BY ir.created_at DESC)
+                            FROM idea_responses ir
+                            LEFT JOIN users ru ON ir.user_id = ru.id
+                            WHERE ir.idea_id = i.id
+                        ), '[]'::jsonb),
+                        'final_resolution_response', (
+                            SELECT ir.response FROM idea_responses ir
+                            WHERE ir.idea_id = i.id AND ir.is_final_resolution = true
+                            ORDER BY ir.created_at DESC
+                            LIMIT 1
+                        ),
+                        'workflow_history', COALESCE((
+                            SELECT jsonb_agg(jsonb_build_object(
+                                'action', ih.action,
+                                'details', ih.details,
+                                'created_at', ih.created_at,
+                                'performed_by_name', tu.full_name
+                            ) ORDER BY ih.created_at DESC)
+                            FROM idea_history ih
+                            LEFT JOIN users tu ON ih.performed_by = tu.id
+                            WHERE ih.idea_id = i.id
+                        ), '[]'::jsonb)
+                    )
+                    FROM ideas i
+                    LEFT JOIN users u ON i.submitter_id = u.id
+                    LEFT JOIN departments d ON i.department_id = d.id
+                    LEFT JOIN idea_workflow_stages ws ON i.workflow_stage = ws.stage_code
+                    WHERE i.id = p_id
+                );
+            END;
+            $$ LANGUAGE plpgsql STABLE
+        """)
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION rag_refresh_idea_card(p_id UUID) RETURNS BOOLEAN AS $$
+            DECLARE
+                v_card JSONB;
+            BEGIN
+                v_card := rag_build_idea_card(p_id);
+                IF v_card IS NULL THEN
+                    DELETE FROM rag_idea_cards WHERE idea_id = p_id;
+                    RETURN false;
+                END IF;
+
+                INSERT INTO rag_idea_cards (idea_id, card, refreshed_at)
+                VALUES (p_id, v_card, NOW())
+                ON CONFLICT (idea_id) DO UPDATE
+                SET card = EXCLUDED.card, refreshed_at = NOW();
+                RETURN true;
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION rag_idea_card_trigger() RETURNS trigger AS $$
+            DECLARE
+                v_id UUID;
+            BEGIN
+                IF TG_TABLE_NAME = 'ideas' THEN
+                    v_id := NEW.id;
+                ELSIF TG_OP = 'DELETE' THEN
+                    v_id := OLD.idea_id;
+                ELSE
+                    v_id := NEW.idea_id;
+                END IF;
+
+                BEGIN
+                    PERFORM rag_refresh_idea_card(v_id);
+                EXCEPTION WHEN OTHERS THEN
+                    -- Cache khong duoc lam hong write cua backend: bo card, lan doc sau build lai
+                    RAISE WARNING 'rag_idea_cards refresh failed for %: %', v_id, SQLERRM;
+                    DELETE FROM rag_idea_cards WHERE idea_id = v_id;
+                END;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+
+        # Xoa idea -> card xoa theo ON DELETE CASCADE, chi can INSERT/UPDATE cac cot trong card
+        cur.execute("DROP TRIGGER IF EXISTS trg_rag_idea_card ON ideas")
+        cur.execute(f"""
+            CREATE TRIGGER trg_rag_idea_card
+            AFTER INSERT OR UPDATE OF {', '.join(IDEA_CARD_COLUMNS)} ON ideas
+            FOR EACH ROW EXECUTE FUNCTION rag_idea_card_trigger()
+        """)
+        for table in IDEA_CARD_CHILD_TABLES:
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL as exists", (table,))
+            if not cur.fetchone()['exists']:
+                print(f"[WARN] Table '{table}' does not exist - idea cards will not track it")
+                continue
+            cur.execute(f"DROP TRIGGER IF EXISTS trg_rag_idea_card ON {table}")
+            cur.execute(f"""
+                CREATE TRIGGER trg_rag_idea_card
+                AFTER INSERT OR UPDATE OR DELETE ON {table}
+                FOR EACH ROW EXECUTE FUNCTION rag_idea_card_trigger()
+            """)
+
+        # Build card cho cac idea chua co (lan dau / idea tao truoc khi co trigger)
+        cur.execute("""
+            SELECT COUNT(*) FILTER (WHERE rag_refresh_idea_card(i.id)) as count
+            FROM ideas i
+            WHERE NOT EXISTS (SELECT 1 FROM rag_idea_cards c WHERE c.idea_id = i.id)
+        """)
+        built = cur.fetchone()['count']
+        if built:
+            print(f"[OK] Built {built} idea cards")
+
+    def refresh_idea_cards(self, idea_ids: Optional[List[str]] = None) -> int:
+        """Build lai card (mac dinh toan bo) - vd sau khi doi ten user/department"""
+        with self.cursor() as cur:
+            if idea_ids is None:
+                cur.execute("SELECT COUNT(*) FILTER (WHERE rag_refresh_idea_card(id)) as count FROM ideas")
+            else:
+                cur.execute(
+                    "SELECT COUNT(*) FILTER (WHERE rag_refresh_idea_card(x)) as count "
+                    "FROM unnest(%s::uuid[]) x",
+                    ([str(i) for i in idea_ids],)
+                )
+            return cur.fetchone()['count']
+
+    def supports_iterative_scan(self) -> bool:
+        """pgvector >= 0.8 ho tro hnsw.iterative_scan (filtered search van du top-k)"""
+        if self._iterative_scan is None:
+            try:
+                version = tuple(int(p) for p in self.get_extension_version().split('.')[:2])
+                self._iterative_scan = version >= (0, 8)
+            except ValueError:
+                self._iterative_scan = False
+        return self._iterative_scan
+
+    def _build_filters(self, filters: Optional[Dict], allowed: Dict[str, Optional[str]], alias: str) -> tuple:
+        """
+        Tao menh de WHERE tham so hoa tu dict filter.
+        Gia tri scalar -> "col = %s::type", list/tuple -> "col = ANY(%s::type[])", None -> bo qua.
+        """
+        clauses: List[str] = []
+        params: List = []
+
+        for column, value in (filters or {}).items():
+            if column not in allowed:
+                raise ValueError(f"Unsupported filter column: {column}")
+            if value is None:
+                continue
+
+            pg_type = allowed[column]
+            if isinstance(value, (list, tuple, set)):
+                cast = f"::{pg_type}[]" if pg_type else "::text[]"
+                clauses.append(f"{alias}.{column} = ANY(%s{cast})")
+                params.append([str(v) for v in value])
+            else:
+                cast = f"::{pg_type}" if pg_type else ""
+                clauses.append(f"{alias}.{column} = %s{cast}")
+                params.append(str(value))
+
+        sql = ''.join(f" AND {c}" for c in clauses)
+        return sql, params
+
+    def _prepare_ann(self, cur, limit: int):
+        """
+        Cau hinh HNSW cho query hien tai (SET LOCAL - chi co hieu luc trong transaction).
+        - ef_search >= limit de index tra du ung vien
+        - iterative_scan: index tiep tuc quet khi filter loai bot ket qua
+        """
+        cur.execute("SET LOCAL hnsw.ef_search = %s", (min(max(40, limit * 2), 1000),))
+        if self.supports_iterative_scan():
+            cur.execute("SET LOCAL hnsw.iterative_scan = relaxed_order")
+
+    def _apply_deadline(self, cur, deadline: Optional[Deadline], stage: str):
+        """Gioi han query theo thoi gian con lai cua request (SET LOCAL - chi trong transaction)"""
+        if deadline is None:
+            return
+        deadline.check(stage)
+        cur.execute("SET LOCAL statement_timeout = %s", (deadline.statement_timeout_ms(),))
+
     def save_embedding(self, incident_id: str, embedding: np.ndarray) -> bool:
         """Luu embedding cho 1 incident"""
         try:
@@ -174,81 +733,378 @@ class Database:
                 """, (embedding.tolist(), str(incident_id)))
             return True
         except Exception as e:
-            print(f"[ERROR] Error saving embedding for incident {incident_id}: {e}")
+            log.error("save_embedding_failed", incident_id=str(incident_id), error=str(e))
             return False
 
-    def save_embeddings_batch(self, data: List[Dict]) -> int:
-        """Luu nhieu embeddings cung luc"""
+    def save_embeddings_batch(self, data: List[Dict], table: str = 'incidents') -> int:
+        """
+        Luu nhieu embeddings cung luc.
+        ideas: moi item kem 'version' + 'text_hash' (ghi cung embedding -> upgrade cu khong de len)
+        """
         if not data:
             return 0
+        if table not in BACKFILL_TARGETS:
+            raise ValueError(f"Unsupported table: {table}")
 
         try:
             with self.cursor() as cur:
-                values = [(str(d['id']), d['embedding'].tolist()) for d in data]
-
-                execute_values(cur, """
-                    UPDATE incidents AS t SET
-                        embedding = v.embedding::vector
-                    FROM (VALUES %s) AS v(id, embedding)
-                    WHERE t.id = v.id::uuid
-                """, values, template="(%s, %s)")
-
-            print(f"[OK] Saved {len(data)} embeddings")
+                if table == 'ideas':
+                    values = [
+                        (str(d['id']), d['embedding'].tolist(), d['version'], d['text_hash'])
+                        for d in data
+                    ]
+                    execute_values(cur, """
+                        UPDATE ideas AS t SET
+                            embedding = v.embedding::vector,
+                            embedding_version = v.version,
+                            embedding_text_hash = v.text_hash
+                        FROM (VALUES %s) AS v(id, embedding, version, text_hash)
+                        WHERE t.id = v.id::uuid
+                    """, values, template="(%s, %s, %s, %s)")
+                else:
+                    values = [(str(d['id']), d['embedding'].tolist()) for d in data]
+                    execute_values(cur, f"""
+                        UPDATE {table} AS t SET
+                            embedding = v.embedding::vector
+                        FROM (VALUES %s) AS v(id, embedding)
+                        WHERE t.id = v.id::uuid
+                    """, values, template="(%s, %s)")
+
+            log.info("embeddings_saved", table=table, count=len(data))
             return len(data)
 
         except Exception as e:
-            print(f"[ERROR] Error saving batch embeddings: {e}")
+            log.error("save_embeddings_batch_failed", table=table, count=len(data), error=str(e))
             return 0
 
+    def save_idea_embedding(self, idea_id: str, embedding: np.ndarray, version: str, text_hash: str) -> bool:
+        """Pha 1 (hoac 1 pha neu extract xong ngay): ghi embedding + version, ghi de moi version cu"""
+        with self.cursor() as cur:
+            cur.execute("""
+                UPDATE ideas
+                SET embedding = %s::vector, embedding_version = %s, embedding_text_hash = %s
+                WHERE id = %s::uuid
+            """, (embedding.tolist(), version, text_hash, str(idea_id)))
+            return cur.rowcount == 1
+
+    def upgrade_idea_embeddings(self, data: List[Dict]) -> List[str]:
+        """
+        Pha 2: nang cap embedding len version moi, 1 UPDATE cho ca batch.
+        data: [{'id', 'embedding' (None = giu embedding, chi doi version), 'version',
+                'text_hash', 'expected_hash' (hash luc doc row)}]
+        Chi ghi khi row van tu cung text (expected_hash khop -> khong de len lan index moi hon)
+        va chua o version do (goi lai la no-op). Tra ve id da nang cap.
+        """
+        if not data:
+            return []
+        values = [
+            (str(d['id']), d['embedding'].tolist() if d['embedding'] is not None else None,
+             d['version'], d['text_hash'], d['expected_hash'])
+            for d in data
+        ]
+        with self.cursor() as cur:
+            rows = execute_values(cur, """
+                UPDATE ideas AS t SET
+                    embedding = COALESCE(v.embedding::vector, t.embedding),
+                    embedding_version = v.version,
+                    embedding_text_hash = v.text_hash
+                FROM (VALUES %s) AS v(id, embedding, version, text_hash, expected_hash)
+                WHERE t.id = v.id::uuid
+                  AND t.embedding IS NOT NULL
+                  AND t.embedding_text_hash IS NOT DISTINCT FROM v.expected_hash
+                  AND t.embedding_version IS DISTINCT FROM v.version
+                RETURNING t.id::text
+            """, values, template="(%s, %s::real[], %s, %s, %s)", fetch=True)
+        return [row['id'] for row in rows]
+
+    def get_ideas_for_embedding_upgrade(self, version: str, limit: int = 100) -> List[Dict]:
+        """Ideas co embedding nhung chua o `version` (raw, NULL hoac prompt cu)"""
+        with self.cursor() as cur:
+            cur.execute("""
+                SELECT id::text as id, description, expected_benefit, embedding_text_hash
+                FROM ideas
+                WHERE embedding IS NOT NULL
+                  AND embedding_version IS DISTINCT FROM %s
+                ORDER BY id
+                LIMIT %s
+            """, (version, limit))
+            return cur.fetchall()
+
+    def count_idea_embedding_versions(self) -> Dict[str, int]:
+        with self.cursor() as cur:
+            cur.execute("""
+                SELECT COALESCE(embedding_version, 'unknown') as version, COUNT(*) as count
+                FROM ideas
+                WHERE embedding IS NOT NULL
+                GROUP BY 1
+            """)
+            return {row['version']: row['count'] for row in cur.fetchall()}
+
+    def save_embeddings_rowwise(self, data: List[Dict], table: str = 'incidents') -> List[tuple]:
+        """
+        Luu tung embedding trong transaction rieng (fallback khi batch that bai).
+        Tra ve danh sach (id, ly do) cua cac row loi.
+        """
+        if table not in BACKFILL_TARGETS:
+            raise ValueError(f"Unsupported table: {table}")
+
+        failures = []
+        for d in data:
+            try:
+                if table == 'ideas':
+                    if not self.save_idea_embedding(d['id'], d['embedding'], d['version'], d['text_hash']):
+                        failures.append((str(d['id']), 'not found'))
+                    continue
+                with self.cursor() as cur:
+                    cur.execute(f"""
+                        UPDATE {table}
+                        SET embedding = %s::vector
+                        WHERE id = %s::uuid
+                    """, (d['embedding'].tolist(), str(d['id'])))
+            except Exception as e:
+                failures.append((str(d['id']), str(e).strip()))
+        return failures
+
     def find_similar(
         self,
         query_embedding: np.ndarray,
         limit: int = None,
-        min_similarity: float = None
+        min_similarity: float = None,
+        filters: Optional[Dict] = None,
+        deadline: Optional[Deadline] = None
     ) -> List[Dict]:
         """
         Tim cac incidents tuong tu nhat voi query
         Tra ve ca location, incident_type, priority, title, resolution_notes de multi-field matching
+
+        filters: metadata filter push xuong ANN query (xem INCIDENT_FILTER_COLUMNS),
+        vd {'incident_type': 'equipment', 'priority': ['high', 'critical']}
+        deadline: statement_timeout = thoi gian con lai; bi huy -> DeadlineExceeded
         """
         limit = limit or Config.DEFAULT_LIMIT
         min_similarity = min_similarity or Config.MIN_SIMILARITY
+        filter_sql, filter_params = self._build_filters(filters, INCIDENT_FILTER_COLUMNS, 'i')
+        vector = query_embedding.tolist()
 
         try:
             with self.cursor() as cur:
-                cur.execute("""
+                self._prepare_ann(cur, limit)
+                self._apply_deadline(cur, deadline, 'ann')
+                # relaxed_order co the tra ve lech thu tu -> sort lai ben ngoai CTE
+                cur.execute(f"""
+                    WITH candidates AS MATERIALIZED (
+                        SELECT
+                            i.id,
+                            i.title,
+                            i.description,
+                            i.location,
+                            i.incident_type,
+                            i.priority,
+                            i.status,
+                            i.resolution_notes,
+                            i.assigned_department_id,
+                            i.embedding <=> %s::vector as distance
+                        FROM incidents i
+                        WHERE i.embedding IS NOT NULL
+                          AND i.assigned_department_id IS NOT NULL{filter_sql}
+                        ORDER BY i.embedding <=> %s::vector
+                        LIMIT %s
+                    )
                     SELECT
-                        i.id,
-                        i.title,
-                        i.description,
-                        i.location,
-                        i.incident_type,
-                        i.priority,
-                        i.status,
-                        i.resolution_notes,
-                        i.assigned_department_id,
+                        c.id,
+                        c.title,
+                        c.description,
+                        c.location,
+                        c.incident_type,
+                        c.priority,
+                        c.status,
+                        c.resolution_notes,
+                        c.assigned_department_id,
                         d.name as department_name,
-                        1 - (embedding <=> %s::vector) as similarity
-                    FROM incidents i
-                    LEFT JOIN departments d ON i.assigned_department_id = d.id
-                    WHERE embedding IS NOT NULL
-                      AND i.assigned_department_id IS NOT NULL
-                      AND 1 - (embedding <=> %s::vector) >= %s
-                    ORDER BY embedding <=> %s::vector
-                    LIMIT %s
-                """, (
-                    query_embedding.tolist(),
-                    query_embedding.tolist(),
-                    min_similarity,
-                    query_embedding.tolist(),
-                    limit
-                ))
+                        1 - c.distance as similarity
+                    FROM candidates c
+                    LEFT JOIN departments d ON c.assigned_department_id = d.id
+                    WHERE 1 - c.distance >= %s
+                    ORDER BY c.distance
+                """, (vector, *filter_params, vector, limit, min_similarity))
 
                 return cur.fetchall()
 
+        except DeadlineExceeded:
+            raise
         except Exception as e:
-            print(f"[ERROR] Error finding similar incidents: {e}")
+            if deadline is not None and isinstance(e, psycopg2.extensions.QueryCanceledError):
+                metrics.deadline_exceeded.inc(stage='ann')
+                raise DeadlineExceeded('ann', deadline.budget_ms) from e
+            log.error("find_similar_failed", error=str(e))
+            return []
+
+    def find_similar_batch(
+        self,
+        query_embeddings: List[np.ndarray],
+        limit: int = None,
+        min_similarity: float = None,
+        incident_types: Optional[List[Optional[str]]] = None,
+        type_limit: int = None
+    ) -> List[List[Dict]]:
+        """
+        Ban batch cua find_similar: ANN cho tat ca query trong 1 round trip (LATERAL tren mang vector).
+        incident_types[k] (neu co): them top `type_limit` cung loai cho query k (gop, bo trung id).
+        Tra ve list ket qua theo thu tu input, moi list sort theo similarity giam dan.
+        Loi DB duoc raise (caller tu quyet dinh loi tung item).
+        """
+        limit = limit or Config.DEFAULT_LIMIT
+        min_similarity = min_similarity or Config.MIN_SIMILARITY
+        type_limit = type_limit or limit
+        if len(query_embeddings) == 0:
             return []
 
+        vectors = ['[' + ','.join(repr(float(x)) for x in emb) + ']' for emb in query_embeddings]
+        types = list(incident_types) if incident_types else [None] * len(vectors)
+        columns = """
+            i.id, i.title, i.description, i.location, i.incident_type, i.priority,
+            i.status, i.resolution_notes, i.assigned_department_id
+        """
+
+        with self.cursor() as cur:
+            self._prepare_ann(cur, max(limit, type_limit))
+            # So sanh incident_type dang text: gia tri la khong lam hong ca batch (chi khong match)
+            cur.execute(f"""
+                WITH q AS (
+                    SELECT t.ord, t.vec::vector as vec, t.incident_type
+                    FROM unnest(%s::text[], %s::text[]) WITH ORDINALITY AS t(vec, incident_type, ord)
+                ),
+                hits AS (
+                    SELECT q.ord, n.*
+                    FROM q
+                    CROSS JOIN LATERAL (
+                        SELECT {columns}, i.embedding <=> q.vec as distance
+                        FROM incidents i
+                        WHERE i.embedding IS NOT NULL
+                          AND i.assigned_department_id IS NOT NULL
+                        ORDER BY i.embedding <=> q.vec
+                        LIMIT %s
+                    ) n
+                    UNION ALL
+                    SELECT q.ord, n.*
+                    FROM q
+                    CROSS JOIN LATERAL (
+                        SELECT {columns}, i.embedding <=> q.vec as distance
+                        FROM incidents i
+                        WHERE i.embedding IS NOT NULL
+                          AND i.assigned_department_id IS NOT NULL
+                          AND i.incident_type::text = q.incident_type
+                        ORDER BY i.embedding <=> q.vec
+                        LIMIT %s
+                    ) n
+                    WHERE q.incident_type IS NOT NULL
+                )
+                SELECT DISTINCT ON (h.ord, h.id)
+                    h.ord,
+                    h.id,
+                    h.title,
+                    h.description,
+                    h.location,
+                    h.incident_type,
+                    h.priority,
+                    h.status,
+                    h.resolution_notes,
+                    h.assigned_department_id,
+                    d.name as department_name,
+                    1 - h.distance as similarity
+                FROM hits h
+                LEFT JOIN departments d ON h.assigned_department_id = d.id
+                WHERE 1 - h.distance >= %s
+                ORDER BY h.ord, h.id
+            """, (vectors, types, limit, type_limit, min_similarity))
+            rows = cur.fetchall()
+
+        results: List[List[Dict]] = [[] for _ in vectors]
+        for row in rows:
+            row = dict(row)
+            results[row.pop('ord') - 1].append(row)
+        for items in results:
+            items.sort(key=lambda r: r['similarity'], reverse=True)
+        return results
+
+    def find_similar_ideas(
+        self,
+        query_embedding: np.ndarray,
+        limit: int = None,
+        filters: Optional[Dict] = None,
+        min_similarity: float = None
+    ) -> List[Dict]:
+        """
+        Filtered ANN tren ideas - chi tra ve id, text va similarity (theo thu tu gan nhat).
+        Caller tu hydrate them thong tin can thiet theo id.
+
+        filters: xem IDEA_FILTER_COLUMNS, vd {'ideabox_type': 'white', 'whitebox_subtype': 'idea'}
+        Loi DB duoc raise len de endpoint co the fallback.
+        """
+        limit = limit or Config.DEFAULT_LIMIT
+        filter_sql, filter_params = self._build_filters(filters, IDEA_FILTER_COLUMNS, 'i')
+        vector = query_embedding.tolist()
+        threshold = min_similarity if min_similarity is not None else -1.0
+
+        with self.cursor() as cur:
+            self._prepare_ann(cur, limit)
+            cur.execute(f"""
+                WITH candidates AS MATERIALIZED (
+                    SELECT
+                        i.id,
+                        i.title,
+                        i.description,
+                        i.expected_benefit,
+                        i.embedding <=> %s::vector as distance
+                    FROM ideas i
+                    WHERE i.embedding IS NOT NULL{filter_sql}
+                    ORDER BY i.embedding <=> %s::vector
+                    LIMIT %s
+                )
+                SELECT id, title, description, expected_benefit, 1 - distance as similarity
+                FROM candidates
+                WHERE 1 - distance >= %s
+                ORDER BY distance
+            """, (vector, *filter_params, vector, limit, threshold))
+
+            return cur.fetchall()
+
+    def get_idea_cards(self, idea_ids: List[str], with_history: bool = True) -> Dict[str, Dict]:
+        """
+        Doc idea card (JSON dung san: submitter, department, stage, responses, history,
+        final resolution) theo primary key + implemented count cua category.
+        with_history=False: bo responses/workflow_history ngay trong SQL (payload gon).
+        Card thieu (refresh loi, idea tao truoc khi co trigger) duoc build ngay.
+        Tra ve dict id -> card.
+        """
+        if not idea_ids:
+            return {}
+
+        card = "c.card" if with_history else "c.card - 'responses' - 'workflow_history'"
+        query = f"""
+            SELECT c.idea_id::text as id, {card} as card,
+                   COALESCE(cs.implemented_count, 0) as implemented_count
+            FROM rag_idea_cards c
+            LEFT JOIN rag_idea_category_stats cs ON cs.category = c.card->>'category'
+            WHERE c.idea_id = ANY(%s::uuid[])
+        """
+        ids = [str(i) for i in idea_ids]
+
+        with metrics.timer('hydration'), self.cursor() as cur:
+            cur.execute(query, (ids,))
+            rows = cur.fetchall()
+
+            missing = list(set(ids) - {r['id'] for r in rows})
+            if missing:
+                cur.execute("SELECT rag_refresh_idea_card(x) FROM unnest(%s::uuid[]) x", (missing,))
+                cur.execute(query, (missing,))
+                rows += cur.fetchall()
+
+        return {
+            r['id']: {**r['card'], 'implemented_count': r['implemented_count']}
+            for r in rows
+        }
+
     def get_department_suggestion(self, query_embedding: np.ndarray) -> Dict:
         """
         Goi y department dua tren embedding (voting + weighted confidence)
@@ -353,7 +1209,7 @@ class Database:
                 }
 
         except Exception as e:
-            print(f"[ERROR] Error counting embeddings: {e}")
+            log.error("count_embeddings_failed", error=str(e))
             return {'total': 0, 'with_embedding': 0, 'without_embedding': 0, 'percentage': 0.0}
 
     def get_incidents_without_embedding(self, limit: int = 100) -> List[Dict]:
@@ -371,9 +1227,512 @@ class Database:
                 return cur.fetchall()
 
         except Exception as e:
-            print(f"[ERROR] Error getting incidents: {e}")
+            log.error("get_incidents_without_embedding_failed", error=str(e))
             return []
 
+    def get_department_embeddings_after(self, after_id: Optional[str], limit: int = 1000) -> List[Dict]:
+        """Trang (keyset theo id) embedding incidents da co department - nguon cho prototype routing"""
+        with self.cursor() as cur:
+            cur.execute("""
+                SELECT i.id::text as id, i.embedding,
+                       i.assigned_department_id::text as assigned_department_id,
+                       d.name as department_name
+                FROM incidents i
+                LEFT JOIN departments d ON i.assigned_department_id = d.id
+                WHERE i.embedding IS NOT NULL
+                  AND i.assigned_department_id IS NOT NULL
+                  AND i.id > %s::uuid
+                ORDER BY i.id
+                LIMIT %s
+            """, (after_id or ZERO_UUID, limit))
+            return cur.fetchall()
+
+    def get_records_after(
+        self,
+        target: str,
+        after_id: Optional[str],
+        limit: int = 100,
+        only_missing: bool = True,
+        range_start: Optional[str] = None,
+        range_end: Optional[str] = None
+    ) -> List[Dict]:
+        """
+        Keyset pagination theo id: lay records co id > after_id (hoac >= range_start khi chua co cursor),
+        gioi han trong [range_start, range_end] neu chay theo shard.
+        Khong lap lai row cu du row do luu that bai -> backfill luon tien ve phia truoc.
+        Tra ve id + text dung de encode.
+        """
+        spec = BACKFILL_TARGETS[target]
+        conditions = ["id > %s::uuid" if after_id else "id >= %s::uuid"]
+        params: List = [after_id or range_start or ZERO_UUID]
+        if range_end:
+            conditions.append("id <= %s::uuid")
+            params.append(range_end)
+        if only_missing:
+            conditions.append("embedding IS NULL")
+        conditions.append(spec['valid'])
+
+        with self.cursor() as cur:
+            cur.execute(f"""
+                SELECT id::text as id, {spec['text']} as text
+                FROM {target}
+                WHERE {' AND '.join(conditions)}
+                ORDER BY id
+                LIMIT %s
+            """, (*params, limit))
+            return cur.fetchall()
+
+    def count_backfill_records(self, target: str, only_missing: bool = True) -> int:
+        spec = BACKFILL_TARGETS[target]
+        missing_sql = "AND embedding IS NULL" if only_missing else ""
+        with self.cursor() as cur:
+            cur.execute(f"SELECT COUNT(*) as count FROM {target} WHERE {spec['valid']} {missing_sql}")
+            return cur.fetchone()['count']
+
+    def partition_backfill_ranges(self, target: str, shards: int, only_missing: bool = True) -> List[Dict]:
+        """
+        Chia records can backfill thanh `shards` khoang id lien tiep, so luong xap xi bang nhau.
+        Postgres khong co MIN/MAX cho uuid -> lay tren id::text (uuid dang chuan chu thuong
+        sap xep giong het uuid)
+        """
+        spec = BACKFILL_TARGETS[target]
+        missing_sql = "AND embedding IS NULL" if only_missing else ""
+        with self.cursor() as cur:
+            cur.execute(f"""
+                SELECT
+                    shard,
+                    MIN(id::text) as range_start,
+                    MAX(id::text) as range_end,
+                    COUNT(*) as total
+                FROM (
+                    SELECT id, ntile(%s) OVER (ORDER BY id) as shard
+                    FROM {target}
+                    WHERE {spec['valid']} {missing_sql}
+                ) t
+                GROUP BY shard
+                ORDER BY shard
+            """, (shards,))
+            return [dict(r) for r in cur.fetchall()]
+
+    # === Backfill jobs ===
+    def ensure_backfill_tables(self):
+        """Tao bang job + bang loi cho backfill (idempotent)"""
+        if self._backfill_ready:
+            return
+        with self.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS rag_backfill_jobs (
+                    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+                    target VARCHAR(50) NOT NULL,
+                    status VARCHAR(20) NOT NULL DEFAULT 'running',
+                    only_missing BOOLEAN NOT NULL DEFAULT true,
+                    batch_size INTEGER NOT NULL,
+                    cursor_id UUID,
+                    total INTEGER DEFAULT 0,
+                    processed INTEGER DEFAULT 0,
+                    failed INTEGER DEFAULT 0,
+                    error TEXT,
+                    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+                    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+                    finished_at TIMESTAMP WITH TIME ZONE
+                )
+            """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS rag_backfill_failures (
+                    job_id UUID NOT NULL REFERENCES rag_backfill_jobs(id) ON DELETE CASCADE,
+                    record_id UUID NOT NULL,
+                    reason TEXT,
+                    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+                    PRIMARY KEY (job_id, record_id)
+                )
+            """)
+            # Shard cua backfill song song (run_id gom cac shard cung 1 lan chay)
+            cur.execute("""
+                ALTER TABLE rag_backfill_jobs
+                    ADD COLUMN IF NOT EXISTS run_id UUID,
+                    ADD COLUMN IF NOT EXISTS range_start UUID,
+                    ADD COLUMN IF NOT EXISTS range_end UUID
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_rag_backfill_jobs_target
+                ON rag_backfill_jobs(target, created_at DESC)
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_rag_backfill_jobs_run
+                ON rag_backfill_jobs(run_id)
+            """)
+        self._backfill_ready = True
+
+    def create_backfill_job(
+        self,
+        target: str,
+        batch_size: int,
+        total: int,
+        only_missing: bool = True,
+        run_id: Optional[str] = None,
+        range_start: Optional[str] = None,
+        range_end: Optional[str] = None,
+        status: str = 'running'
+    ) -> Dict:
+        """status='queued': shard tao truoc, process nao claim_backfill_job_by_id truoc thi chay"""
+        self.ensure_backfill_tables()
+        with self.cursor() as cur:
+            cur.execute("""
+                INSERT INTO rag_backfill_jobs
+                    (target, batch_size, total, only_missing, run_id, range_start, range_end, status)
+                VALUES (%s, %s, %s, %s, %s::uuid, %s::uuid, %s::uuid, %s)
+                RETURNING *
+            """, (target, batch_size, total, only_missing, run_id, range_start, range_end, status))
+            return dict(cur.fetchone())
+
+    def get_backfill_job(self, job_id: str) -> Optional[Dict]:
+        self.ensure_backfill_tables()
+        with self.cursor() as cur:
+            cur.execute("SELECT * FROM rag_backfill_jobs WHERE id = %s::uuid", (job_id,))
+            row = cur.fetchone()
+            return dict(row) if row else None
+
+    def claim_backfill_job(self, target: str, batch_size: int, only_missing: bool = True,
+                           resume: bool = True, stale_seconds: float = 300) -> tuple:
+        """
+        Nhan 1 backfill job (khong theo shard) de chay, nguyen tu giua cac process/worker:
+        advisory lock theo target trong transaction -> 2 process khong cung resume/tao job.
+        Job 'running' chi duoc resume khi heartbeat (updated_at, ghi moi checkpoint)
+        cu hon stale_seconds (process cu da chet).
+        Tra ve (state, job): state = 'resumed' | 'created' | 'busy' (job dang chay) | 'empty'.
+        """
+        self.ensure_backfill_tables()
+        spec = BACKFILL_TARGETS[target]
+        missing_sql = "AND embedding IS NULL" if only_missing else ""
+        with self.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"rag_backfill:{target}",))
+            cur.execute("""
+                SELECT * FROM rag_backfill_jobs
+                WHERE target = %s
+                  AND run_id IS NULL
+                  AND status = 'running'
+                  AND updated_at >= NOW() - make_interval(secs => %s)
+                ORDER BY created_at DESC
+                LIMIT 1
+            """, (target, stale_seconds))
+            row = cur.fetchone()
+            if row is not None:
+                return 'busy', dict(row)
+
+            if resume:
+                cur.execute("""
+                    UPDATE rag_backfill_jobs SET status = 'running', updated_at = NOW()
+                    WHERE id = (
+                        SELECT id FROM rag_backfill_jobs
+                        WHERE target = %s
+                          AND only_missing = %s
+                          AND run_id IS NULL
+                          AND status IN ('running', 'paused', 'interrupted')
+                        ORDER BY created_at DESC
+                        LIMIT 1
+                    )
+                    RETURNING *
+                """, (target, only_missing))
+                row = cur.fetchone()
+                if row is not None:
+                    return 'resumed', dict(row)
+
+            cur.execute(f"SELECT COUNT(*) as count FROM {target} WHERE {spec['valid']} {missing_sql}")
+            total = cur.fetchone()['count']
+            if total == 0:
+                return 'empty', None
+            cur.execute("""
+                INSERT INTO rag_backfill_jobs (target, batch_size, total, only_missing)
+                VALUES (%s, %s, %s, %s)
+                RETURNING *
+            """, (target, batch_size, total, only_missing))
+            return 'created', dict(cur.fetchone())
+
+    def claim_backfill_job_by_id(self, job_id: str, stale_seconds: float = 300) -> Optional[Dict]:
+        """
+        Nhan 1 job cu the (vd shard cua backfill song song). None neu job da xong
+        hoac dang duoc process khac chay (heartbeat con moi)
+        """
+        self.ensure_backfill_tables()
+        with self.cursor() as cur:
+            cur.execute("""
+                UPDATE rag_backfill_jobs SET status = 'running', updated_at = NOW()
+                WHERE id = %s::uuid
+                  AND status <> 'completed'
+                  AND (status <> 'running' OR updated_at < NOW() - make_interval(secs => %s))
+                RETURNING *
+            """, (job_id, stale_seconds))
+            row = cur.fetchone()
+            return dict(row) if row else None
+
+    def list_backfill_jobs(self, target: str = None, limit: int = 20) -> List[Dict]:
+        self.ensure_backfill_tables()
+        with self.cursor() as cur:
+            cur.execute("""
+                SELECT * FROM rag_backfill_jobs
+                WHERE %s::text IS NULL OR target = %s
+                ORDER BY created_at DESC
+                LIMIT %s
+            """, (target, target, limit))
+            return [dict(r) for r in cur.fetchall()]
+
+    def get_backfill_run(self, run_id: str) -> Dict:
+        """Tong hop tien do tat ca shard cua 1 lan backfill song song"""
+        self.ensure_backfill_tables()
+        with self.cursor() as cur:
+            cur.execute("""
+                SELECT * FROM rag_backfill_jobs
+                WHERE run_id = %s::uuid
+                ORDER BY target, range_start
+            """, (run_id,))
+            shards = [dict(r) for r in cur.fetchall()]
+
+        total = sum(j['total'] or 0 for j in shards)
+        processed = sum(j['processed'] or 0 for j in shards)
+        failed = sum(j['failed'] or 0 for j in shards)
+        statuses = {j['status'] for j in shards}
+        if not shards:
+            status = 'not_found'
+        elif statuses == {'completed'}:
+            status = 'completed'
+        elif 'running' in statuses:
+            status = 'running'
+        else:
+            status = 'incomplete'
+
+        return {
+            'run_id': run_id,
+            'status': status,
+            'total': total,
+            'processed': processed,
+            'failed': failed,
+            'percentage': round((processed + failed) * 100 / total, 1) if total else 0.0,
+            'shards': shards
+        }
+
+    def checkpoint_backfill_job(self, job_id: str, cursor_id: str, processed: int, failed: int,
+                                failures: List[tuple] = None):
+        """Luu tien do + cac row loi (record_id, reason) trong cung 1 transaction"""
+        with self.cursor() as cur:
+            if failures:
+                execute_values(cur, """
+                    INSERT INTO rag_backfill_failures (job_id, record_id, reason)
+                    VALUES %s
+                    ON CONFLICT (job_id, record_id) DO UPDATE SET
+                        reason = EXCLUDED.reason,
+                        created_at = NOW()
+                """, [(job_id, rid, reason[:1000]) for rid, reason in failures],
+                    template="(%s::uuid, %s::uuid, %s)")
+            cur.execute("""
+                UPDATE rag_backfill_jobs SET
+                    cursor_id = %s::uuid,
+                    processed = %s,
+                    failed = %s,
+                    status = 'running',
+                    updated_at = NOW()
+                WHERE id = %s::uuid
+            """, (cursor_id, processed, failed, job_id))
+
+    def finish_backfill_job(self, job_id: str, status: str, error: str = None):
+        with self.cursor() as cur:
+            cur.execute("""
+                UPDATE rag_backfill_jobs SET
+                    status = %s,
+                    error = %s,
+                    updated_at = NOW(),
+                    finished_at = CASE WHEN %s IN ('completed', 'failed', 'cancelled') THEN NOW() END
+                WHERE id = %s::uuid
+            """, (status, error, status, job_id))
+
+    def get_backfill_failures(self, job_id: str, limit: int = 100) -> List[Dict]:
+        self.ensure_backfill_tables()
+        with self.cursor() as cur:
+            cur.execute("""
+                SELECT record_id::text as record_id, reason, created_at
+                FROM rag_backfill_failures
+                WHERE job_id = %s::uuid
+                ORDER BY created_at DESC
+                LIMIT %s
+            """, (job_id, limit))
+            return [dict(r) for r in cur.fetchall()]
+
+    # === Background jobs (job_queue) ===
+    def ensure_job_tables(self):
+        """
+        Bang trang thai job nen dung chung cho moi worker (idempotent).
+        Unique index tren key cua job dang queued/running -> single-flight giua cac worker
+        """
+        if self._jobs_ready:
+            return
+        with self.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS rag_jobs (
+                    id UUID PRIMARY KEY,
+                    kind VARCHAR(50) NOT NULL,
+                    key VARCHAR(100) NOT NULL,
+                    status VARCHAR(20) NOT NULL DEFAULT 'queued',
+                    params JSONB,
+                    total INTEGER,
+                    done INTEGER DEFAULT 0,
+                    failed INTEGER DEFAULT 0,
+                    result JSONB,
+                    error TEXT,
+                    cancel_requested BOOLEAN NOT NULL DEFAULT false,
+                    worker_pid INTEGER,
+                    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+                    started_at TIMESTAMP WITH TIME ZONE,
+                    finished_at TIMESTAMP WITH TIME ZONE,
+                    heartbeat_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                )
+            """)
+            cur.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_rag_jobs_active_key
+                ON rag_jobs(key) WHERE status IN ('queued', 'running')
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_rag_jobs_created
+                ON rag_jobs(created_at DESC)
+            """)
+        self._jobs_ready = True
+
+    def create_job(self, job_id: str, kind: str, key: str, params: Dict, worker_pid: int,
+                   stale_seconds: float) -> tuple:
+        """
+        Tao job neu chua co job cung key dang chay. Job cung key co heartbeat qua
+        stale_seconds (worker chet) bi danh dau 'interrupted' truoc.
+        Tra ve (True, row moi) hoac (False, row job dang chay).
+        """
+        self.ensure_job_tables()
+        with self.cursor() as cur:
+            cur.execute("""
+                UPDATE rag_jobs
+                SET status = 'interrupted', finished_at = NOW(), error = 'worker heartbeat lost'
+                WHERE key = %s
+                  AND status IN ('queued', 'running')
+                  AND heartbeat_at < NOW() - make_interval(secs => %s)
+            """, (key, stale_seconds))
+            cur.execute("""
+                INSERT INTO rag_jobs (id, kind, key, params, worker_pid)
+                VALUES (%s::uuid, %s, %s, %s, %s)
+                ON CONFLICT (key) WHERE status IN ('queued', 'running') DO NOTHING
+                RETURNING *
+            """, (job_id, kind, key, psycopg2.extras.Json(params, dumps=_json_dumps), worker_pid))
+            row = cur.fetchone()
+            if row is not None:
+                return True, dict(row)
+            cur.execute("""
+                SELECT * FROM rag_jobs
+                WHERE key = %s AND status IN ('queued', 'running')
+            """, (key,))
+            row = cur.fetchone()
+            return False, dict(row) if row else None
+
+    def heartbeat_jobs(self, jobs: List[Dict]) -> List[str]:
+        """
+        Ghi tien do + heartbeat cac job dang chay cua worker nay (1 UPDATE).
+        jobs: [{'id', 'status', 'total', 'done', 'failed', 'started_at' (epoch)}].
+        Tra ve id cac job da duoc yeu cau huy (tu worker khac)
+        """
+        if not jobs:
+            return []
+        values = [
+            (j['id'], j['status'], j['total'], j['done'], j['failed'], j['started_at'])
+            for j in jobs
+        ]
+        with self.cursor() as cur:
+            rows = execute_values(cur, """
+                UPDATE rag_jobs AS t SET
+                    status = v.status,
+                    total = v.total,
+                    done = v.done,
+                    failed = v.failed,
+                    started_at = COALESCE(t.started_at, to_timestamp(v.started_at)),
+                    heartbeat_at = NOW()
+                FROM (VALUES %s) AS v(id, status, total, done, failed, started_at)
+                WHERE t.id = v.id::uuid
+                  AND t.status IN ('queued', 'running')
+                RETURNING t.id::text as id, t.cancel_requested
+            """, values, template="(%s, %s, %s::integer, %s::integer, %s::integer, %s::double precision)", fetch=True)
+        return [row['id'] for row in rows if row['cancel_requested']]
+
+    def finish_job(self, job_id: str, status: str, total: Optional[int], done: int, failed: int,
+                   result=None, error: str = None):
+        with self.cursor() as cur:
+            cur.execute("""
+                UPDATE rag_jobs SET
+                    status = %s, total = %s, done = %s, failed = %s,
+                    result = %s, error = %s,
+                    finished_at = NOW(), heartbeat_at = NOW()
+                WHERE id = %s::uuid
+            """, (status, total, done, failed,
+                  psycopg2.extras.Json(result, dumps=_json_dumps) if result is not None else None,
+                  error, job_id))
+
+    def get_job(self, job_id: str) -> Optional[Dict]:
+        self.ensure_job_tables()
+        with self.cursor() as cur:
+            cur.execute(f"SELECT {JOB_COLUMNS} FROM rag_jobs WHERE id = %s::uuid", (job_id,))
+            row = cur.fetchone()
+            return dict(row) if row else None
+
+    def list_jobs(self, kind: str = None, limit: int = 100) -> List[Dict]:
+        self.ensure_job_tables()
+        with self.cursor() as cur:
+            cur.execute(f"""
+                SELECT {JOB_COLUMNS} FROM rag_jobs
+                WHERE %s::text IS NULL OR kind = %s
+                ORDER BY created_at DESC
+                LIMIT %s
+            """, (kind, kind, limit))
+            return [dict(r) for r in cur.fetchall()]
+
+    def request_job_cancel(self, job_id: str) -> Optional[Dict]:
+        """Danh dau huy; worker dang chay job thay o heartbeat tiep theo"""
+        self.ensure_job_tables()
+        with self.cursor() as cur:
+            cur.execute(f"""
+                UPDATE rag_jobs SET cancel_requested = true
+                WHERE id = %s::uuid
+                RETURNING {JOB_COLUMNS}
+            """, (job_id,))
+            row = cur.fetchone()
+            return dict(row) if row else None
+
+    # === Query cache generations (query_cache) ===
+    def ensure_cache_generation_table(self):
+        """Generation cua query cache dung chung cho moi worker (idempotent)"""
+        if self._cache_generations_ready:
+            return
+        with self.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS rag_cache_generations (
+                    namespace VARCHAR(50) PRIMARY KEY,
+                    generation BIGINT NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                )
+            """)
+        self._cache_generations_ready = True
+
+    def bump_cache_generation(self, namespace: str) -> int:
+        """Tang generation cua namespace (atomic giua cac worker), tra ve generation moi"""
+        self.ensure_cache_generation_table()
+        with self.cursor() as cur:
+            cur.execute("""
+                INSERT INTO rag_cache_generations (namespace, generation)
+                VALUES (%s, 1)
+                ON CONFLICT (namespace) DO UPDATE
+                SET generation = rag_cache_generations.generation + 1, updated_at = NOW()
+                RETURNING generation
+            """, (namespace,))
+            return cur.fetchone()['generation']
+
+    def get_cache_generations(self) -> Dict[str, int]:
+        """{namespace: generation} hien tai (namespace chua bump -> khong co trong dict)"""
+        self.ensure_cache_generation_table()
+        with self.cursor() as cur:
+            cur.execute("SELECT namespace, generation FROM rag_cache_generations")
+            return {row['namespace']: row['generation'] for row in cur.fetchall()}
+
     def get_rag_settings(self) -> Dict:
         """Lay RAG settings tu database."""
         default_settings = {
@@ -410,7 +1769,7 @@ class Database:
                 return default_settings
 
         except Exception as e:
-            print(f"[WARN] Error getting RAG settings: {e}")
+            log.warning("get_rag_settings_failed", error=str(e))
             return default_settings
 
     def save_rag_settings(self, settings: Dict) -> bool:
@@ -442,10 +1801,13 @@ class Database:
             print(f"[ERROR] Error saving RAG settings: {e}")
             return False
 
-    def should_auto_assign(self, confidence: float) -> Dict:
-        """Kiem tra xem co nen auto-assign hay khong."""
-        settings = self.get_rag_settings()
-        stats = self.count_embeddings()
+    def should_auto_assign(self, confidence: float, settings: Dict = None, stats: Dict = None) -> Dict:
+        """
+        Kiem tra xem co nen auto-assign hay khong.
+        settings/stats: truyen vao khi goi nhieu lan (batch) de khong query lai moi item.
+        """
+        settings = settings or self.get_rag_settings()
+        stats = stats or self.count_embeddings()
 
         enabled = settings['enabled']
         threshold = settings['threshold']
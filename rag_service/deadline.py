@@ -0,0 +1,87 @@
+"""
+Deadline
+Thoi gian con lai cua 1 request, truyen qua pipeline routing (router -> embedding -> database)
+
+- Tao tu header X-Deadline-Ms (client con cho bao lau) hoac REQUEST_DEADLINE_MS
+- Stage bat buoc (encode, ANN) goi check(): het gio -> DeadlineExceeded (api tra 504)
+- Stage tuy chon (rerank, wide retrieval) goi allows(): uoc luong chi phi tu latency
+  trung binh cua stage (metrics); khong du thoi gian -> bo qua va ghi vao skipped
+- Database: statement_timeout() -> SET LOCAL statement_timeout theo thoi gian con lai
+"""
+import math
+import time
+from typing import List, Optional
+
+from config import Config
+from metrics import metrics
+
+# Uoc luong chi phi (giay) khi stage chua co so lieu
+DEFAULT_STAGE_COST = {
+    'rerank': 0.3,
+    'ann': 0.05,
+    'wide_retrieval': 0.05,
+}
+# Chua lai cho voting + serialize response
+SAFETY_MARGIN = 0.05
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage: str, budget_ms: float):
+        super().__init__(f"Deadline exceeded at '{stage}' (budget {budget_ms:.0f}ms)")
+        self.stage = stage
+        self.budget_ms = budget_ms
+
+
+class Deadline:
+    def __init__(self, budget_ms: float):
+        self.budget_ms = budget_ms
+        self.expires_at = time.monotonic() + budget_ms / 1000
+        self.skipped: List[str] = []
+
+    @classmethod
+    def from_header(cls, value: Optional[str]) -> 'Deadline':
+        """
+        X-Deadline-Ms hop le thi dung (gioi han boi REQUEST_DEADLINE_MAX_MS), khong thi mac dinh.
+        nan/inf -> mac dinh (nan lot qua min/max va lam moi stage bi bo qua)
+        """
+        budget = Config.REQUEST_DEADLINE_MS
+        if value:
+            try:
+                requested = float(value)
+            except ValueError:
+                requested = None
+            if requested is not None and math.isfinite(requested):
+                budget = min(max(requested, 0.0), Config.REQUEST_DEADLINE_MAX_MS)
+        return cls(budget)
+
+    def remaining(self) -> float:
+        """Giay con lai (co the am)"""
+        return self.expires_at - time.monotonic()
+
+    def check(self, stage: str):
+        """Stage bat buoc: het gio thi dung pipeline"""
+        if self.remaining() <= 0:
+            metrics.deadline_exceeded.inc(stage=stage)
+            raise DeadlineExceeded(stage, self.budget_ms)
+
+    def allows(self, stage: str, cost_stage: str = None) -> bool:
+        """
+        Stage tuy chon: chi chay neu thoi gian con lai > chi phi uoc luong + margin.
+        Khong du -> ghi stage vao skipped.
+        """
+        cost = metrics.stage_mean(cost_stage or stage)
+        if cost is None:
+            cost = DEFAULT_STAGE_COST.get(stage, 0.0)
+        if self.remaining() > cost + SAFETY_MARGIN:
+            return True
+        self.skip(stage)
+        return False
+
+    def skip(self, stage: str):
+        if stage not in self.skipped:
+            self.skipped.append(stage)
+            metrics.deadline_skipped.inc(stage=stage)
+
+    def statement_timeout_ms(self) -> int:
+        """Cho Postgres statement_timeout (>= 1ms; 0 nghia la khong gioi han nen tranh)"""
+        return max(1, int(self.remaining() * 1000))
@@ -28,6 +28,8 @@ logging.getLogger("safetensors").setLevel(logging.ERROR)
 logging.getLogger("tqdm").setLevel(logging.ERROR)
 
 from config import Config
+from metrics import metrics
+from deadline import Deadline
 
 # ========================================
 # Configuration
@@ -93,6 +95,7 @@ class EmbeddingService:
     """
     _instance = None
     _model = None
+    _model_bytes = None
     _tokenizer = None
     _use_huggingface = False
     _model_name = None
@@ -131,6 +134,9 @@ class EmbeddingService:
         start = time.time()
         # show_progress_bar=False tắt log "Loading weights..."
         self._model = SentenceTransformer(model_name, device="cuda")
+        if Config.INFERENCE_THREADS > 0:
+            import torch
+            torch.set_num_threads(Config.INFERENCE_THREADS)
         
         # Load Reranker (nếu có config và đủ VRAM)
         self._reranker = None
@@ -167,9 +173,34 @@ class EmbeddingService:
             documents = [tokenize_vietnamese(doc) for doc in documents]
         
         pairs = [[query, doc] for doc in documents]
-        scores = self._reranker.predict(pairs)
+        with metrics.timer('rerank'):
+            scores = self._reranker.predict(pairs)
         return scores.tolist()
 
+    def rerank_batch(self, queries: List[str], documents: List[List[str]]) -> List[List[float]]:
+        """
+        Rerank nhieu query cung luc: gop tat ca cap (query, doc) vao 1 lan predict.
+        Tra ve scores theo tung query (cung thu tu voi documents).
+        """
+        if not hasattr(self, '_reranker') or not self._reranker:
+            return [[0.0] * len(docs) for docs in documents]
+
+        if HAS_PYVI:
+            queries = [tokenize_vietnamese(q) for q in queries]
+            documents = [[tokenize_vietnamese(doc) for doc in docs] for docs in documents]
+
+        pairs = [[q, doc] for q, docs in zip(queries, documents) for doc in docs]
+        if not pairs:
+            return [[] for _ in documents]
+
+        with metrics.timer('rerank'):
+            scores = self._reranker.predict(pairs).tolist()
+        results, pos = [], 0
+        for docs in documents:
+            results.append(scores[pos:pos + len(docs)])
+            pos += len(docs)
+        return results
+
     def _load_onnx_model(self):
         """Load ONNX model and tokenizer"""
         print(f"Loading ONNX model: {Config.MODEL_NAME}...")
@@ -194,12 +225,9 @@ class EmbeddingService:
                     "Please ensure the model files are in place or install sentence-transformers."
                 )
 
-        # Load ONNX model
-        providers = ['CPUExecutionProvider']
-        self._model = ort.InferenceSession(
-            str(onnx_path), 
-            providers=providers
-        )
+        # Load ONNX model (giu bytes trong RAM: worker fork sau do tao session tu bytes nay)
+        self._model_bytes = onnx_path.read_bytes()
+        self._model = self._create_onnx_session(Config.INFERENCE_THREADS)
         print(f"[OK] ONNX model loaded from {onnx_path}")
 
         # Load tokenizer
@@ -222,19 +250,21 @@ class EmbeddingService:
         sum_mask = np.sum(mask_expanded, axis=1)
         return sum_embeddings / np.maximum(sum_mask, 1e-9)
 
-    def encode(self, text: Union[str, List[str]], is_query: bool = False) -> np.ndarray:
+    def encode(self, text: Union[str, List[str]], is_query: bool = False, deadline: Deadline = None) -> np.ndarray:
         """
         Tạo embedding từ text.
         
         Args:
             text: Text hoặc list of texts
             is_query: True nếu là query
+            deadline: hết thời gian của request -> DeadlineExceeded (không encode)
             
         Returns:
             numpy array of embeddings (normalized)
         """
-        start = time.time()
-        
+        if deadline is not None:
+            deadline.check('encode')
+
         # Prepare texts
         is_single = isinstance(text, str)
         texts = [text] if is_single else text
@@ -244,7 +274,8 @@ class EmbeddingService:
             # E5 multilingual model không cần và sẽ bị ảnh hưởng xấu bởi word segmentation
             is_phobert = "phobert" in self._model_name.lower() and "aiteamvn" not in self._model_name.lower()
             if HAS_PYVI and is_phobert:
-                texts = [tokenize_vietnamese(t) for t in texts]
+                with metrics.timer('segmentation'):
+                    texts = [tokenize_vietnamese(t) for t in texts]
             
             # E5 models cần prefix "query:" hoặc "passage:" để hoạt động tốt
             if "e5" in self._model_name.lower():
@@ -253,25 +284,28 @@ class EmbeddingService:
                 else:
                     texts = [f"passage: {t}" for t in texts]
             
-            # Use sentence-transformers
-            embeddings = self._model.encode(
-                texts,
-                normalize_embeddings=True,
-                show_progress_bar=False
-            )
+            # Use sentence-transformers (tokenize + inference trong 1 lan goi)
+            with metrics.timer('inference'):
+                embeddings = self._model.encode(
+                    texts,
+                    normalize_embeddings=True,
+                    show_progress_bar=False
+                )
         else:
             # Use ONNX model
             # Vietnamese word segmentation (required for PhoBERT)
-            texts = [tokenize_vietnamese(t) for t in texts]
+            with metrics.timer('segmentation'):
+                texts = [tokenize_vietnamese(t) for t in texts]
 
             # Tokenize
-            encoded = self._tokenizer(
-                texts,
-                padding=True,
-                truncation=True,
-                max_length=256,
-                return_tensors="np"
-            )
+            with metrics.timer('tokenization'):
+                encoded = self._tokenizer(
+                    texts,
+                    padding=True,
+                    truncation=True,
+                    max_length=256,
+                    return_tensors="np"
+                )
             
             # Prepare inputs
             inputs = {
@@ -285,16 +319,14 @@ class EmbeddingService:
                 inputs["token_type_ids"] = np.zeros_like(encoded["input_ids"]).astype(np.int64)
             
             # Run inference
-            outputs = self._model.run(None, inputs)
+            with metrics.timer('inference'):
+                outputs = self._model.run(None, inputs)
             embeddings = self._mean_pooling(outputs[0], encoded["attention_mask"])
             
             # Normalize
             norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
             embeddings = embeddings / np.maximum(norms, 1e-9)
 
-        elapsed = time.time() - start
-        # print(f"Encoded {len(texts)} text(s) in {elapsed*1000:.1f}ms")  # Disabled verbose log
-        
         return embeddings[0] if is_single else embeddings
 
     def similarity(self, text1: str, text2: str) -> float:
@@ -308,6 +340,42 @@ class EmbeddingService:
 
         return float(dot / (norm1 * norm2))
 
+    def _create_onnx_session(self, threads: int):
+        providers = ['CPUExecutionProvider']
+        sess_options = ort.SessionOptions()
+        if threads > 0:
+            # Gioi han CPU cho moi process (backfill song song, multi-worker)
+            sess_options.intra_op_num_threads = threads
+            sess_options.inter_op_num_threads = 1
+        return ort.InferenceSession(
+            self._model_bytes,
+            sess_options=sess_options,
+            providers=providers
+        )
+
+    @property
+    def fork_safe(self) -> bool:
+        """ONNX (CPU) co the preload roi fork worker; model HuggingFace tren CUDA thi khong"""
+        return not self._use_huggingface
+
+    def release_session(self):
+        """Master truoc khi fork: bo ONNX session, moi worker tu tao lai trong init_worker"""
+        if not self._use_huggingface:
+            self._model = None
+
+    def init_worker(self, threads: int):
+        """
+        Goi trong worker ngay sau fork: tao lai ONNX session voi thread budget rieng.
+        Thread pool cua session khong ton tai sau fork; model bytes, tokenizer, pyvi
+        va code da import van chia se copy-on-write voi master.
+        """
+        if self._use_huggingface:
+            if threads > 0:
+                import torch
+                torch.set_num_threads(threads)
+            return
+        self._model = self._create_onnx_session(threads)
+
     def get_model_info(self) -> dict:
         """Trả về thông tin model"""
         return {
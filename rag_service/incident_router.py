@@ -5,16 +5,28 @@ Dynamic weights: Use 100% semantic when no multi-field provided
 """
 from typing import Dict, List
 import re
-import datetime
 from collections import defaultdict
 
 from database import db
+from vector_index import local_index
+from prototype_router import department_prototypes
 from embedding_service import embedding_service
 from config import Config
+from metrics import metrics
+from logger import get_logger
+from deadline import Deadline
+
+log = get_logger('router')
 
 MIN_CHARS = 10
 MIN_WORDS = 2
 
+# So ung vien cho Stage 1 (broad search) va nhanh filter theo incident_type
+RETRIEVE_LIMIT = 50
+FILTERED_RETRIEVE_LIMIT = 20
+# Stage 1 khi sap het deadline (bo wide retrieval)
+NARROW_RETRIEVE_LIMIT = 10
+
 
 class IncidentRouter:
     """Router goi y department - Multi-field + Voting (MAX score)"""
@@ -56,70 +68,277 @@ class IncidentRouter:
             return 0.0
         return 1.0 if type1.lower() == type2.lower() else 0.0
 
+    def _retrieve_candidates(self, embedding, incident_type: str = None, deadline: Deadline = None) -> List[Dict]:
+        """
+        Stage 1: broad ANN + (neu co incident_type) filtered ANN push xuong DB.
+        Nhanh filter dam bao cac incident cung loai luon co du top-k,
+        ke ca khi chung bi day ra khoi top 50 chung.
+        Sap het deadline: chi 1 ANN hep (NARROW_RETRIEVE_LIMIT), bo 'wide_retrieval'.
+        """
+        wide = deadline is None or deadline.allows('wide_retrieval', cost_stage='ann')
+        candidates = [
+            dict(c) for c in local_index.find_similar(
+                embedding, limit=RETRIEVE_LIMIT if wide else NARROW_RETRIEVE_LIMIT, deadline=deadline
+            )
+        ]
+
+        incident_type = self._normalize_type(incident_type)
+        if incident_type and wide:
+            seen = {str(c['id']) for c in candidates}
+            same_type = local_index.find_similar(
+                embedding,
+                limit=FILTERED_RETRIEVE_LIMIT,
+                filters={'incident_type': incident_type},
+                deadline=deadline
+            )
+            candidates.extend(dict(c) for c in same_type if str(c['id']) not in seen)
+            candidates.sort(key=lambda c: c['similarity'], reverse=True)
+
+        return candidates
+
     def suggest_department(
         self,
         description: str,
         location: str = None,
         incident_type: str = None,
-        priority: str = None
+        priority: str = None,
+        rerank: bool = True,
+        deadline: Deadline = None
     ) -> Dict:
-        """Goi y department - dung MAX score cua top candidates"""
-        ts = datetime.datetime.now().strftime("%H:%M:%S")
-        desc_log = description[:80].encode('ascii', 'replace').decode('ascii')
-        print(f"\n[{ts}] ========== RAG SUGGESTION ==========")
-        print(f"[{ts}] Desc: {desc_log}...")
-        print(f"[{ts}] Multi-field: loc={location}, type={incident_type}, pri={priority}")
+        """
+        Goi y department - dung MAX score cua top candidates.
+        rerank=False (server qua tai): vote tren cosine similarity, bao 'rerank' trong skipped_stages.
+        deadline: stage tuy chon (wide retrieval, rerank) bi bo qua khi khong du thoi gian,
+        stage bat buoc het gio -> DeadlineExceeded.
+        """
+        log.debug(
+            "suggestion_input", description=(description or '')[:80],
+            location=location, incident_type=incident_type, priority=priority
+        )
 
         # Validate
         is_valid, reason = self._validate_input(description)
         if not is_valid:
-            print(f"[{ts}] REJECTED: {reason}")
-            return {
-                'success': True,
-                'suggestion': None,
-                'similar_incidents': [],
-                'message': f'Mo ta khong hop le: {reason}',
-                'validation_error': reason
-            }
+            log.info("suggestion_rejected", reason=reason)
+            return self._rejected(reason)
 
         # Stage 1: Retrieve (Broad search)
         # Tăng limit lên 50 để Reranker có nhiều ứng viên hơn
-        embedding = embedding_service.encode(description, is_query=True)
-        candidates = db.find_similar(embedding, limit=50)
-        candidates = [dict(c) for c in candidates]
-        print(f"[{ts}] Stage 1: Retrieved {len(candidates)} candidates")
+        skipped: List[str] = []  # stage bo qua do qua tai (deadline tu ghi vao deadline.skipped)
+        embedding = embedding_service.encode(description, is_query=True, deadline=deadline)
+
+        # Fast path: prototype department du chac chan -> bo qua kNN + rerank + voting.
+        # Prototype khong tach theo incident_type -> co type thi di kNN (filter + type bonus)
+        if self._normalize_type(incident_type) is None:
+            prototype = department_prototypes.classify(embedding)
+        else:
+            department_prototypes.record_fallback('incident_type')
+            prototype = None
+        if prototype is not None:
+            return self._with_skipped(self._prototype_result(prototype), skipped, deadline)
+
+        candidates = self._retrieve_candidates(embedding, incident_type, deadline)
 
         if not candidates:
-            return {
-                'success': True,
-                'suggestion': None,
-                'similar_incidents': [],
-                'message': 'Khong tim thay incident tuong tu.'
-            }
+            return self._with_skipped(self._no_candidates(), skipped, deadline)
 
         # Stage 2: Rerank (Precision search)
         candidate_texts = [c['description'] for c in candidates]
         
         # Nếu có Reranker thì dùng, không thì fallback về cosine similarity
-        if hasattr(embedding_service, '_reranker') and embedding_service._reranker:
-            print(f"[{ts}] Stage 2: Reranking with {embedding_service._reranker.config.name_or_path}...")
-            rerank_scores = embedding_service.rerank(description, candidate_texts)
-            
-            # Sigmoid normalization for BGE reranker (scores can be negative)
-            import numpy as np
-            rerank_scores = (1 / (1 + np.exp(-np.array(rerank_scores)))).tolist()
-            
-            # Update scores
-            for i, c in enumerate(candidates):
-                c['similarity'] = rerank_scores[i]
-                
-            # Reranker threshold thường thấp hơn cosine similarity
-            rerank_threshold = 0.5 
+        reranked = self._has_reranker()
+        if reranked and not rerank:
+            reranked = False
+            skipped.append('rerank')
+        elif reranked and deadline is not None and not deadline.allows('rerank'):
+            reranked = False
+
+        if reranked:
+            rerank_scores = self._normalize_rerank(embedding_service.rerank(description, candidate_texts))
         else:
-             # Fallback to cosine similarity
             rerank_scores = [c['similarity'] for c in candidates]
-            rerank_threshold = Config.MIN_SIMILARITY
-            print(f"[{ts}] Stage 2: Using raw similarity scores (No Reranker)")
+
+        result = self._vote(candidates, rerank_scores, location, incident_type, priority, reranked=reranked)
+        return self._with_skipped(result, skipped, deadline)
+
+    def suggest_department_batch(self, items: List[Dict], rerank: bool = True) -> List[Dict]:
+        """
+        Goi y department cho nhieu incident (vd import tu MES):
+        encode 1 lan, ANN 1 round trip, rerank 1 lan predict, voting tung item.
+        items: [{'description', 'location', 'incident_type', 'priority'}].
+        Tra ve ket qua theo thu tu input, item loi co 'success': False va 'error'.
+        """
+        results: List[Dict] = [None] * len(items)
+
+        valid = []
+        for idx, item in enumerate(items):
+            is_valid, reason = self._validate_input(item.get('description'))
+            if is_valid:
+                valid.append(idx)
+            else:
+                results[idx] = self._rejected(reason)
+
+        fast = []
+        if valid:
+            try:
+                descriptions = [items[i]['description'] for i in valid]
+                embeddings = embedding_service.encode(descriptions, is_query=True)
+
+                # Fast path theo prototype cho item khong co incident_type (1 phep nhan ma tran),
+                # con lai -> kNN
+                untyped = [n for n, i in enumerate(valid) if self._normalize_type(items[i].get('incident_type')) is None]
+                prototypes = [None] * len(valid)
+                if untyped:
+                    for n, p in zip(untyped, department_prototypes.classify_batch(embeddings[untyped])):
+                        prototypes[n] = p
+                department_prototypes.record_fallback('incident_type', len(valid) - len(untyped))
+                fast = [(idx, p) for idx, p in zip(valid, prototypes) if p is not None]
+                remaining = [n for n, p in enumerate(prototypes) if p is None]
+                knn = [valid[n] for n in remaining]
+                descriptions = [descriptions[n] for n in remaining]
+
+                candidates_list, scores_list = [], []
+                reranked = rerank and self._has_reranker()
+                if knn:
+                    types = [self._normalize_type(items[i].get('incident_type')) for i in knn]
+                    neighbours = local_index.find_similar_batch(
+                        embeddings[remaining],
+                        limit=RETRIEVE_LIMIT,
+                        incident_types=types,
+                        type_limit=FILTERED_RETRIEVE_LIMIT
+                    )
+                    candidates_list = [[dict(c) for c in rows] for rows in neighbours]
+
+                    if reranked:
+                        texts = [[c['description'] for c in cands] for cands in candidates_list]
+                        scores_list = [
+                            self._normalize_rerank(scores)
+                            for scores in embedding_service.rerank_batch(descriptions, texts)
+                        ]
+                    else:
+                        scores_list = [[c['similarity'] for c in cands] for cands in candidates_list]
+            except Exception as e:
+                log.error("batch_routing_failed", items=len(valid), error=str(e))
+                for idx in valid:
+                    results[idx] = {'success': False, 'error': str(e)}
+                return results
+
+            # Settings/stats auto-assign chi doc 1 lan cho ca batch
+            settings = db.get_rag_settings()
+            stats = db.count_embeddings()
+
+            for idx, prototype in fast:
+                results[idx] = self._prototype_result(prototype, settings=settings, stats=stats)
+
+            for idx, candidates, rerank_scores in zip(knn, candidates_list, scores_list):
+                item = items[idx]
+                try:
+                    if not candidates:
+                        results[idx] = self._no_candidates()
+                        continue
+                    results[idx] = self._with_skipped(self._vote(
+                        candidates, rerank_scores,
+                        item.get('location'), item.get('incident_type'), item.get('priority'),
+                        settings=settings, stats=stats, reranked=reranked
+                    ), [] if reranked or not self._has_reranker() else ['rerank'])
+                except Exception as e:
+                    results[idx] = {'success': False, 'error': str(e)}
+
+        done = sum(1 for r in results if r.get('suggestion'))
+        log.info("batch_suggestion", items=len(items), valid=len(valid), suggested=done, prototype=len(fast))
+        return results
+
+    def _has_reranker(self) -> bool:
+        return hasattr(embedding_service, '_reranker') and bool(embedding_service._reranker)
+
+    def _normalize_rerank(self, scores: List[float]) -> List[float]:
+        """Sigmoid normalization for BGE reranker (scores can be negative)"""
+        import numpy as np
+        return (1 / (1 + np.exp(-np.array(scores)))).tolist()
+
+    def _normalize_type(self, incident_type: str) -> str:
+        if incident_type and str(incident_type).strip():
+            return str(incident_type).strip().lower()
+        return None
+
+    def _with_skipped(self, result: Dict, skipped: List[str], deadline: Deadline = None) -> Dict:
+        """Danh dau stage tuy chon bi bo qua (qua tai hoac het deadline)"""
+        if deadline is not None:
+            skipped = deadline.skipped + [s for s in skipped if s not in deadline.skipped]
+        if skipped:
+            result['skipped_stages'] = list(skipped)
+        return result
+
+    def _prototype_result(self, prototype: Dict, settings: Dict = None, stats: Dict = None) -> Dict:
+        """
+        Ket qua fast path: department tu prototype, khong co similar_incidents (bo qua kNN).
+        confidence = cosine voi centroid, KHONG cung thang do voi confidence cua voting/rerank
+        (nguong auto-assign tune cho voting) -> fast path chi goi y, khong bao gio auto-assign.
+        """
+        confidence = prototype['confidence']
+        name = prototype['department_name']
+        decision = db.should_auto_assign(confidence, settings=settings, stats=stats)
+        decision['auto_assign'] = False
+        decision['reasons'] = ["Prototype route: centroid similarity is not calibrated for auto-assign"]
+        metrics.auto_assign_decisions.inc(decision='suggest')
+        log.info(
+            "suggestion", department=name, confidence=round(confidence, 4),
+            margin=round(prototype['margin'], 4), samples=prototype['samples'], path='prototype'
+        )
+        return {
+            'success': True,
+            'suggestion': {
+                'department_id': prototype['department_id'],
+                'department_name': name,
+                'confidence': confidence,
+                'vote_count': 0,
+                'prototype_samples': prototype['samples'],
+                'auto_assign': False
+            },
+            'similar_incidents': [],
+            'message': f'Goi y: {name} ({confidence*100:.0f}%)',
+            'auto_assign_info': decision,
+            'department_scores': {
+                dept_name: {'score': score} for dept_name, score in prototype['scores'].items()
+            },
+            'route': 'prototype'
+        }
+
+    def _rejected(self, reason: str) -> Dict:
+        return {
+            'success': True,
+            'suggestion': None,
+            'similar_incidents': [],
+            'message': f'Mo ta khong hop le: {reason}',
+            'validation_error': reason
+        }
+
+    def _no_candidates(self) -> Dict:
+        return {
+            'success': True,
+            'suggestion': None,
+            'similar_incidents': [],
+            'message': 'Khong tim thay incident tuong tu.'
+        }
+
+    @metrics.timed('scoring')
+    def _vote(
+        self,
+        candidates: List[Dict],
+        rerank_scores: List[float],
+        location: str = None,
+        incident_type: str = None,
+        priority: str = None,
+        settings: Dict = None,
+        stats: Dict = None,
+        reranked: bool = False
+    ) -> Dict:
+        """Stage 3-4: multi-field scoring + voting tren candidates (reranked: score tu reranker)"""
+        # Reranker threshold thường thấp hơn cosine similarity
+        rerank_threshold = 0.5 if reranked else Config.MIN_SIMILARITY
+        if reranked:
+            for i, c in enumerate(candidates):
+                c['similarity'] = rerank_scores[i]
 
         # Stage 3: Multi-field scoring - Dynamic weights
         # If no multi-field data provided, use 100% semantic score
@@ -149,7 +368,10 @@ class IncidentRouter:
                 W_TYPE /= total_weight
                 W_PRIORITY /= total_weight
         
-        print(f"[{ts}] Weights: SEM={W_SEMANTIC:.2f}, LOC={W_LOCATION:.2f}, TYPE={W_TYPE:.2f}, PRI={W_PRIORITY:.2f}")
+        log.debug(
+            "routing_weights", semantic=round(W_SEMANTIC, 2), location=round(W_LOCATION, 2),
+            type=round(W_TYPE, 2), priority=round(W_PRIORITY, 2)
+        )
 
         for i, c in enumerate(candidates):
             c['rerank_score'] = float(rerank_scores[i])
@@ -171,7 +393,8 @@ class IncidentRouter:
         # Filter by rerank threshold
         valid_candidates = [c for c in candidates if c['rerank_score'] >= rerank_threshold]
         if not valid_candidates:
-            print(f"[{ts}] ALL REJECTED")
+            log.info("suggestion_none", candidates=len(candidates), threshold=rerank_threshold)
+            metrics.auto_assign_decisions.inc(decision='none')
             return {
                 'success': True,
                 'suggestion': None,
@@ -201,9 +424,13 @@ class IncidentRouter:
             # Average of top 3 (or less if fewer)
             dept_max_scores[dept_id] = sum(top_scores) / len(top_scores)
 
-        print(f"[{ts}] Department Scores (max of top 3):")
-        for did, score in sorted(dept_max_scores.items(), key=lambda x: x[1], reverse=True)[:3]:
-            print(f"[{ts}]   {dept_info[did]['department_name']}: {score:.4f} ({len(dept_scores[did])} votes)")
+        log.debug("department_scores", scores=[
+            {'department': dept_info[did]['department_name'], 'score': round(score, 4), 'votes': len(dept_scores[did])}
+            for did, score in sorted(dept_max_scores.items(), key=lambda x: x[1], reverse=True)
+        ], candidates=[
+            {'id': str(c.get('id')), 'rerank': round(c['rerank_score'], 4), 'final': round(c['final_score'], 4)}
+            for c in valid_candidates
+        ])
 
         # Select best
         best_dept_id = max(dept_max_scores, key=dept_max_scores.get)
@@ -211,12 +438,15 @@ class IncidentRouter:
         best_name = dept_info[best_dept_id]['department_name']
         vote_count = len(dept_scores[best_dept_id])
 
-        decision = db.should_auto_assign(best_score)
+        decision = db.should_auto_assign(best_score, settings=settings, stats=stats)
         auto_assign = decision['auto_assign']
+        metrics.auto_assign_decisions.inc(decision='auto' if auto_assign else 'suggest')
 
-        print(f"[{ts}] SUGGESTED: {best_name} ({best_score*100:.1f}%)")
-        print(f"[{ts}] AUTO_ASSIGN: {'YES' if auto_assign else 'NO'}")
-        print(f"[{ts}] =====================================\n")
+        log.info(
+            "suggestion", department=best_name, confidence=round(best_score, 4), votes=vote_count,
+            auto_assign=auto_assign, candidates=len(candidates), valid_candidates=len(valid_candidates),
+            reranker=reranked
+        )
 
         if auto_assign:
             msg = f'Tu dong gan: {best_name} ({best_score*100:.0f}%)'
@@ -243,12 +473,12 @@ class IncidentRouter:
 
     def find_similar_incidents(self, description: str, limit: int = 5) -> Dict:
         embedding = embedding_service.encode(description, is_query=True)
-        similar = db.find_similar(embedding, limit=limit)
+        similar = local_index.find_similar(embedding, limit=limit)
         return {'success': True, 'count': len(similar), 'incidents': [dict(s) for s in similar]}
 
     def auto_fill_form(self, description: str) -> Dict:
         embedding = embedding_service.encode(description, is_query=True)
-        similar = db.find_similar(embedding, limit=1)
+        similar = local_index.find_similar(embedding, limit=1)
         if not similar:
             return {'success': True, 'suggestions': {}, 'confidence': 0.0, 'reference_incident_id': None}
         best = similar[0]
@@ -0,0 +1,334 @@
+"""
+Job Queue
+Chay cac tac vu dai (backfill embeddings, generate ideas embeddings) tren executor rieng
+
+- Endpoint enqueue job va tra ve job_id ngay, khong giu worker/request
+- Theo doi tien do: done/failed/total, throughput, ETA
+- Huy job (cooperative: job kiem tra job.cancelled giua cac batch)
+- Trang thai job luu trong Postgres (rag_jobs): moi worker cua prefork server deu tra loi
+  duoc /jobs/{id}, huy duoc job dang chay o worker khac (qua heartbeat)
+- Single-flight theo key o muc database (unique index tren job dang chay):
+  2 admin khong the chay cung 1 backfill, ke ca khi request roi vao 2 worker khac nhau.
+  Worker chet -> heartbeat cu qua JOB_STALE_SECONDS -> key duoc giai phong
+- Ket qua tung item (job.emit) giu trong buffer gioi han cua worker chay job de stream NDJSON
+"""
+import os
+import time
+import uuid
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import Config
+from database import db
+from logger import get_logger
+
+log = get_logger('jobs')
+
+ACTIVE_STATUSES = ('queued', 'running')
+# So ket qua item toi da giu trong bo nho moi job (client stream cham hon se bi bao 'gap')
+EVENT_BUFFER_SIZE = 10000
+
+
+class JobConflictError(Exception):
+    """Da co job cung key dang chay (o worker nay hoac worker khac)"""
+
+    def __init__(self, key: str, status: str, job_id: str):
+        super().__init__(f"Job '{key}' is already {status} ({job_id})")
+        self.key = key
+        self.status = status
+        self.job_id = job_id
+
+
+class JobCancelled(Exception):
+    """Raise ben trong job khi bi huy"""
+
+
+class Job:
+    """Trang thai 1 job - cap nhat tu executor thread, doc tu event loop"""
+
+    def __init__(self, kind: str, key: str, params: Dict):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.key = key
+        self.params = params
+        self.status = 'queued'
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.total: Optional[int] = None
+        self.done = 0
+        self.failed = 0
+        self.result = None
+        self.error: Optional[str] = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._events = deque(maxlen=EVENT_BUFFER_SIZE)
+        self._event_seq = 0
+
+    # === Goi tu ben trong job ===
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    def set_total(self, total: int):
+        self.total = total
+
+    def report(self, done: int = 0, failed: int = 0):
+        """Cong them so item da xu ly (delta)"""
+        with self._lock:
+            self.done += done
+            self.failed += failed
+
+    def emit(self, records: List[Dict]):
+        """Ghi ket qua tung item (cho GET /jobs/{id}/stream)"""
+        with self._lock:
+            for record in records:
+                self._event_seq += 1
+                self._events.append((self._event_seq, record))
+
+    def events_after(self, seq: int) -> Tuple[List[Dict], int, int]:
+        """Item co so thu tu > seq. Tra ve (records, so item bi mat do buffer day, seq moi)"""
+        with self._lock:
+            new = [(s, r) for s, r in self._events if s > seq]
+            first = new[0][0] if new else self._event_seq + 1
+            return [r for _, r in new], max(0, first - seq - 1), self._event_seq
+
+    @property
+    def finished(self) -> bool:
+        return self.status not in ACTIVE_STATUSES
+
+    # === Trang thai ===
+    def to_dict(self) -> Dict:
+        now = self.finished_at or time.time()
+        elapsed = now - self.started_at if self.started_at else 0.0
+        finished = self.done + self.failed
+        throughput = finished / elapsed if elapsed > 0 else 0.0
+
+        eta = None
+        if self.status == 'running' and self.total and throughput > 0:
+            eta = max(self.total - finished, 0) / throughput
+
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'params': self.params,
+            'total': self.total,
+            'done': self.done,
+            'failed': self.failed,
+            'percentage': round(finished * 100 / self.total, 1) if self.total else None,
+            'throughput_per_second': round(throughput, 2),
+            'elapsed_seconds': round(elapsed, 1),
+            'eta_seconds': round(eta, 1) if eta is not None else None,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'cancel_requested': self.cancelled,
+            'result': self.result,
+            'error': self.error,
+        }
+
+
+def job_dict_from_row(row: Dict) -> Dict:
+    """Trang thai job doc tu rag_jobs (job cua worker khac), cung dang voi Job.to_dict"""
+    status = row['status']
+    if status in ACTIVE_STATUSES and row['heartbeat_age'] > Config.JOB_STALE_SECONDS:
+        status = 'interrupted'  # Worker chay job da chet
+    started_at = row['started_at']
+    finished_at = row['finished_at']
+    now = finished_at or time.time()
+    elapsed = now - started_at if started_at else 0.0
+    done, failed, total = row['done'] or 0, row['failed'] or 0, row['total']
+    finished = done + failed
+    throughput = finished / elapsed if elapsed > 0 else 0.0
+
+    eta = None
+    if status == 'running' and total and throughput > 0:
+        eta = max(total - finished, 0) / throughput
+
+    return {
+        'job_id': row['id'],
+        'kind': row['kind'],
+        'status': status,
+        'params': row['params'],
+        'total': total,
+        'done': done,
+        'failed': failed,
+        'percentage': round(finished * 100 / total, 1) if total else None,
+        'throughput_per_second': round(throughput, 2),
+        'elapsed_seconds': round(elapsed, 1),
+        'eta_seconds': round(eta, 1) if eta is not None else None,
+        'created_at': row['created_at'],
+        'started_at': started_at,
+        'finished_at': finished_at,
+        'cancel_requested': row['cancel_requested'],
+        'result': row['result'],
+        'error': row['error'],
+    }
+
+
+class JobRunner:
+    """Executor rieng cho job nen - tach khoi threadpool phuc vu request"""
+
+    def __init__(self, max_workers: int = None, history: int = 100):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or Config.JOB_WORKERS,
+            thread_name_prefix="rag-job"
+        )
+        self._jobs: 'OrderedDict[str, Job]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._history = history
+        self._heartbeat: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def submit(self, kind: str, fn: Callable, key: str = None, **params) -> Job:
+        """
+        Enqueue job. fn(job, **params) co the la ham thuong hoac coroutine.
+        Raise JobConflictError neu da co job cung key dang queued/running (o bat ky worker nao).
+        """
+        key = key or kind
+        job = Job(kind, key, params)
+        created, row = db.create_job(job.id, kind, key, params, os.getpid(), Config.JOB_STALE_SECONDS)
+        if not created:
+            if row is None:
+                # Job kia vua xong giua INSERT va SELECT -> thu lai 1 lan
+                return self.submit(kind, fn, key=key, **params)
+            raise JobConflictError(key, row['status'], str(row['id']))
+
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim_history()
+        self._ensure_heartbeat()
+
+        self._executor.submit(self._run, job, fn)
+        return job
+
+    def _run(self, job: Job, fn: Callable):
+        if job.cancelled:
+            self._finish(job, 'cancelled')
+            return
+
+        job.status = 'running'
+        job.started_at = time.time()
+        try:
+            if asyncio.iscoroutinefunction(fn):
+                # Job async (vd goi LLM) chay tren event loop rieng cua executor thread
+                job.result = asyncio.run(fn(job, **job.params))
+            else:
+                job.result = fn(job, **job.params)
+            self._finish(job, 'cancelled' if job.cancelled else 'completed')
+        except JobCancelled:
+            self._finish(job, 'cancelled')
+        except Exception as e:
+            job.error = str(e)
+            log.error("job_failed", job_id=job.id, kind=job.kind, error=str(e), exc_info=True)
+            self._finish(job, 'failed')
+
+    def _finish(self, job: Job, status: str):
+        job.status = status
+        job.finished_at = time.time()
+        try:
+            db.finish_job(job.id, status, job.total, job.done, job.failed, job.result, job.error)
+        except Exception as e:
+            # Khong ghi duoc -> heartbeat ngung, job bi coi la 'interrupted' sau JOB_STALE_SECONDS
+            log.error("job_finish_persist_failed", job_id=job.id, error=str(e))
+
+    # === Heartbeat: tien do -> Postgres, nhan yeu cau huy tu worker khac ===
+    def _ensure_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is None or not self._heartbeat.is_alive():
+                self._heartbeat = threading.Thread(target=self._heartbeat_loop, name="rag-job-heartbeat", daemon=True)
+                self._heartbeat.start()
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(Config.JOB_HEARTBEAT_INTERVAL):
+            active = [j for j in list(self._jobs.values()) if j.status in ACTIVE_STATUSES]
+            if not active:
+                continue
+            try:
+                cancelled = db.heartbeat_jobs([
+                    {'id': j.id, 'status': j.status, 'total': j.total, 'done': j.done,
+                     'failed': j.failed, 'started_at': j.started_at}
+                    for j in active
+                ])
+            except Exception as e:
+                log.error("job_heartbeat_failed", jobs=len(active), error=str(e))
+                continue
+            for job_id in cancelled:
+                job = self._jobs.get(job_id)
+                if job is not None:
+                    job._cancel.set()
+
+    def _trim_history(self):
+        """Giu toi da `history` job da xong trong bo nho (Postgres giu lich su day du)"""
+        while len(self._jobs) > self._history:
+            oldest_id = next(
+                (jid for jid, j in self._jobs.items() if j.status not in ACTIVE_STATUSES),
+                None
+            )
+            if oldest_id is None:
+                break
+            del self._jobs[oldest_id]
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Job chay tren worker nay (co buffer ket qua tung item), None neu o worker khac"""
+        return self._jobs.get(job_id)
+
+    def get_dict(self, job_id: str) -> Optional[Dict]:
+        """Trang thai job: ban song neu chay o worker nay, nguoc lai doc tu Postgres"""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        try:
+            uuid.UUID(job_id)
+        except ValueError:
+            return None
+        row = db.get_job(job_id)
+        return job_dict_from_row(row) if row else None
+
+    def list(self, kind: str = None) -> List[Dict]:
+        """Job moi nhat truoc, tren moi worker"""
+        return [
+            self._jobs[row['id']].to_dict() if row['id'] in self._jobs else job_dict_from_row(row)
+            for row in db.list_jobs(kind, limit=self._history)
+        ]
+
+    def cancel(self, job_id: str) -> Optional[Dict]:
+        job = self._jobs.get(job_id)
+        if job is not None and job.status in ACTIVE_STATUSES:
+            job._cancel.set()
+        try:
+            uuid.UUID(job_id)
+        except ValueError:
+            return None
+        # Job o worker khac: worker do thay cancel_requested o heartbeat tiep theo
+        row = db.request_job_cancel(job_id)
+        if job is not None:
+            return job.to_dict()
+        return job_dict_from_row(row) if row else None
+
+    def queue_depth(self) -> int:
+        return sum(1 for j in self._jobs.values() if j.status == 'queued')
+
+    def shutdown(self):
+        """Huy cac job dang chay va doi executor dung"""
+        for job in list(self._jobs.values()):
+            if job.status in ACTIVE_STATUSES:
+                job._cancel.set()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._stop.set()
+        # Job con trong hang doi bi huy truoc khi chay -> giai phong key trong Postgres
+        for job in list(self._jobs.values()):
+            if job.status in ACTIVE_STATUSES:
+                self._finish(job, 'cancelled')
+
+
+# Singleton instance
+job_runner = JobRunner()
@@ -0,0 +1,141 @@
+"""
+LLM Agreement
+Do muc do khop giua stripper cuc bo (BoilerplateStripper) va ket qua LLM tren ideas da luu
+
+- Moi idea: chay stripper; van ban chac chan (local) duoc so voi ket qua LLM cua cung text
+- Ket qua LLM lay tu cache rag_llm_extractions (khong tang hits); --call-llm goi Mistral
+  cho text chua co trong cache (ket qua duoc cache lai)
+- Khop = do giong chuoi (difflib) >= --threshold; --embed do them cosine embedding
+  (anh huong thuc te toi check-duplicate)
+- In coverage (ty le xu ly cuc bo), ly do chuyen LLM va cac truong hop lech nhieu nhat
+
+Chay:
+    python llm_agreement.py --limit 500
+    python llm_agreement.py --limit 200 --call-llm --embed --show 20
+"""
+import time
+import argparse
+import difflib
+from collections import Counter
+
+import numpy as np
+
+from database import db
+from query_cache import normalize_query
+from llm_extractor import (
+    boilerplate_stripper, extraction_cache, extract_core_issue_sync,
+    LLM_EXTRACT_ENABLED, MISTRAL_API_KEY
+)
+
+PAGE_SIZE = 200
+
+
+def iter_ideas(limit: int):
+    after_id = None
+    seen = 0
+    while seen < limit:
+        rows = db.get_records_after('ideas', after_id, min(PAGE_SIZE, limit - seen), only_missing=False)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        seen += len(rows)
+        after_id = rows[-1]['id']
+
+
+def llm_reference(text: str, call_llm: bool):
+    """Ket qua LLM cho text: cache truoc, goi LLM neu duoc phep. None neu khong co"""
+    row = db.get_llm_extraction(extraction_cache.key(text), touch=False)
+    if row is not None:
+        return row['extracted']
+    if call_llm:
+        extracted = extract_core_issue_sync(text, local_first=False)
+        # Loi/khong hop le -> extract tra ve nguyen van, khong dung lam tham chieu
+        return extracted if extracted != text else None
+    return None
+
+
+def similarity(a: str, b: str) -> float:
+    a = normalize_query(a).lower().rstrip(' .')
+    b = normalize_query(b).lower().rstrip(' .')
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Agreement between the local boilerplate stripper and LLM extraction")
+    parser.add_argument('--limit', type=int, default=500, help="So ideas toi da")
+    parser.add_argument('--call-llm', action='store_true',
+                        help="Goi LLM cho text chua co trong cache (mac dinh chi dung cache)")
+    parser.add_argument('--threshold', type=float, default=0.9, help="Do giong toi thieu de tinh la khop")
+    parser.add_argument('--embed', action='store_true', help="Do them cosine giua embedding 2 ket qua")
+    parser.add_argument('--show', type=int, default=10, help="So truong hop lech nhieu nhat can in")
+    args = parser.parse_args()
+
+    if args.call_llm and (not LLM_EXTRACT_ENABLED or not MISTRAL_API_KEY):
+        parser.error("--call-llm can MISTRAL_API_KEY va LLM_EXTRACT_ENABLED=true")
+
+    total = 0
+    reasons = Counter()
+    pairs = []  # (similarity, local, llm, text)
+    no_reference = 0
+    strip_seconds = 0.0
+
+    for row in iter_ideas(args.limit):
+        text = row['text']
+        total += 1
+        start = time.perf_counter()
+        local, reason = boilerplate_stripper.strip(text)
+        strip_seconds += time.perf_counter() - start
+        if reason is not None:
+            reasons[reason] += 1
+            continue
+
+        reference = llm_reference(text, args.call_llm)
+        if reference is None:
+            no_reference += 1
+            continue
+        pairs.append((similarity(local, reference), local, reference, text))
+
+    if not total:
+        print("Khong co idea nao")
+        return
+
+    local_count = total - sum(reasons.values())
+    print(f"\nIdeas: {total}")
+    print(f"  - Xu ly cuc bo: {local_count} ({local_count / total:.1%}), "
+          f"trung binh {strip_seconds / total * 1e6:.0f}us/text")
+    for reason, count in reasons.most_common():
+        print(f"  - Chuyen LLM ({reason}): {count}")
+
+    if not pairs:
+        print(f"\nKhong co ket qua LLM de so sanh ({no_reference} text chua co trong cache, thu --call-llm)")
+        return
+
+    scores = np.array([p[0] for p in pairs])
+    agree = int((scores >= args.threshold).sum())
+    print(f"\nSo voi LLM: {len(pairs)} text (bo qua {no_reference} chua co ket qua LLM)")
+    print(f"  - Khop (>= {args.threshold}): {agree} ({agree / len(pairs):.1%})")
+    print(f"  - Trung khop hoan toan: {int((scores >= 0.999).sum())}")
+    print(f"  - Do giong: mean={scores.mean():.3f}, p10={np.percentile(scores, 10):.3f}, min={scores.min():.3f}")
+
+    if args.embed:
+        from embedding_service import embedding_service
+        local_emb = embedding_service.encode([p[1] for p in pairs])
+        llm_emb = embedding_service.encode([p[2] for p in pairs])
+        cosines = np.sum(local_emb * llm_emb, axis=1) / (
+            np.linalg.norm(local_emb, axis=1) * np.linalg.norm(llm_emb, axis=1)
+        )
+        print(f"  - Cosine embedding: mean={cosines.mean():.4f}, p10={np.percentile(cosines, 10):.4f}, "
+              f"min={cosines.min():.4f}")
+
+    worst = sorted(pairs, key=lambda p: p[0])[:args.show]
+    if worst:
+        print("\nLech nhieu nhat:")
+    for score, local, reference, text in worst:
+        print(f"\n  [{score:.2f}] {text[:120]}")
+        print(f"    local: {local[:120]}")
+        print(f"    llm:   {reference[:120]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,68 @@
 """
 LLM Extractor - Sử dụng Mistral AI để trích xuất vấn đề chính từ nội dung
 Loại bỏ các phần "mong xem xét", "kính đề nghị", "xin kiểm tra"...
+
+Fast path: câu chào/đề nghị/cảm ơn khuôn mẫu được tách cục bộ bằng regex (BoilerplateStripper),
+chỉ văn bản không rõ ràng mới gọi LLM.
 """
 import os
+import re
+import time
+import random
+import atexit
+import asyncio
+import hashlib
+import threading
+import unicodedata
+import weakref
+import concurrent.futures
 import httpx
-from typing import Optional
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from metrics import metrics
+from query_cache import normalize_query
+from logger import get_logger
+
+log = get_logger('llm')
 
 # Config
 MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY", "")
 MISTRAL_MODEL = os.getenv("MISTRAL_MODEL", "mistral-large-latest")
+MISTRAL_API_URL = os.getenv("MISTRAL_API_URL", "https://api.mistral.ai/v1/chat/completions")
 LLM_EXTRACT_ENABLED = os.getenv("LLM_EXTRACT_ENABLED", "true").lower() == "true"
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "5000"))
+LLM_LOCAL_STRIP_ENABLED = os.getenv("LLM_LOCAL_STRIP_ENABLED", "true").lower() == "true"
+LLM_LOCAL_MAX_CHARS = int(os.getenv("LLM_LOCAL_MAX_CHARS", "500"))
+# Timeout rieng: request tuong tac (/check-duplicate, /ideas/index) ngan, bulk indexing dai
+LLM_INTERACTIVE_TIMEOUT = float(os.getenv("LLM_INTERACTIVE_TIMEOUT", "5"))
+LLM_BULK_TIMEOUT = float(os.getenv("LLM_BULK_TIMEOUT", "30"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "10"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "true").lower() == "true"
+# Bulk extraction (index nhieu ideas): song song, gioi han toc do, retry khi 429/5xx
+LLM_BULK_CONCURRENCY = int(os.getenv("LLM_BULK_CONCURRENCY", "8"))
+LLM_BULK_RATE = float(os.getenv("LLM_BULK_RATE", "5"))
+LLM_BULK_BURST = int(os.getenv("LLM_BULK_BURST", "10"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "20"))
+
+# Circuit breaker: mo sau N loi lien tiep, thu lai (half-open) sau RESET giay
+LLM_BREAKER_ENABLED = os.getenv("LLM_BREAKER_ENABLED", "true").lower() == "true"
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# HTTP/2 can package h2 (pip install httpx[http2]), khong co thi dung HTTP/1.1 keep-alive
+try:
+    import h2  # noqa: F401
+    HAS_H2 = True
+except ImportError:
+    HAS_H2 = False
 
 # Prompt để extract vấn đề chính
 EXTRACT_PROMPT = """Bạn là AI chuyên trích xuất vấn đề/ý tưởng chính từ văn bản tiếng Việt.
@@ -37,79 +90,738 @@ Output: "Thêm quạt mát cho xưởng sản xuất vì trời nóng"
 Bây giờ xử lý văn bản sau:
 """
 
+# Doi prompt -> version moi -> cache cu tu dong khong con khop
+PROMPT_VERSION = hashlib.sha256(EXTRACT_PROMPT.encode('utf-8')).hexdigest()[:12]
+
+# Version embedding cua idea (ideas.embedding_version): text goc hoac text da extract voi prompt hien tai
+EMBEDDING_VERSION_RAW = 'raw'
+EMBEDDING_VERSION_EXTRACTED = f'extracted:{PROMPT_VERSION}'
+
+
+def embedding_text_hash(text: str) -> str:
+    """Hash text goc cua embedding idea (ideas.embedding_text_hash) - moi noi ghi embedding ideas deu dat"""
+    return hashlib.sha256(normalize_query(text).encode('utf-8')).hexdigest()[:16]
+
+
+# === Stripper cuc bo (fast path) ===
+# Cau (hoac menh de) ket thuc bang dau cau / xuong dong; giu nguyen dau cau de ghep lai dung nhu goc
+_SENTENCE = re.compile(r'[^.!?;\n]+[.!?;\n]*')
+# Loi chao dau van ban, ket thuc o dau cau dau tien: "Kinh gui ban lanh dao, ..."
+_GREETING = re.compile(
+    r'^\s*(?:kính\s+gửi|kính\s+thưa|thưa|gửi\s+(?:đến|tới))\b[^,.:;!?\n]{0,80}[,.:;!?\n]\s*',
+    re.IGNORECASE
+)
+# Cau cam on / ket thu
+_CLOSING = re.compile(
+    r'^\s*(?:(?:xin|em|chúng\s+em|chúng\s+tôi|tôi)\s+)?(?:(?:chân\s+thành|trân\s+trọng)\s+)?(?:cảm|cám)\s+ơn\b'
+    r'|^\s*trân\s+trọng\b',
+    re.IGNORECASE
+)
+# Cau mo dau bang loi de nghi: "Mong ...", "Kinh de nghi ...", "Xin xem xet ...", "De xuat ..."
+_REQUEST_LEAD = re.compile(
+    r'^\s*(?:(?:em|chúng\s+em|chúng\s+tôi|tôi|rất|kính|xin)\s+)*'
+    r'(?:mong\s+muốn|mong|đề\s+nghị|đề\s+xuất|kiến\s+nghị|xin)\b\s*',
+    re.IGNORECASE
+)
+# Sau loi de nghi la nguoi nhan / hanh dong xem xet -> khong tach duoc noi dung chac chan
+_REQUEST_OBJECT = re.compile(
+    r'^(?:ban\s+lãnh\s+đạo|lãnh\s+đạo|ban\s+giám\s+đốc|công\s+ty|công\s+đoàn|cấp\s+trên|quý\s+\w+'
+    r'|(?:các\s+)?anh\s+chị|phòng\s+\w+|bộ\s+phận\s+\w+|xem\s+xét|kiểm\s+tra\s+lại|giải\s+quyết|xử\s+lý)\b',
+    re.IGNORECASE
+)
+# Menh de de nghi o cuoi cau noi dung: "May nong qua, mong ban lanh dao xem xet."
+_TRAILING_REQUEST = re.compile(
+    r'\s*,\s*(?:(?:rất|kính|xin|em|chúng\s+em|chúng\s+tôi)\s+)*(?:mong|đề\s+nghị|kiến\s+nghị|xin)\b[^.!?;\n]*',
+    re.IGNORECASE
+)
+# Con sot cum tu khuon mau sau khi tach -> de LLM xu ly
+_RESIDUAL_MARKER = re.compile(
+    r'\b(?:kính\s+gửi|kính\s+thưa|đề\s+nghị|xem\s+xét|(?:cảm|cám)\s+ơn|trân\s+trọng'
+    r'|mong\s+(?:ban|công|cấp|quý|anh|các|lãnh))\b',
+    re.IGNORECASE
+)
+CLOSING_MAX_CHARS = 60
+MIN_RESULT_WORDS = 3
+
+
+class BoilerplateStripper:
+    """
+    Tach loi chao / de nghi / cam on khuon mau bang regex bien dich san (micro giay, khong goi mang).
+    strip() tra ve (text, reason): reason=None -> ket qua chac chan, dung luon;
+    reason != None -> van ban khong ro rang, can LLM.
+    """
+
+    def __init__(self, enabled: bool = None, max_chars: int = None):
+        self.enabled = LLM_LOCAL_STRIP_ENABLED if enabled is None else enabled
+        self.max_chars = max_chars or LLM_LOCAL_MAX_CHARS
+        self._lock = threading.Lock()
+        self._local = 0
+        self._ambiguous: Dict[str, int] = {}
+
+    def strip(self, text: str) -> Tuple[str, Optional[str]]:
+        if len(text) > self.max_chars:
+            return text, 'too_long'
+
+        normalized = unicodedata.normalize('NFC', text)
+        kept = []
+        changed = False
+        for index, match in enumerate(_SENTENCE.finditer(normalized)):
+            sentence = match.group(0)
+            if index == 0:
+                greeting = _GREETING.match(sentence)
+                if greeting:
+                    sentence = sentence[greeting.end():]
+                    changed = True
+                    if not sentence.strip():
+                        continue
+
+            if _CLOSING.match(sentence):
+                if len(sentence.strip()) > CLOSING_MAX_CHARS:
+                    return text, 'long_closing'
+                changed = True
+                continue
+
+            lead = _REQUEST_LEAD.match(sentence)
+            if lead:
+                changed = True
+                if any(part.strip() for part in kept):
+                    # Noi dung da co phia truoc -> ca cau la loi de nghi
+                    continue
+                rest = sentence[lead.end():]
+                if _REQUEST_OBJECT.match(rest):
+                    return text, 'request_with_recipient'
+                sentence = rest
+
+            trimmed = _TRAILING_REQUEST.sub('', sentence)
+            if trimmed != sentence:
+                changed = True
+                sentence = trimmed
+            kept.append(sentence)
+
+        if not changed:
+            if _RESIDUAL_MARKER.search(normalized):
+                return text, 'residual_marker'
+            return text, None
+
+        result = ' '.join(''.join(kept).split()).rstrip(' .;,')
+        if _RESIDUAL_MARKER.search(result):
+            return text, 'residual_marker'
+        if len(result.split()) < MIN_RESULT_WORDS:
+            return text, 'too_short'
+        return result[:1].upper() + result[1:], None
+
+    def try_local(self, text: str) -> Optional[str]:
+        """Ket qua cuc bo neu chac chan, None neu can LLM (ghi metrics theo ly do)"""
+        start = time.perf_counter()
+        result, reason = self.strip(text)
+        metrics.record('llm_local_strip', time.perf_counter() - start)
+
+        with self._lock:
+            if reason is None:
+                self._local += 1
+            else:
+                self._ambiguous[reason] = self._ambiguous.get(reason, 0) + 1
+        if reason is None:
+            metrics.llm_fastpath.inc(outcome='local')
+            return result
+        metrics.llm_fastpath.inc(outcome='llm', reason=reason)
+        return None
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            ambiguous = sum(self._ambiguous.values())
+            total = self._local + ambiguous
+            return {
+                'enabled': self.enabled,
+                'max_chars': self.max_chars,
+                'local': self._local,
+                'ambiguous': dict(self._ambiguous),
+                'local_ratio': round(self._local / total, 4) if total else 0.0,
+            }
+
+
+# Singleton instance
+boilerplate_stripper = BoilerplateStripper()
+
+
+# database import tre (trong thread cua to_thread): import database la mo connection,
+# module nay phai load duoc khi khong co Postgres (test stub server, tool offline)
+def _read_extraction(key: str) -> Optional[Dict]:
+    from database import db
+    return db.get_llm_extraction(key)
+
+
+def _save_extraction(key: str, extracted: str, latency_ms: float):
+    from database import db
+    db.save_llm_extraction(key, MISTRAL_MODEL, PROMPT_VERSION, extracted, latency_ms)
+
+
+class ExtractionCache:
+    """
+    Cache ket qua extract: LRU trong RAM phia truoc bang Postgres rag_llm_extractions.
+    Key = sha256(model + prompt version + text da chuan hoa) -> doi model/prompt tu dong miss.
+    Chi cache ket qua LLM hop le (khong cache fallback khi loi/disabled).
+    """
+
+    def __init__(self, max_entries: int = None, enabled: bool = None):
+        self.enabled = LLM_CACHE_ENABLED if enabled is None else enabled
+        self.max_entries = max_entries or LLM_CACHE_MEMORY_ENTRIES
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()  # key -> (extracted, latency_ms)
+        self._lock = threading.Lock()
+        self._memory_hits = 0
+        self._db_hits = 0
+        self._misses = 0
+        self._saved_seconds = 0.0
+
+    @staticmethod
+    def key(text: str) -> str:
+        raw = f"{MISTRAL_MODEL}\x00{PROMPT_VERSION}\x00{normalize_query(text)}"
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._memory_hits += 1
+        if entry is not None:
+            self._record_hit(entry[1])
+            return entry[0]
+
+        try:
+            row = await asyncio.to_thread(_read_extraction, key)
+        except Exception as e:
+            log.warning("llm_cache_read_failed", error=str(e))
+            row = None
+
+        if row is None:
+            with self._lock:
+                self._misses += 1
+            metrics.cache_result('llm_extraction', hit=False)
+            return None
+
+        with self._lock:
+            self._db_hits += 1
+        self._remember(key, row['extracted'], row['latency_ms'])
+        self._record_hit(row['latency_ms'])
+        return row['extracted']
+
+    async def set(self, key: str, extracted: str, latency_ms: float):
+        if not self.enabled:
+            return
+        self._remember(key, extracted, latency_ms)
+        try:
+            await asyncio.to_thread(_save_extraction, key, extracted, latency_ms)
+        except Exception as e:
+            log.warning("llm_cache_write_failed", error=str(e))
+
+    def _remember(self, key: str, extracted: str, latency_ms: float):
+        with self._lock:
+            self._entries[key] = (extracted, latency_ms)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _record_hit(self, latency_ms: float):
+        saved = (latency_ms or 0.0) / 1000
+        with self._lock:
+            self._saved_seconds += saved
+        metrics.cache_result('llm_extraction', hit=True)
+        metrics.llm_latency_saved.inc(saved)
 
-async def extract_core_issue(text: str) -> str:
+    def get_stats(self) -> Dict:
+        with self._lock:
+            hits = self._memory_hits + self._db_hits
+            lookups = hits + self._misses
+            return {
+                'enabled': self.enabled,
+                'prompt_version': PROMPT_VERSION,
+                'memory_entries': len(self._entries),
+                'memory_hits': self._memory_hits,
+                'db_hits': self._db_hits,
+                'misses': self._misses,
+                'hit_ratio': round(hits / lookups, 4) if lookups else 0.0,
+                'latency_saved_seconds': round(self._saved_seconds, 3),
+            }
+
+
+# Singleton instance
+extraction_cache = ExtractionCache()
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker cho LLM endpoint (dung chung moi event loop -> thread-safe).
+    - closed: goi binh thuong; failure_threshold loi lien tiep (timeout, loi mang, 429/5xx) -> open
+    - open: khong goi LLM, extract tra fallback ngay; sau reset_seconds -> half_open
+    - half_open: cho 1 request thu (probe); thanh cong -> closed, loi -> open lai.
+      Probe treo qua probe_timeout thi cho probe khac (vd probe bi huy giua chung)
+    """
+    STATES = ('closed', 'half_open', 'open')
+
+    def __init__(self, enabled: bool = None, failure_threshold: int = None,
+                 reset_seconds: float = None, probe_timeout: float = None):
+        self.enabled = LLM_BREAKER_ENABLED if enabled is None else enabled
+        self.failure_threshold = failure_threshold or LLM_BREAKER_FAILURES
+        self.reset_seconds = reset_seconds or LLM_BREAKER_RESET_SECONDS
+        self.probe_timeout = probe_timeout or LLM_BULK_TIMEOUT + 5
+        self._lock = threading.Lock()
+        self._state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = None
+        self._short_circuited = 0
+        self._opened_count = 0
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def allow(self) -> bool:
+        """True -> duoc goi LLM; False -> mach dang mo, dung fallback"""
+        if not self.enabled:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            if self._state == 'open' and now - self._opened_at >= self.reset_seconds:
+                self._transition('half_open')
+            if self._state == 'closed':
+                return True
+            if self._state == 'half_open' and (
+                self._probe_started is None or now - self._probe_started >= self.probe_timeout
+            ):
+                self._probe_started = now
+                return True
+            self._short_circuited += 1
+        metrics.llm_short_circuited.inc()
+        return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self._state != 'closed':
+                self._transition('closed')
+
+    def record_failure(self, reason: str):
+        with self._lock:
+            self._failures += 1
+            if self._state == 'half_open' or (
+                self._state == 'closed' and self._failures >= self.failure_threshold
+            ):
+                self._opened_at = time.monotonic()
+                self._opened_count += 1
+                self._transition('open')
+                log.warning("llm_circuit_opened", reason=reason, consecutive_failures=self._failures,
+                            retry_in=self.reset_seconds)
+
+    def _transition(self, state: str):
+        """Goi khi dang giu lock"""
+        if state != 'open':
+            self._probe_started = None
+        self._state = state
+        metrics.llm_circuit_transitions.inc(state=state)
+        if state == 'closed':
+            log.info("llm_circuit_closed")
+
+    def retry_in(self) -> float:
+        """Giay con lai truoc khi mach chuyen half-open (0 neu khong mo)"""
+        with self._lock:
+            if self._state != 'open':
+                return 0.0
+            return max(0.0, self.reset_seconds - (time.monotonic() - self._opened_at))
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            stats = {
+                'enabled': self.enabled,
+                'state': self._state,
+                'consecutive_failures': self._failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_seconds': self.reset_seconds,
+                'times_opened': self._opened_count,
+                'short_circuited': self._short_circuited,
+            }
+            if self._state == 'open':
+                stats['retry_in'] = round(max(0.0, self.reset_seconds - (time.monotonic() - self._opened_at)), 1)
+            return stats
+
+
+# Singleton instance
+circuit_breaker = CircuitBreaker()
+metrics.llm_circuit_state.set_function(lambda: CircuitBreaker.STATES.index(circuit_breaker.state))
+
+
+# === HTTP client dung chung ===
+# AsyncClient gan voi event loop tao ra no -> moi loop 1 client (pool keep-alive rieng):
+# - loop cua API: mo o startup, dong o shutdown (api.py)
+# - loop nen cho caller dong bo (batch_processor), xem _BackgroundLoop
+_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]' = weakref.WeakKeyDictionary()
+
+
+def _new_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=LLM_BULK_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        ),
+        http2=LLM_HTTP2 and HAS_H2,
+        headers={
+            "Authorization": f"Bearer {MISTRAL_API_KEY}",
+            "Content-Type": "application/json"
+        },
+    )
+
+
+def get_client() -> httpx.AsyncClient:
+    """Client cua event loop hien tai (tao lazy neu chua co, vd script CLI)"""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = _new_client()
+        _clients[loop] = client
+    return client
+
+
+async def start_client():
+    """Startup cua app: mo client dung chung cho event loop hien tai"""
+    get_client()
+    log.info("llm_client_started", url=MISTRAL_API_URL, http2=LLM_HTTP2 and HAS_H2,
+             max_connections=LLM_MAX_CONNECTIONS, max_keepalive=LLM_MAX_KEEPALIVE)
+
+
+async def close_client():
+    """Dong client cua event loop hien tai (dong cac connection keep-alive)"""
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def shutdown_clients():
+    """Shutdown cua app: dong client cua loop API va dung loop nen"""
+    await close_client()
+    await asyncio.to_thread(_background.stop)
+
+
+def get_client_stats() -> Dict:
+    return {
+        'url': MISTRAL_API_URL,
+        'http2': LLM_HTTP2 and HAS_H2,
+        'max_connections': LLM_MAX_CONNECTIONS,
+        'max_keepalive': LLM_MAX_KEEPALIVE,
+        'keepalive_expiry': LLM_KEEPALIVE_EXPIRY,
+        'open_clients': sum(1 for c in list(_clients.values()) if not c.is_closed),
+        'background_loop': _background.running,
+    }
+
+
+class _BackgroundLoop:
+    """
+    Event loop chay tren 1 thread nen, song suot process.
+    extract_core_issue_sync dua coroutine vao day thay vi tao loop/thread moi moi text
+    -> client (va connection keep-alive) duoc giu lai giua cac lan goi.
+    Sau fork thread khong con -> tu tao lai o lan goi dau tien.
+    """
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _ensure_running(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if not self.running:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name='llm-loop', daemon=True
+                )
+                self._thread.start()
+            return self._loop
+
+    def run(self, coro, timeout: float):
+        future = asyncio.run_coroutine_threadsafe(coro, self._ensure_running())
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def stop(self):
+        with self._lock:
+            if not self.running:
+                return
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+
+        try:
+            asyncio.run_coroutine_threadsafe(close_client(), loop).result(5)
+        except Exception as e:
+            log.warning("llm_client_close_failed", error=str(e))
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(5)
+        if not thread.is_alive():
+            loop.close()
+
+
+_background = _BackgroundLoop()
+atexit.register(_background.stop)
+
+
+async def extract_core_issue(text: str, local_first: bool = True) -> str:
     """
     Trích xuất vấn đề/ý tưởng chính từ nội dung, loại bỏ phần đề nghị.
+    Văn bản khuôn mẫu được tách cục bộ; chỉ văn bản không rõ ràng mới gọi LLM.
+    Kết quả LLM được cache (RAM + Postgres) theo text, prompt version và model.
     
     Args:
         text: Nội dung gốc (description + expected_benefit)
+        local_first: Thử stripper cục bộ trước (False -> luôn dùng LLM, vd đo độ khớp)
         
     Returns:
         Nội dung đã được làm sạch, chỉ giữ vấn đề chính
     """
-    # Skip nếu disabled hoặc không có API key
-    if not LLM_EXTRACT_ENABLED or not MISTRAL_API_KEY:
-        print("[LLM] Disabled or no API key, returning original text")
-        return text
-    
+    return await _extract(text, local_first)
+
+
+async def try_extract_core_issue(text: str) -> Optional[str]:
+    """
+    Nhu extract_core_issue nhung tra ve None khi khong co ket qua tin cay (LLM loi/tat,
+    circuit breaker mo) thay vi nguyen van -> caller biet de thu lai sau (vd nang cap embedding).
+    Chay nen nen dung timeout + retry cua bulk.
+    """
+    return await _try_extract(text, True, None, LLM_MAX_RETRIES, LLM_BULK_TIMEOUT)
+
+
+async def _extract(text: str, local_first: bool = True, limiter: 'TokenBucket' = None,
+                   retries: int = 0, timeout: float = None) -> str:
+    """extract_core_issue + tuy chon cho bulk: limiter (token bucket), so lan retry, timeout"""
+    extracted = await _try_extract(text, local_first, limiter, retries, timeout)
+    return text if extracted is None else extracted
+
+
+async def _try_extract(text: str, local_first: bool = True, limiter: 'TokenBucket' = None,
+                       retries: int = 0, timeout: float = None) -> Optional[str]:
+    """None -> khong extract duoc (fallback la nguyen van)"""
     # Skip nếu text quá ngắn
     if len(text.strip()) < 20:
         return text
-    
+
+    # Fast path: lời chào/đề nghị khuôn mẫu -> tách cục bộ, không gọi LLM
+    if local_first and boilerplate_stripper.enabled:
+        local = boilerplate_stripper.try_local(text)
+        if local is not None:
+            return local
+
+    # Skip nếu disabled hoặc không có API key
+    if not LLM_EXTRACT_ENABLED or not MISTRAL_API_KEY:
+        log.debug("llm_extract_skipped", reason="disabled_or_no_api_key")
+        return None
+
+    key = extraction_cache.key(text)
+    cached = await extraction_cache.get(key)
+    if cached is not None:
+        return cached
+
+    start = time.perf_counter()
+    extracted = await _call_llm(text, limiter, retries, timeout or LLM_INTERACTIVE_TIMEOUT)
+    if extracted is None:
+        return None
+
+    await extraction_cache.set(key, extracted, (time.perf_counter() - start) * 1000)
+    return extracted
+
+
+async def _call_llm(text: str, limiter: 'TokenBucket' = None, retries: int = 0,
+                    timeout: float = None) -> Optional[str]:
+    """
+    Goi Mistral chat completion. None neu loi, ket qua khong hop le hoac circuit breaker dang mo.
+    retries > 0: thu lai khi 429/5xx, loi mang hoac mach mo, backoff luy thua + jitter
+    (ton trong Retry-After / thoi gian con lai cua mach mo).
+    limiter: moi lan gui (ke ca retry) lay 1 token truoc.
+    timeout: timeout cua request (LLM_INTERACTIVE_TIMEOUT / LLM_BULK_TIMEOUT)
+    """
+    start = time.perf_counter()
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                "https://api.mistral.ai/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {MISTRAL_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": MISTRAL_MODEL,
-                    "messages": [
-                        {"role": "user", "content": EXTRACT_PROMPT + text}
-                    ],
-                    "temperature": 0.1,  # Low temperature for consistency
-                    "max_tokens": 500
-                }
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                extracted = result["choices"][0]["message"]["content"].strip()
-                
-                # Validate: không trả về kết quả quá khác biệt
-                if len(extracted) > 0 and len(extracted) < len(text) * 2:
-                    print(f"[LLM] Extracted: '{text[:50]}...' -> '{extracted[:50]}...'")
-                    return extracted
-                else:
-                    print(f"[LLM] Invalid response, using original")
-                    return text
+        for attempt in range(retries + 1):
+            retry_after = None
+            if not circuit_breaker.allow():
+                # Mach mo: khong cho timeout, tra fallback ngay (bulk: doi roi thu lai)
+                if attempt >= retries:
+                    log.debug("llm_short_circuited", input_chars=len(text))
+                    return None
+                reason = 'circuit_open'
+                retry_after = circuit_breaker.retry_in()
             else:
-                print(f"[LLM] API error {response.status_code}: {response.text[:200]}")
-                return text
-                
+                if limiter is not None:
+                    await limiter.acquire()
+                try:
+                    response = await get_client().post(
+                        MISTRAL_API_URL,
+                        json={
+                            "model": MISTRAL_MODEL,
+                            "messages": [
+                                {"role": "user", "content": EXTRACT_PROMPT + text}
+                            ],
+                            "temperature": 0.1,  # Low temperature for consistency
+                            "max_tokens": 500
+                        },
+                        timeout=timeout or LLM_BULK_TIMEOUT
+                    )
+                except httpx.TransportError as e:
+                    reason = type(e).__name__
+                    circuit_breaker.record_failure(reason)
+                    if attempt >= retries:
+                        raise
+                else:
+                    if response.status_code in RETRY_STATUSES:
+                        reason = str(response.status_code)
+                        circuit_breaker.record_failure(reason)
+                        if attempt >= retries:
+                            log.warning("llm_api_error", status=response.status_code,
+                                        body=response.text[:200], attempts=attempt + 1)
+                            return None
+                        retry_after = response.headers.get('Retry-After')
+                    else:
+                        # Endpoint con tra loi (ke ca 4xx) -> dependency van song
+                        circuit_breaker.record_success()
+                        if response.status_code != 200:
+                            log.warning("llm_api_error", status=response.status_code,
+                                        body=response.text[:200], attempts=attempt + 1)
+                            return None
+
+                        result = response.json()
+                        extracted = result["choices"][0]["message"]["content"].strip()
+
+                        # Validate: không trả về kết quả quá khác biệt
+                        if len(extracted) > 0 and len(extracted) < len(text) * 2:
+                            log.info("llm_extracted", input_chars=len(text), output_chars=len(extracted),
+                                     http_version=response.http_version, attempts=attempt + 1)
+                            return extracted
+                        log.warning("llm_invalid_response", input_chars=len(text), output_chars=len(extracted))
+                        return None
+
+            delay = _backoff_delay(attempt, retry_after)
+            metrics.llm_retries.inc(reason=reason)
+            log.debug("llm_retry", reason=reason, attempt=attempt + 1, delay=round(delay, 3))
+            await asyncio.sleep(delay)
+
     except Exception as e:
-        print(f"[LLM] Exception: {e}")
-        return text
+        log.error("llm_extract_failed", error=str(e) or type(e).__name__)
+        return None
+    finally:
+        metrics.record('llm_extraction', time.perf_counter() - start)
+
+
+def _backoff_delay(attempt: int, retry_after=None) -> float:
+    """Retry-After (giay) neu co, khong thi base * 2^attempt co full jitter"""
+    if retry_after:
+        try:
+            return min(max(float(retry_after), 0.0), LLM_BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * (2 ** attempt)))
+
+
+class TokenBucket:
+    """
+    Gioi han toc do gui request toi LLM: `rate` token/giay, toi da `burst` token tich luy.
+    Chay tren 1 event loop (khong thread-safe).
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
 
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
 
-def extract_core_issue_sync(text: str) -> str:
+
+async def extract_stream(
+    items: List[Tuple[str, str]],
+    concurrency: int = None,
+    rate: float = None,
+    retries: int = None,
+    fallback: bool = True
+) -> AsyncIterator[Tuple[str, Optional[str]]]:
+    """
+    Extract nhieu text song song cho bulk indexing.
+    items: [(id, text)] -> yield (id, text da lam sach) theo thu tu hoan thanh, de caller
+    gom batch encode/ghi DB trong khi cac extraction khac van dang chay.
+    Fast path cuc bo + cache khong ton token; chi request LLM moi qua token bucket + retry.
+    fallback=False: extract that bai -> yield (id, None) thay vi nguyen van.
+    Dong generator (aclose) -> huy cac extraction chua xong.
+    """
+    limiter = TokenBucket(LLM_BULK_RATE if rate is None else rate, LLM_BULK_BURST)
+    semaphore = asyncio.Semaphore(concurrency or LLM_BULK_CONCURRENCY)
+    retries = LLM_MAX_RETRIES if retries is None else retries
+
+    extract = _extract if fallback else _try_extract
+
+    async def one(item_id: str, text: str) -> Tuple[str, Optional[str]]:
+        async with semaphore:
+            return item_id, await extract(text, True, limiter, retries, LLM_BULK_TIMEOUT)
+
+    tasks = [asyncio.ensure_future(one(item_id, text)) for item_id, text in items]
+    try:
+        for future in asyncio.as_completed(tasks):
+            yield await future
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def extract_batch(texts: List[str], **options) -> List[Optional[str]]:
+    """Nhu extract_stream nhung tra ve list theo thu tu input"""
+    results: List[Optional[str]] = [None] * len(texts)
+    stream = extract_stream([(str(i), t) for i, t in enumerate(texts)], **options)
+    try:
+        async for index, extracted in stream:
+            results[int(index)] = extracted
+    finally:
+        await stream.aclose()
+    return results
+
+
+def extract_core_issue_sync(text: str, local_first: bool = True) -> str:
     """
     Synchronous version - sử dụng cho batch processing.
+    Chạy trên event loop nền dùng chung -> giữ connection keep-alive giữa các lần gọi.
     """
-    import asyncio
     try:
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            # Đang trong async context, tạo task mới
-            import concurrent.futures
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future = executor.submit(asyncio.run, extract_core_issue(text))
-                return future.result(timeout=35)
-        else:
-            return loop.run_until_complete(extract_core_issue(text))
+        return _background.run(extract_core_issue(text, local_first), timeout=LLM_INTERACTIVE_TIMEOUT + 5)
     except Exception as e:
-        print(f"[LLM] Sync extraction failed: {e}")
+        log.error("llm_sync_extract_failed", error=str(e))
         return text
+
+
+def extract_batch_sync(texts: List[str], fallback: bool = True) -> List[Optional[str]]:
+    """
+    Synchronous version của extract_batch (batch_processor): song song + rate limit trên loop nền.
+    Lỗi -> trả về nguyên văn (fallback=False: None).
+    """
+    try:
+        return _background.run(extract_batch(texts, fallback=fallback), timeout=None)
+    except Exception as e:
+        log.error("llm_sync_extract_failed", error=str(e), count=len(texts))
+        return list(texts) if fallback else [None] * len(texts)
@@ -0,0 +1,182 @@
+"""
+Structured Logging
+Log co cau truc cho hot path (routing, search, LLM extract, luu embedding)
+
+- Moi record 1 dong JSON: ts, level, logger, event + fields (+ request_id neu trong request)
+- Ghi qua QueueHandler -> QueueListener (thread rieng): request thread khong cho stdout.
+  Queue co gioi han, day thi bo record (dem trong dropped) thay vi chan request
+- Sampling theo request: INFO chi ghi cho LOG_SAMPLE_RATE request (WARNING/ERROR luon ghi)
+- debug(): chi ghi khi request gui header LOG_DEBUG_HEADER (vd bang diem department),
+  ngoai request thi theo LOG_LEVEL
+"""
+import os
+import sys
+import json
+import uuid
+import queue
+import atexit
+import random
+import logging
+import datetime
+import logging.handlers
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from config import Config
+
+ROOT_LOGGER = 'rag'
+QUEUE_SIZE = 10000
+
+# Context cua request hien tai: request_id, sampled, debug. None = ngoai request (job, startup)
+_request_ctx: ContextVar[Optional[Dict]] = ContextVar('rag_log_ctx', default=None)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        payload.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Dang doc cho dev: '12:00:01 INFO rag.router suggestion key=value ...'"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        ts = datetime.datetime.fromtimestamp(record.created).strftime('%H:%M:%S')
+        fields = ' '.join(f"{k}={v}" for k, v in (getattr(record, 'fields', None) or {}).items())
+        line = f"{ts} {record.levelname} {record.name} {record.getMessage()} {fields}".rstrip()
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Khong format tren request thread, bo record khi queue day"""
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging():
+    """Cau hinh logger 'rag' 1 lan cho moi process"""
+    global _listener
+    if _listener is not None:
+        return
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter() if Config.LOG_FORMAT == 'json' else TextFormatter())
+
+    log_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(Config.LOG_LEVEL)
+    root.addHandler(_DroppingQueueHandler(log_queue))
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=False)
+    _listener.start()
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+def _reinit_after_fork():
+    """Thread listener khong ton tai trong process con -> tao lai queue + listener"""
+    global _listener
+    if _listener is None:
+        return
+    _listener = None
+    root = logging.getLogger(ROOT_LOGGER)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    setup_logging()
+
+
+atexit.register(_stop_listener)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reinit_after_fork)
+
+
+class StructLogger:
+    """Logger voi fields dang keyword: log.info('suggestion', department=..., confidence=...)"""
+
+    def __init__(self, name: str):
+        self._logger = logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+    def _emit(self, level: int, event: str, fields: Dict, exc_info=None):
+        ctx = _request_ctx.get()
+        if ctx is not None:
+            fields = {'request_id': ctx['request_id'], **fields}
+        self._logger.log(level, event, extra={'fields': fields}, exc_info=exc_info)
+
+    def debug(self, event: str, **fields):
+        ctx = _request_ctx.get()
+        if ctx is not None:
+            # Trong request: chi ghi khi client bat debug bang header (bo qua LOG_LEVEL)
+            if ctx['debug']:
+                self._emit(logging.INFO, event, {'debug': True, **fields})
+        elif self._logger.isEnabledFor(logging.DEBUG):
+            self._emit(logging.DEBUG, event, fields)
+
+    def info(self, event: str, **fields):
+        ctx = _request_ctx.get()
+        if ctx is not None and not (ctx['sampled'] or ctx['debug']):
+            return
+        if self._logger.isEnabledFor(logging.INFO):
+            self._emit(logging.INFO, event, fields)
+
+    def warning(self, event: str, **fields):
+        self._emit(logging.WARNING, event, fields)
+
+    def error(self, event: str, exc_info=None, **fields):
+        self._emit(logging.ERROR, event, fields, exc_info=exc_info)
+
+
+def get_logger(name: str) -> StructLogger:
+    setup_logging()
+    return StructLogger(name)
+
+
+# === Request scope (middleware) ===
+def start_request(headers) -> tuple:
+    """Tao context log cho request. Tra ve (token, request_id)"""
+    request_id = headers.get('x-request-id') or uuid.uuid4().hex[:16]
+    debug = headers.get(Config.LOG_DEBUG_HEADER.lower(), '').lower() in ('1', 'true', 'yes')
+    ctx = {
+        'request_id': request_id,
+        'sampled': random.random() < Config.LOG_SAMPLE_RATE,
+        'debug': debug,
+    }
+    return _request_ctx.set(ctx), request_id
+
+
+def end_request(token):
+    _request_ctx.reset(token)
+
+
+def get_stats() -> Dict:
+    return {
+        'level': Config.LOG_LEVEL,
+        'format': Config.LOG_FORMAT,
+        'sample_rate': Config.LOG_SAMPLE_RATE,
+        'dropped': _DroppingQueueHandler.dropped,
+    }
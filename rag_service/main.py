@@ -2,15 +2,19 @@
 RAG Incident Router Service
 Main Entry Point
 
-Chay service voi: python main.py
+Chay service voi: python main.py (dev, auto-reload)
+Production: python main.py --prod [--workers N] (preload model, fork N worker)
 API docs tai: http://localhost:8001/docs
 """
+import argparse
+
 import uvicorn
 
 from config import Config
 from api import app
 from database import db
 from embedding_service import embedding_service
+import prefork
 
 
 def print_banner():
@@ -18,7 +22,7 @@ def print_banner():
     pass  # Disabled verbose banner
 
 
-def startup_checks():
+def startup_checks(workers_line: str = ""):
     """Kiem tra truoc khi start - Compact version"""
     
     # 1. pgvector extension
@@ -40,19 +44,38 @@ def startup_checks():
 RAG Incident Router API v2.0
 ==================================================
 Model: {info['model_name']} (dim={info['vector_dim']})
-Embeddings: {stats['with_embedding']}/{stats['total']}
+Embeddings: {stats['with_embedding']}/{stats['total']}{workers_line}
 Docs: http://localhost:{Config.API_PORT}/docs
 ==================================================""")
     
     return True
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="RAG Incident Router Service")
+    parser.add_argument('--prod', action='store_true', default=Config.RUN_MODE == 'prod',
+                        help="Production: preload model roi fork nhieu worker (khong reload)")
+    parser.add_argument('--workers', type=int, default=Config.WORKERS,
+                        help="So worker (0 = 1/2 so core)")
+    parser.add_argument('--threads-per-worker', type=int, default=Config.INFERENCE_THREADS,
+                        help="So thread inference moi worker (0 = chia deu so core)")
+    return parser.parse_args()
+
+
 def main():
     """Main entry point"""
+    args = parse_args()
     print_banner()
-    
+
+    workers_line = ""
+    if args.prod:
+        workers, threads = prefork.resolve_workers(args.workers, args.threads_per_worker)
+        mem = prefork.memory_footprint()
+        workers_line = (f"\nWorkers: {workers} x {threads} inference threads "
+                        f"(preloaded rss={mem['rss_mb']}MB, shared copy-on-write)")
+
     # Run startup checks
-    if not startup_checks():
+    if not startup_checks(workers_line):
         print("\n[ERROR] Startup checks failed. Please fix issues above.")
         return
     
@@ -69,6 +92,10 @@ def main():
 ================================================================
 """)
     
+    if args.prod:
+        prefork.serve(app, Config.API_HOST, Config.API_PORT, args.workers, args.threads_per_worker)
+        return
+
     # Start server
     uvicorn.run(
         "api:app",
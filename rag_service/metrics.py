@@ -0,0 +1,213 @@
+"""
+Metrics
+Do latency theo tung stage + counter/gauge, xuat o /metrics (Prometheus text format)
+
+- timer(stage): ghi vao histogram rag_stage_duration_seconds{stage}
+  va cong don vao timings cua request hien tai (-> header Server-Timing)
+- Khong phu thuoc prometheus_client: registry nho, thread-safe, trong process
+  (chay nhieu worker -> moi worker 1 registry, Prometheus scrape qua tung worker)
+"""
+import time
+import functools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Bucket (giay) cho latency tung stage: 0.5ms -> 10s
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Timings (ms) cua request hien tai: stage -> tong thoi gian. None = ngoai request
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar('rag_request_timings', default=None)
+
+
+def _label_key(labels: Dict[str, str]) -> Tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: Tuple, extra: Tuple = ()) -> str:
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    body = ','.join(f'{k}="{str(v)}"'.replace('\n', ' ') for k, v in pairs)
+    return '{' + body + '}'
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._series: Dict[Tuple, List] = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def mean(self, **labels) -> Optional[float]:
+        """Gia tri trung binh cua 1 series (None neu chua co quan sat)"""
+        with self._lock:
+            series = self._series.get(_label_key(labels))
+            if not series or not series[-1]:
+                return None
+            return series[-2] / series[-1]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for i, bound in enumerate(self.buckets):
+                    lines.append(f"{self.name}_bucket{_format_labels(key, (('le', bound),))} {series[i]}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, (('le', '+Inf'),))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Gauge:
+    """Gauge doc gia tri luc scrape qua callback (vd do dai queue)"""
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._callbacks: Dict[Tuple, Callable[[], float]] = {}
+
+    def set_function(self, fn: Callable[[], float], **labels):
+        self._callbacks[_label_key(labels)] = fn
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for key, fn in sorted(self._callbacks.items()):
+            try:
+                value = float(fn())
+            except Exception:
+                continue
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class MetricsRegistry:
+    """Tap hop metrics cua service"""
+
+    def __init__(self):
+        self.stage_duration = Histogram(
+            'rag_stage_duration_seconds',
+            'Latency tung stage (segmentation, tokenization, inference, ann, hydration, rerank, ...)'
+        )
+        self.request_duration = Histogram(
+            'rag_http_request_duration_seconds',
+            'Latency HTTP request theo route',
+            buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+        )
+        self.cache_requests = Counter('rag_cache_requests_total', 'Cache lookup theo cache va ket qua (hit/miss)')
+        self.llm_latency_saved = Counter('rag_llm_latency_saved_seconds_total', 'Thoi gian goi LLM tiet kiem nho extraction cache')
+        self.llm_retries = Counter('rag_llm_retries_total', 'Request LLM duoc thu lai (reason: status code hoac loi mang)')
+        self.llm_short_circuited = Counter('rag_llm_short_circuited_total', 'Extract tra fallback ngay vi circuit breaker dang mo')
+        self.llm_circuit_transitions = Counter('rag_llm_circuit_transitions_total', 'Chuyen trang thai circuit breaker LLM (state)')
+        self.llm_circuit_state = Gauge('rag_llm_circuit_state', 'Trang thai circuit breaker LLM: 0 closed, 1 half-open, 2 open')
+        self.hedged_extraction = Counter('rag_check_duplicate_extraction_total', 'Ket qua hedged extraction cua /check-duplicate (fast/cleaned/raw/pending)')
+        self.llm_fastpath = Counter('rag_llm_fastpath_total', 'Extract xu ly cuc bo (outcome=local) hoac chuyen LLM (outcome=llm, reason)')
+        self.routing_path = Counter('rag_routing_path_total', 'Routing qua prototype fast path (path=prototype) hoac kNN voting (path=knn, reason)')
+        self.auto_assign_decisions = Counter('rag_auto_assign_decisions_total', 'Quyet dinh routing (auto/suggest/none)')
+        self.admission_shed = Counter('rag_admission_shed_total', 'Request bi tu choi do qua tai (endpoint, reason)')
+        self.deadline_skipped = Counter('rag_deadline_skipped_stages_total', 'Stage tuy chon bi bo qua do het deadline')
+        self.deadline_exceeded = Counter('rag_deadline_exceeded_total', 'Request dung giua pipeline do het deadline')
+        self.admission_degraded = Counter('rag_admission_degraded_total', 'Request chay che do degraded (bo qua rerank)')
+        self.queue_depth = Gauge('rag_queue_depth', 'So item dang cho trong cac hang doi')
+        self._metrics = [
+            self.stage_duration, self.request_duration,
+            self.cache_requests, self.llm_latency_saved, self.auto_assign_decisions, self.routing_path,
+            self.llm_fastpath, self.llm_retries,
+            self.llm_short_circuited, self.llm_circuit_transitions, self.llm_circuit_state,
+            self.hedged_extraction,
+            self.admission_shed, self.admission_degraded,
+            self.deadline_skipped, self.deadline_exceeded, self.queue_depth,
+        ]
+
+    @contextmanager
+    def timer(self, stage: str):
+        """Do thoi gian 1 stage: histogram + Server-Timing cua request hien tai"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def timed(self, stage: str):
+        """Decorator: do thoi gian ca ham (dong bo) nhu 1 stage"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, stage: str, seconds: float):
+        self.stage_duration.observe(seconds, stage=stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + seconds * 1000
+
+    def stage_mean(self, stage: str) -> Optional[float]:
+        """Latency trung binh (giay) cua stage - dung de uoc luong chi phi khi con it thoi gian"""
+        return self.stage_duration.mean(stage=stage)
+
+    def cache_result(self, cache: str, hit: bool):
+        self.cache_requests.inc(cache=cache, result='hit' if hit else 'miss')
+
+    # === Request scope ===
+    def start_request(self):
+        """Bat dau gom timings cho request (middleware). Tra ve token de reset"""
+        return _request_timings.set({})
+
+    def end_request(self, token) -> Dict[str, float]:
+        timings = _request_timings.get() or {}
+        _request_timings.reset(token)
+        return timings
+
+    def server_timing(self, timings: Dict[str, float], total_ms: float = None) -> str:
+        """Header Server-Timing: 'ann;dur=1.2, rerank;dur=35.0, total;dur=40.1'"""
+        parts = [f"{stage};dur={ms:.1f}" for stage, ms in timings.items()]
+        if total_ms is not None:
+            parts.append(f"total;dur={total_ms:.1f}")
+        return ', '.join(parts)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Singleton instance
+metrics = MetricsRegistry()
@@ -0,0 +1,181 @@
+"""
+Parallel Backfill
+Re-embed toan bo incidents/ideas bang nhieu process song song (vd sau khi doi model)
+
+- Chia records thanh N khoang id (ntile), moi khoang la 1 backfill job (shard) co checkpoint rieng
+- Moi worker process co encoder va DB connection rieng (spawn, khong fork)
+- Tien do cac worker gop ve 1 progress bar o process cha
+- Throttle: gioi han thread inference moi worker, tong records/giay, va nice level
+  de routing production van co du CPU
+
+Chay:
+    python parallel_backfill.py --workers 4 --target all --reembed
+    python parallel_backfill.py --workers 2 --threads-per-worker 2 --max-rate 100
+    python parallel_backfill.py --resume <run_id>
+"""
+import os
+import sys
+import time
+import uuid
+import argparse
+import multiprocessing as mp
+from queue import Empty
+from tqdm import tqdm
+
+from database import db
+
+TARGETS = ('incidents', 'ideas')
+
+
+def _worker(job_id: str, options: dict, progress_queue):
+    """Chay trong process con: import embedding_service o day -> moi worker load model rieng"""
+    if options['nice'] and hasattr(os, 'nice'):
+        os.nice(options['nice'])
+
+    from batch_processor import BatchProcessor
+
+    def report(saved: int, failed: int):
+        progress_queue.put(('progress', job_id, saved, failed))
+
+    try:
+        result = BatchProcessor().process_all(
+            job_id=job_id,
+            batch_size=options['batch_size'],
+            extract=options['extract'],
+            max_rate=options['rate_per_worker'],
+            on_progress=report,
+            show_progress=False
+        )
+        progress_queue.put(('done', job_id, result.get('status', 'completed'), None))
+    except KeyboardInterrupt:
+        progress_queue.put(('done', job_id, 'interrupted', None))
+    except Exception as e:
+        progress_queue.put(('done', job_id, 'failed', str(e)))
+
+
+def create_run(targets: list, workers: int, batch_size: int, only_missing: bool) -> str:
+    """Tao run moi: moi target duoc chia thanh `workers` shard"""
+    run_id = str(uuid.uuid4())
+    for target in targets:
+        ranges = db.partition_backfill_ranges(target, workers, only_missing)
+        for r in ranges:
+            db.create_backfill_job(
+                target, batch_size, r['total'], only_missing,
+                run_id=run_id, range_start=r['range_start'], range_end=r['range_end'],
+                status='queued'
+            )
+    return run_id
+
+
+def run(run_id: str, workers: int, options: dict) -> dict:
+    """Chay cac shard chua xong cua run, toi da `workers` process cung luc"""
+    summary = db.get_backfill_run(run_id)
+    pending = [j for j in summary['shards'] if j['status'] != 'completed']
+    if not pending:
+        return summary
+
+    ctx = mp.get_context('spawn')
+    progress_queue = ctx.Queue()
+    queue_ids = [str(j['id']) for j in pending]
+    active = {}
+
+    done_before = sum((j['processed'] or 0) + (j['failed'] or 0) for j in summary['shards'])
+    progress = tqdm(total=summary['total'], initial=done_before, desc=f"Backfill x{workers}")
+    errors = {}
+    failed_rows = 0
+
+    try:
+        while queue_ids or active:
+            while queue_ids and len(active) < workers:
+                job_id = queue_ids.pop(0)
+                proc = ctx.Process(target=_worker, args=(job_id, options, progress_queue), daemon=False)
+                proc.start()
+                active[job_id] = proc
+
+            try:
+                kind, job_id, a, b = progress_queue.get(timeout=1.0)
+            except Empty:
+                # Worker chet khong bao (OOM, kill) -> bo khoi active, run se o trang thai incomplete
+                for job_id, proc in list(active.items()):
+                    if not proc.is_alive():
+                        errors[job_id] = f"exit code {proc.exitcode}"
+                        active.pop(job_id)
+                continue
+
+            if kind == 'progress':
+                failed_rows += b
+                progress.update(a + b)
+                progress.set_postfix(failed=failed_rows)
+            elif kind == 'done':
+                if b:
+                    errors[job_id] = b
+                proc = active.pop(job_id, None)
+                if proc is not None:
+                    proc.join()
+    except KeyboardInterrupt:
+        print("\n[WARN] Interrupted - shards will resume from their last checkpoint")
+        for proc in active.values():
+            proc.join(timeout=10)
+    finally:
+        progress.close()
+
+    summary = db.get_backfill_run(run_id)
+    summary['errors'] = errors
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded parallel embedding backfill")
+    parser.add_argument('--workers', type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="So worker process (mac dinh: 1/2 so core)")
+    parser.add_argument('--target', choices=TARGETS + ('all',), default='all')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--reembed', action='store_true',
+                        help="Re-embed tat ca records (mac dinh chi records chua co embedding)")
+    parser.add_argument('--no-extract', action='store_true',
+                        help="Khong dung LLM trich xuat truoc khi encode ideas")
+    parser.add_argument('--threads-per-worker', type=int, default=1,
+                        help="So thread inference moi worker (0 = mac dinh ONNX Runtime)")
+    parser.add_argument('--max-rate', type=float, default=None,
+                        help="Gioi han tong records/giay cua tat ca worker")
+    parser.add_argument('--nice', type=int, default=10,
+                        help="Tang nice level cua worker (POSIX) de nhuong CPU cho API")
+    parser.add_argument('--resume', metavar='RUN_ID', help="Chay tiep cac shard chua xong cua run")
+    args = parser.parse_args()
+
+    # Process con ke thua env luc spawn -> Config.INFERENCE_THREADS cua moi worker
+    os.environ['INFERENCE_THREADS'] = str(args.threads_per_worker)
+
+    options = {
+        'batch_size': args.batch_size,
+        'extract': not args.no_extract,
+        'rate_per_worker': args.max_rate / args.workers if args.max_rate else None,
+        'nice': args.nice,
+    }
+
+    if args.resume:
+        run_id = args.resume
+    else:
+        targets = list(TARGETS) if args.target == 'all' else [args.target]
+        run_id = create_run(targets, args.workers, args.batch_size, only_missing=not args.reembed)
+
+    print(f"Run {run_id}: {args.workers} workers, {args.threads_per_worker} thread(s)/worker"
+          + (f", max {args.max_rate:.0f} records/s" if args.max_rate else ""))
+
+    start = time.time()
+    summary = run(run_id, args.workers, options)
+    elapsed = time.time() - start
+
+    print(f"\nKet qua run {run_id}: {summary['status']}")
+    print(f"  - Da xu ly: {summary['processed']}/{summary['total']}")
+    print(f"  - That bai: {summary['failed']}")
+    print(f"  - Thoi gian: {elapsed:.1f}s")
+    for job_id, error in summary.get('errors', {}).items():
+        print(f"  - [ERROR] shard {job_id}: {error}")
+    if summary['status'] != 'completed':
+        print(f"\nChay tiep: python parallel_backfill.py --resume {run_id}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
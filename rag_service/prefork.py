@@ -0,0 +1,181 @@
+"""
+Prefork Server
+Chay production nhieu worker: master load model 1 lan roi fork N worker
+
+- Master: preload model bytes + tokenizer + pyvi (import api), setup schema, bind socket,
+  roi fork -> worker chia se vung nho do copy-on-write
+- Worker: DB pool rieng (DB_POOL_SIZE connection), ONNX session rieng voi thread budget rieng
+  (cpu_count / workers neu INFERENCE_THREADS=0), chay uvicorn tren socket chung
+- SIGTERM/SIGINT o master: chuyen SIGTERM cho worker (uvicorn graceful shutdown),
+  qua GRACEFUL_TIMEOUT thi SIGKILL. Worker chet bat thuong -> fork lai
+- Chi ho tro os.fork (Linux/macOS)
+"""
+import os
+import time
+import socket
+import signal
+import traceback
+from typing import Dict, Optional
+
+import uvicorn
+
+from config import Config
+from database import db
+from embedding_service import embedding_service
+
+# Index cua worker hien tai (None = master hoac chay 1 process)
+WORKER_ID: Optional[int] = None
+
+RESPAWN_DELAY = 1.0
+
+
+def memory_footprint(pid='self') -> Dict[str, float]:
+    """
+    RSS/PSS (MB) cua process. PSS chia deu trang dung chung (model copy-on-write)
+    cho cac process -> tong PSS cac worker = RAM thuc te.
+    """
+    values: Dict[str, float] = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                key, _, rest = line.partition(':')
+                if key in ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty'):
+                    values[key] = int(rest.split()[0]) / 1024
+    except (OSError, ValueError, IndexError):
+        import resource
+        values['Rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    return {
+        'rss_mb': round(values.get('Rss', 0.0), 1),
+        'pss_mb': round(values.get('Pss', values.get('Rss', 0.0)), 1),
+        'shared_mb': round(values.get('Shared_Clean', 0.0) + values.get('Shared_Dirty', 0.0), 1),
+    }
+
+
+def _bind(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+class PreforkServer:
+    def __init__(self, app, host: str, port: int, workers: int, threads: int):
+        self.app = app
+        self.workers = workers
+        self.threads = threads
+        self.sock = _bind(host, port)
+        self.children: Dict[int, int] = {}  # pid -> worker index
+        self.stopping = False
+
+    def run(self):
+        # Master khong giu session/connection: worker tu tao sau fork
+        embedding_service.release_session()
+        db.close()
+
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        signal.signal(signal.SIGALRM, self._on_timeout)
+
+        for index in range(self.workers):
+            self._spawn(index)
+
+        mem = memory_footprint()
+        print(f"[OK] Master pid={os.getpid()}: {self.workers} workers x {self.threads} inference threads, "
+              f"preloaded rss={mem['rss_mb']}MB")
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index = self.children.pop(pid, None)
+            if index is None:
+                continue
+            if not self.stopping:
+                print(f"[WARN] Worker {index} (pid={pid}) exited with status {status}, restarting")
+                time.sleep(RESPAWN_DELAY)
+                self._spawn(index)
+
+        self.sock.close()
+        print("[OK] All workers stopped")
+
+    def _spawn(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._run_worker(index)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = index
+
+    def _run_worker(self, index: int):
+        global WORKER_ID
+        WORKER_ID = index
+        # Process group rieng: Ctrl+C chi toi master, master chuyen SIGTERM 1 lan
+        os.setpgid(0, 0)
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGALRM):
+            signal.signal(sig, signal.SIG_DFL)
+
+        db.reset_after_fork()
+        embedding_service.init_worker(self.threads)
+
+        config = uvicorn.Config(
+            self.app,
+            log_level="info",
+            lifespan="on",
+            timeout_graceful_shutdown=Config.GRACEFUL_TIMEOUT
+        )
+        uvicorn.Server(config).run(sockets=[self.sock])
+
+    def _on_signal(self, signum, frame):
+        if self.stopping:
+            # Signal lan 2: dung ngay
+            self._kill_all(signal.SIGKILL)
+            return
+        print(f"\n[INFO] Shutting down {len(self.children)} workers (graceful {Config.GRACEFUL_TIMEOUT}s)...")
+        self.stopping = True
+        self._kill_all(signal.SIGTERM)
+        signal.alarm(int(Config.GRACEFUL_TIMEOUT) + 5)
+
+    def _on_timeout(self, signum, frame):
+        if self.children:
+            print(f"[WARN] Graceful shutdown timed out, killing {len(self.children)} workers")
+            self._kill_all(signal.SIGKILL)
+
+    def _kill_all(self, sig):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+
+def resolve_workers(workers: int = 0, threads: int = 0) -> tuple:
+    """0 = tu dong: workers = 1/2 so core, threads = chia deu so core cho cac worker"""
+    cpus = os.cpu_count() or 1
+    workers = workers or max(1, cpus // 2)
+    threads = threads or max(1, cpus // workers)
+    return workers, threads
+
+
+def serve(app, host: str, port: int, workers: int = 0, threads: int = 0):
+    """Chay production: prefork neu duoc, neu khong thi 1 process (khong reload)"""
+    workers, threads = resolve_workers(workers, threads)
+
+    if not hasattr(os, 'fork') or not embedding_service.fork_safe:
+        reason = "os.fork unavailable" if not hasattr(os, 'fork') else "HuggingFace backend cannot be forked"
+        print(f"[WARN] {reason}: running a single worker")
+        embedding_service.init_worker(threads)
+        uvicorn.run(app, host=host, port=port, log_level="info",
+                    timeout_graceful_shutdown=Config.GRACEFUL_TIMEOUT)
+        return
+
+    PreforkServer(app, host, port, workers, threads).run()
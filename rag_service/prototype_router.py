@@ -0,0 +1,316 @@
+"""
+Department Prototype Router
+Fast path cho routing: so query voi vai prototype/department thay vi kNN 50 incidents + voting
+
+- Prototype = centroid embedding cac incident da resolve cua 1 department
+  (PROTOTYPE_CENTROIDS > 1 -> spherical k-means, nhieu centroid/department)
+- Build tu Postgres luc start + rebuild dinh ky (PROTOTYPE_REBUILD_INTERVAL);
+  /create-embedding cap nhat incremental (running mean cua centroid gan nhat)
+- Scoring: 1 phep nhan ma tran-vector trong RAM (prototypes x dim) . (dim,)
+- Chi tra ket qua khi chac chan (similarity va margin voi department thu 2 du lon,
+  department du mau); nguoc lai router fallback ve kNN + voting
+- Prototype khong phan theo incident_type -> query co incident_type luon di kNN
+  (filtered ANN + type bonus trong voting)
+- Moi worker giu ban rieng trong RAM (nho: so department x so centroid x dim)
+"""
+import json
+import time
+import threading
+import numpy as np
+from typing import Dict, List, Optional
+
+from config import Config
+from database import db
+from metrics import metrics
+from logger import get_logger
+
+log = get_logger('prototypes')
+
+BUILD_PAGE_SIZE = 1000
+KMEANS_ITERATIONS = 10
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0)
+
+
+def _to_array(value) -> np.ndarray:
+    """pgvector tra ve ndarray (da register_vector) hoac chuoi '[...]'"""
+    if isinstance(value, str):
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+
+def _kmeans(vectors: np.ndarray, k: int) -> tuple:
+    """
+    Spherical k-means (cosine) tren vectors da normalize.
+    Khoi tao farthest-point (deterministic). Tra ve (sums, counts) cua tung cluster
+    """
+    centroids = [vectors[0]]
+    for _ in range(1, k):
+        closest = np.max(vectors @ np.stack(centroids).T, axis=1)
+        centroids.append(vectors[int(np.argmin(closest))])
+    centroids = np.stack(centroids)
+
+    for _ in range(KMEANS_ITERATIONS):
+        labels = np.argmax(vectors @ centroids.T, axis=1)
+        updated = np.stack([
+            vectors[labels == c].sum(axis=0) if np.any(labels == c) else centroids[c]
+            for c in range(k)
+        ])
+        updated = _normalize(updated)
+        if np.allclose(updated, centroids):
+            break
+        centroids = updated
+
+    labels = np.argmax(vectors @ centroids.T, axis=1)
+    sums = np.stack([vectors[labels == c].sum(axis=0) for c in range(k)])
+    counts = np.bincount(labels, minlength=k)
+    keep = counts > 0
+    return sums[keep], counts[keep]
+
+
+class _Snapshot:
+    """Ma tran prototype read-only (thay nguyen khoi khi build/update)"""
+
+    def __init__(self, matrix: np.ndarray, owners: np.ndarray, departments: List[Dict]):
+        self.matrix = matrix          # (P, dim) normalized
+        self.owners = owners          # (P,) index vao departments
+        self.departments = departments  # [{'department_id', 'department_name', 'samples'}]
+
+
+class DepartmentPrototypes:
+    """Prototype embeddings theo department, dung lam fast path cho IncidentRouter"""
+
+    def __init__(self):
+        self.enabled = Config.PROTOTYPE_ROUTING_ENABLED
+        self.centroids = max(1, Config.PROTOTYPE_CENTROIDS)
+        self.min_similarity = Config.PROTOTYPE_MIN_SIMILARITY
+        self.min_margin = Config.PROTOTYPE_MIN_MARGIN
+        self.min_samples = Config.PROTOTYPE_MIN_SAMPLES
+        self._lock = threading.Lock()
+        self._building = False
+        # department_id -> {'name', 'sums': (C, dim), 'counts': (C,)}
+        self._departments: Dict[str, Dict] = {}
+        self._seen: set = set()  # incident da tinh vao prototype (tranh cong 2 lan)
+        self._snapshot: Optional[_Snapshot] = None
+        self._built_at = 0.0
+        self._last_attempt = 0.0
+        self._stats = {'fast_path': 0, 'fallback': 0}
+        self._fallback_reasons: Dict[str, int] = {}
+
+    # === Build ===
+    def is_ready(self) -> bool:
+        return self.enabled and self._snapshot is not None
+
+    def build(self) -> Dict:
+        """Tinh lai toan bo prototype tu incidents da resolve (co embedding + department)"""
+        start = time.perf_counter()
+        vectors: Dict[str, List[np.ndarray]] = {}
+        names: Dict[str, str] = {}
+        seen = set()
+        after_id = None
+        while True:
+            rows = db.get_department_embeddings_after(after_id, BUILD_PAGE_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                dept_id = row['assigned_department_id']
+                vectors.setdefault(dept_id, []).append(_to_array(row['embedding']))
+                names[dept_id] = row['department_name'] or 'Unknown'
+                seen.add(row['id'])
+            after_id = rows[-1]['id']
+
+        departments = {}
+        for dept_id, vecs in vectors.items():
+            matrix = _normalize(np.stack(vecs))
+            k = min(self.centroids, len(matrix) // max(1, self.min_samples)) or 1
+            if k > 1:
+                sums, counts = _kmeans(matrix, k)
+            else:
+                sums, counts = matrix.sum(axis=0, keepdims=True), np.array([len(matrix)])
+            departments[dept_id] = {'name': names[dept_id], 'sums': sums, 'counts': counts}
+
+        with self._lock:
+            self._departments = departments
+            self._seen = seen
+            self._publish()
+            self._built_at = time.time()
+
+        snapshot = self._snapshot
+        result = {
+            'departments': len(departments),
+            'prototypes': 0 if snapshot is None else len(snapshot.matrix),
+            'incidents': len(seen),
+            'seconds': round(time.perf_counter() - start, 3),
+        }
+        log.info("prototypes_built", **result)
+        return result
+
+    def start(self):
+        """Build lan dau o thread nen (khong chan startup)"""
+        if self.enabled:
+            self._build_async()
+
+    def _build_async(self):
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+            self._last_attempt = time.time()
+
+        def run():
+            try:
+                self.build()
+            except Exception as e:
+                log.error("prototypes_build_failed", error=str(e))
+            finally:
+                self._building = False
+
+        threading.Thread(target=run, name="prototype-build", daemon=True).start()
+
+    def _maybe_rebuild(self):
+        """Worker khac nhan /create-embedding -> ban nay lech dan, rebuild dinh ky (ca khi build loi)"""
+        if time.time() - self._last_attempt >= Config.PROTOTYPE_REBUILD_INTERVAL:
+            self._build_async()
+
+    def _publish(self):
+        """Gop sums/counts thanh ma tran prototype moi (goi khi dang giu _lock)"""
+        rows, owners, departments = [], [], []
+        for dept_id, dept in self._departments.items():
+            owner = len(departments)
+            departments.append({
+                'department_id': dept_id,
+                'department_name': dept['name'],
+                'samples': int(dept['counts'].sum()),
+            })
+            rows.append(dept['sums'])
+            owners.extend([owner] * len(dept['sums']))
+        if not rows:
+            self._snapshot = None
+            return
+        self._snapshot = _Snapshot(
+            _normalize(np.vstack(rows)).astype(np.float32),
+            np.array(owners, dtype=np.int32),
+            departments,
+        )
+
+    # === Incremental update ===
+    def add(self, incident_id: str, department_id: str, department_name: Optional[str], embedding: np.ndarray):
+        """Cong 1 incident vua resolve vao centroid gan nhat cua department (running mean)"""
+        if not self.enabled:
+            return
+        incident_id, department_id = str(incident_id), str(department_id)
+        vec = _normalize(np.asarray(embedding, dtype=np.float32))
+        with self._lock:
+            if incident_id in self._seen:
+                return
+            self._seen.add(incident_id)
+            dept = self._departments.get(department_id)
+            if dept is None:
+                self._departments[department_id] = {
+                    'name': department_name or 'Unknown',
+                    'sums': vec[None, :].copy(),
+                    'counts': np.array([1]),
+                }
+            else:
+                nearest = int(np.argmax(_normalize(dept['sums']) @ vec))
+                dept['sums'][nearest] += vec
+                dept['counts'][nearest] += 1
+            self._publish()
+
+    # === Scoring ===
+    @metrics.timed('prototype_scoring')
+    def classify(self, query_embedding: np.ndarray) -> Optional[Dict]:
+        """
+        Department cua query neu prototype du chac chan, nguoc lai None (-> kNN + voting).
+        Ghi nhan ty le fast path / fallback.
+        """
+        results = self.classify_batch(np.asarray(query_embedding)[None, :])
+        return results[0]
+
+    def classify_batch(self, query_embeddings: np.ndarray) -> List[Optional[Dict]]:
+        """Nhu classify cho nhieu query: 1 phep nhan ma tran (queries x prototypes)"""
+        if not self.enabled:
+            return [None] * len(query_embeddings)
+        self._maybe_rebuild()
+        snapshot = self._snapshot
+        if snapshot is None:
+            for _ in range(len(query_embeddings)):
+                self._record('not_ready')
+            return [None] * len(query_embeddings)
+
+        # Diem department = max tren cac centroid cua no
+        scores = _normalize(np.asarray(query_embeddings, dtype=np.float32)) @ snapshot.matrix.T
+        dept_scores = np.full((len(scores), len(snapshot.departments)), -1.0, dtype=np.float32)
+        np.maximum.at(dept_scores, (slice(None), snapshot.owners), scores)
+
+        results = []
+        for row in dept_scores:
+            order = np.argsort(row)[::-1]
+            best = int(order[0])
+            best_score = float(row[best])
+            margin = best_score - float(row[order[1]]) if len(order) > 1 else best_score
+            department = snapshot.departments[best]
+
+            if department['samples'] < self.min_samples:
+                reason = 'few_samples'
+            elif best_score < self.min_similarity:
+                reason = 'low_similarity'
+            elif margin < self.min_margin:
+                reason = 'low_margin'
+            else:
+                reason = None
+            self._record(reason)
+            if reason is not None:
+                results.append(None)
+                continue
+
+            results.append({
+                **department,
+                'confidence': min(max(best_score, 0.0), 1.0),
+                'margin': margin,
+                'scores': {
+                    snapshot.departments[i]['department_name']: float(row[i])
+                    for i in order[:5]
+                },
+            })
+        return results
+
+    def record_fallback(self, reason: str, count: int = 1):
+        """Query bi router dua thang sang kNN (vd co incident_type: prototype khong tach theo type)"""
+        if not self.enabled:
+            return
+        for _ in range(count):
+            self._record(reason)
+
+    def _record(self, reason: Optional[str]):
+        path = 'prototype' if reason is None else 'knn'
+        metrics.routing_path.inc(path=path, reason=reason or 'confident')
+        with self._lock:
+            if reason is None:
+                self._stats['fast_path'] += 1
+            else:
+                self._stats['fallback'] += 1
+                self._fallback_reasons[reason] = self._fallback_reasons.get(reason, 0) + 1
+
+    def get_stats(self) -> Dict:
+        snapshot = self._snapshot
+        with self._lock:
+            total = self._stats['fast_path'] + self._stats['fallback']
+            return {
+                'enabled': self.enabled,
+                'ready': snapshot is not None,
+                'departments': 0 if snapshot is None else len(snapshot.departments),
+                'prototypes': 0 if snapshot is None else len(snapshot.matrix),
+                'incidents': len(self._seen),
+                'built_at': self._built_at or None,
+                **self._stats,
+                'fast_path_rate': round(self._stats['fast_path'] / total, 4) if total else None,
+                'fallback_reasons': dict(self._fallback_reasons),
+            }
+
+
+# Singleton instance
+department_prototypes = DepartmentPrototypes()
@@ -0,0 +1,194 @@
+"""
+Query Cache
+Cache response cua cac endpoint search (/similar-ideas, /similar) trong bo nho process
+
+- Key: namespace + query da chuan hoa + filters + limit + generation cua namespace
+- Generation tang khi index thay doi (index idea, tao embedding...) -> entry cu khong
+  con duoc tra ve va bi don dan theo LRU
+- Generation luu trong Postgres (rag_cache_generations) de bump o 1 worker vo hieu hoa
+  cache cua moi worker: 1 thread nen/worker ghi bump dang cho va doc lai generation
+  moi QUERY_CACHE_GENERATION_POLL giay (get/bump duoc goi tu event loop, khong chan);
+  Postgres loi -> dung generation local (TTL van gioi han du lieu cu)
+- Gioi han so entry, tong dung luong (uoc luong theo JSON da serialize) va TTL
+  (TTL chan du lieu cu khi backend sua idea/response ma khong qua service nay)
+"""
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+from config import Config
+from metrics import metrics
+from logger import get_logger
+from serialization import dumps
+
+log = get_logger('query_cache')
+
+NAMESPACES = ('ideas', 'incidents')
+
+
+def normalize_query(text: str) -> str:
+    """Chuan hoa Unicode (NFC) + gop khoang trang - giu nguyen hoa/thuong vi model phan biet"""
+    return ' '.join(unicodedata.normalize('NFC', text or '').split())
+
+
+class QueryCache:
+    """LRU cache co gioi han entry/bytes/TTL, invalidate theo generation"""
+
+    def __init__(self, max_entries: int = None, max_bytes: int = None, ttl: float = None,
+                 enabled: bool = None):
+        self.enabled = Config.QUERY_CACHE_ENABLED if enabled is None else enabled
+        self.max_entries = max_entries or Config.QUERY_CACHE_MAX_ENTRIES
+        self.max_bytes = max_bytes or Config.QUERY_CACHE_MAX_BYTES
+        self.ttl = ttl if ttl is not None else Config.QUERY_CACHE_TTL
+        self.generation_poll = Config.QUERY_CACHE_GENERATION_POLL
+
+        self._entries: 'OrderedDict[tuple, tuple]' = OrderedDict()  # key -> (value, size, expires_at)
+        self._generations = {ns: 0 for ns in NAMESPACES}  # dung chung (Postgres)
+        self._local_generations = {ns: 0 for ns in NAMESPACES}  # bump chi cua worker nay
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+        self._poller: Optional[threading.Thread] = None
+        self._pending: set = set()  # namespace da bump, chua ghi len Postgres
+        self._wake = threading.Event()
+
+    def _key(self, namespace: str, key: Hashable) -> tuple:
+        return (namespace, self._generations[namespace], self._local_generations[namespace], key)
+
+    def _ensure_poller(self):
+        """Start thread dong bo generation dung chung (lazy: sau fork moi worker tu start ban rieng)"""
+        if self._poller is not None and self._poller.is_alive():
+            return
+        with self._lock:
+            if self._poller is not None and self._poller.is_alive():
+                return
+            self._poller = threading.Thread(target=self._poll_generations, name="query-cache-generations", daemon=True)
+            self._poller.start()
+
+    def _poll_generations(self):
+        """Ghi bump dang cho roi doc generation cua worker khac; bump() danh thuc som"""
+        while True:
+            self._wake.clear()
+            with self._lock:
+                pending, self._pending = self._pending, set()
+            try:
+                # database import tre: llm_extractor/llm_agreement import module nay
+                # (normalize_query) va phai load duoc khi khong co Postgres
+                from database import db
+                while pending:
+                    namespace = next(iter(pending))
+                    self._adopt(namespace, db.bump_cache_generation(namespace))
+                    pending.discard(namespace)
+                for namespace, generation in db.get_cache_generations().items():
+                    if namespace in self._generations:
+                        self._adopt(namespace, generation)
+            except Exception as e:
+                log.warning("cache_generation_sync_failed", pending=sorted(pending), error=str(e))
+                with self._lock:
+                    self._pending |= pending  # thu lai vong sau
+            self._wake.wait(timeout=self.generation_poll)
+
+    def _adopt(self, namespace: str, generation: int):
+        """Generation dung chung cua namespace da doi -> bo toan bo entry cu cua no"""
+        with self._lock:
+            if self._generations[namespace] == generation:
+                return
+            self._generations[namespace] = generation
+            self._drop(namespace)
+
+    def _drop(self, namespace: str):
+        stale = [k for k in self._entries if k[0] == namespace]
+        for k in stale:
+            self._remove(k)
+
+    def get(self, namespace: str, key: Hashable) -> Optional[Any]:
+        if not self.enabled:
+            return None
+
+        self._ensure_poller()
+        with self._lock:
+            full_key = self._key(namespace, key)
+            entry = self._entries.get(full_key)
+            if entry is None or entry[2] < time.monotonic():
+                if entry is not None:
+                    self._remove(full_key)
+                self._misses += 1
+                metrics.cache_result('query', hit=False)
+                return None
+
+            self._entries.move_to_end(full_key)
+            self._hits += 1
+            metrics.cache_result('query', hit=True)
+            return entry[0]
+
+    def set(self, namespace: str, key: Hashable, value: Any):
+        if not self.enabled:
+            return
+
+        size = len(dumps(value))
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            full_key = self._key(namespace, key)
+            if full_key in self._entries:
+                self._remove(full_key)
+
+            self._entries[full_key] = (value, size, time.monotonic() + self.ttl)
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._evictions += 1
+
+    def _remove(self, full_key: tuple):
+        _, size, _ = self._entries.pop(full_key)
+        self._bytes -= size
+
+    def bump(self, namespace: str, shared: bool = True):
+        """
+        Index cua namespace da thay doi -> vo hieu hoa toan bo entry cu.
+        shared=False: chi worker nay (vd reload local index - moi worker tu reload)
+        """
+        if not self.enabled:
+            return
+        # Bo entry cua worker nay ngay, worker khac thay qua generation trong Postgres
+        with self._lock:
+            self._local_generations[namespace] += 1
+            self._drop(namespace)
+            if shared:
+                self._pending.add(namespace)
+        if shared:
+            self._ensure_poller()
+            self._wake.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_ratio': round(self._hits / lookups, 4) if lookups else 0.0,
+                'evictions': self._evictions,
+                'generations': dict(self._generations),
+            }
+
+
+# Singleton instance
+query_cache = QueryCache()
@@ -0,0 +1,31 @@
+"""
+Serialization
+JSON nhanh cho response lon (/check-duplicate, /similar-ideas) va NDJSON stream
+
+- orjson (optional): nhanh hon json stdlib nhieu lan, serialize san datetime/UUID/numpy
+- Khong cai orjson -> fallback json stdlib (default=str), output giong nhau
+- FastJSONResponse: endpoint tra ve truc tiep -> bo qua jsonable_encoder + validate response_model
+"""
+import json
+from typing import Any
+
+from fastapi.responses import Response
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+
+def dumps(obj: Any) -> bytes:
+    if HAS_ORJSON:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, ensure_ascii=False, default=str).encode('utf-8')
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
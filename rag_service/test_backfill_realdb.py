@@ -0,0 +1,130 @@
+"""
+Test Backfill với Database thực tế
+==================================
+Kiểm tra các truy vấn backfill (database.py) trên PostgreSQL thật - không cần API
+
+- partition_backfill_ranges: các shard phủ đủ records, không chồng nhau, đúng số lượng
+- claim_backfill_job_by_id: 1 shard chỉ được 1 process chạy, shard mất heartbeat được nhận lại
+- rag_jobs: single-flight theo key giữa các worker, job mất heartbeat được giải phóng
+
+Yêu cầu:
+- PostgreSQL cấu hình trong .env (DB_HOST, DB_NAME...) có bảng incidents/ideas
+
+Chạy:
+    python test_backfill_realdb.py
+"""
+import os
+import sys
+import uuid
+
+from database import db, BACKFILL_TARGETS
+
+SHARD_COUNTS = (1, 2, 3, 4, 7)
+
+failures = []
+
+
+def check(name: str, condition: bool, detail: str = ""):
+    print(f"  {'✅' if condition else '❌'} {name}{f' ({detail})' if detail and not condition else ''}")
+    if not condition:
+        failures.append(name)
+
+
+def count_in_range(target: str, range_start: str, range_end: str, only_missing: bool) -> int:
+    spec = BACKFILL_TARGETS[target]
+    missing_sql = "AND embedding IS NULL" if only_missing else ""
+    with db.cursor() as cur:
+        cur.execute(f"""
+            SELECT COUNT(*) as count FROM {target}
+            WHERE id BETWEEN %s::uuid AND %s::uuid
+              AND {spec['valid']} {missing_sql}
+        """, (range_start, range_end))
+        return cur.fetchone()['count']
+
+
+def test_partition_ranges():
+    print("\n📦 partition_backfill_ranges")
+    for target in BACKFILL_TARGETS:
+        for only_missing in (False, True):
+            total = db.count_backfill_records(target, only_missing)
+            for shards in SHARD_COUNTS:
+                label = f"{target} only_missing={only_missing} shards={shards}"
+                ranges = db.partition_backfill_ranges(target, shards, only_missing)
+
+                check(f"{label}: so shard", len(ranges) == min(shards, total), f"{len(ranges)} shard, {total} records")
+                check(f"{label}: tong records", sum(r['total'] for r in ranges) == total)
+                ordered = all(prev['range_end'] < cur['range_start'] for prev, cur in zip(ranges, ranges[1:]))
+                check(f"{label}: shard khong chong nhau", ordered)
+                mismatched = [
+                    r['shard'] for r in ranges
+                    if count_in_range(target, r['range_start'], r['range_end'], only_missing) != r['total']
+                ]
+                check(f"{label}: so records trong tung shard", not mismatched, f"shard {mismatched}")
+
+
+def test_claim_backfill_shard():
+    print("\n🧵 claim_backfill_job_by_id")
+    # run_id rieng -> khong dung toi job backfill that (claim_backfill_job bo qua job co run_id)
+    job = db.create_backfill_job('incidents', 50, 0, run_id=str(uuid.uuid4()), status='queued')
+    job_id = str(job['id'])
+    try:
+        check("shard queued duoc nhan", db.claim_backfill_job_by_id(job_id, stale_seconds=300) is not None)
+        check("shard dang chay khong bi nhan lan 2", db.claim_backfill_job_by_id(job_id, stale_seconds=300) is None)
+        check("shard mat heartbeat duoc nhan lai", db.claim_backfill_job_by_id(job_id, stale_seconds=0) is not None)
+        db.finish_backfill_job(job_id, 'completed')
+        check("shard da xong khong bi nhan", db.claim_backfill_job_by_id(job_id, stale_seconds=0) is None)
+    finally:
+        with db.cursor() as cur:
+            cur.execute("DELETE FROM rag_backfill_jobs WHERE id = %s::uuid", (job_id,))
+
+
+def test_job_single_flight():
+    print("\n🔒 rag_jobs single-flight")
+    key = f"test:{uuid.uuid4()}"
+    first, second, third = (str(uuid.uuid4()) for _ in range(3))
+    try:
+        created, row = db.create_job(first, 'test', key, {}, os.getpid(), stale_seconds=30)
+        check("job dau tien duoc tao", created and row['id'] is not None)
+
+        created, row = db.create_job(second, 'test', key, {}, os.getpid() + 1, stale_seconds=30)
+        check("cung key (worker khac) -> conflict", not created and str(row['id']) == first)
+
+        db.heartbeat_jobs([{'id': first, 'status': 'running', 'total': 10, 'done': 3, 'failed': 0,
+                            'started_at': None}])
+        state = db.get_job(first)
+        check("heartbeat ghi tien do", state['status'] == 'running' and state['done'] == 3)
+
+        db.request_job_cancel(first)
+        cancelled = db.heartbeat_jobs([{'id': first, 'status': 'running', 'total': 10, 'done': 4,
+                                        'failed': 0, 'started_at': None}])
+        check("yeu cau huy den duoc worker chay job", cancelled == [first])
+
+        # Heartbeat cu hon stale_seconds -> coi nhu worker chet, key duoc giai phong
+        created, row = db.create_job(third, 'test', key, {}, os.getpid(), stale_seconds=0)
+        check("job mat heartbeat bi thay the", created and db.get_job(first)['status'] == 'interrupted')
+
+        db.finish_job(third, 'completed', 1, 1, 0, result={'ok': True})
+        check("job xong giai phong key", db.create_job(second, 'test', key, {}, os.getpid(), 30)[0])
+    finally:
+        with db.cursor() as cur:
+            cur.execute("DELETE FROM rag_jobs WHERE key = %s", (key,))
+
+
+def main():
+    print("\n" + "=" * 60)
+    print("   BACKFILL QUERIES (PostgreSQL thuc te)")
+    print("=" * 60)
+
+    test_partition_ranges()
+    test_claim_backfill_shard()
+    test_job_single_flight()
+
+    print("\n" + "=" * 60)
+    if failures:
+        print(f"❌ {len(failures)} kiem tra that bai")
+        sys.exit(1)
+    print("✅ Tat ca kiem tra deu dat")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""
+Test LLM Extractor - Đo latency gọi LLM qua stub server cục bộ
+So sánh: client mới mỗi lần gọi (cách cũ) vs client dùng chung (keep-alive)
+Bulk: extract tuần tự vs extract_batch (song song + token bucket + retry) khi stub trả 429/503
+Circuit breaker: stub treo -> mạch mở, extract trả fallback ngay; stub hồi phục -> probe đóng mạch
+
+Chạy: python test_llm_extractor.py [--calls 50] [--delay-ms 20] [--concurrency 10]
+      python test_llm_extractor.py --bulk 200 --fail-rate 0.2 --rate 50
+Không cần Mistral API key hay database (cache và stripper cục bộ tắt).
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+import statistics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SAMPLE_TEXT = "Kính gửi ban lãnh đạo, máy CNC số 5 hay bị lỗi treo. Xin xem xét sửa chữa."
+STUB_OUTPUT = "Máy CNC số 5 hay bị lỗi treo"
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    """Giả lập /v1/chat/completions: trả kết quả cố định sau delay_ms"""
+    protocol_version = "HTTP/1.1"  # Giữ connection (keep-alive)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        json.loads(self.rfile.read(length) or b'{}')
+        status = self.server.record(self.client_address)
+        time.sleep(self.server.delay_ms / 1000)
+
+        if status == 200:
+            body = json.dumps({
+                "choices": [{"message": {"role": "assistant", "content": STUB_OUTPUT}}]
+            }).encode('utf-8')
+        else:
+            body = json.dumps({"message": "stub error"}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 429:
+            self.send_header('Retry-After', '0.05')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay_ms: float):
+        super().__init__(('127.0.0.1', 0), StubLLMHandler)
+        self.delay_ms = delay_ms
+        self.fail_rate = 0.0  # Tỷ lệ request trả 429/503 (giả lập rate limit / quá tải)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.connections = set()
+
+    def record(self, client_address) -> int:
+        """Ghi nhận request, trả về status code sẽ trả cho client"""
+        with self._lock:
+            self.requests += 1
+            self.connections.add(client_address)
+            if random.random() < self.fail_rate:
+                self.errors += 1
+                return random.choice((429, 503))
+            return 200
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.errors = 0
+            self.connections = set()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1/chat/completions"
+
+
+def start_stub(delay_ms: float) -> StubLLMServer:
+    server = StubLLMServer(delay_ms)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def summarize(name: str, latencies: list, server: StubLLMServer, wall: float = None):
+    ms = sorted(x * 1000 for x in latencies)
+    p95 = ms[min(len(ms) - 1, int(len(ms) * 0.95))]
+    wall_text = f"  wall={wall * 1000:.0f}ms" if wall is not None else ""
+    print(f"  {name:<28} p50={statistics.median(ms):6.2f}ms  p95={p95:6.2f}ms  "
+          f"connections={len(server.connections):3d}/{server.requests} requests{wall_text}")
+    server.reset()
+
+
+async def bench_new_client(llm, n: int) -> list:
+    """Cách cũ: mỗi lần gọi mở AsyncClient mới (DNS + TCP + TLS mỗi lần)"""
+    import httpx
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        async with httpx.AsyncClient(timeout=llm.LLM_BULK_TIMEOUT) as client:
+            response = await client.post(llm.MISTRAL_API_URL, json={
+                "model": llm.MISTRAL_MODEL,
+                "messages": [{"role": "user", "content": llm.EXTRACT_PROMPT + SAMPLE_TEXT}],
+            })
+            response.json()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def bench_shared_client(llm, n: int) -> list:
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        result = await llm.extract_core_issue(SAMPLE_TEXT)
+        latencies.append(time.perf_counter() - start)
+        assert result == STUB_OUTPUT, f"unexpected extraction: {result!r}"
+    return latencies
+
+
+async def bench_concurrent(llm, n: int, concurrency: int) -> tuple:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            await llm.extract_core_issue(SAMPLE_TEXT)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(n)))
+    return latencies, time.perf_counter() - start
+
+
+def bench_sync(llm, n: int) -> list:
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        result = llm.extract_core_issue_sync(SAMPLE_TEXT)
+        latencies.append(time.perf_counter() - start)
+        assert result == STUB_OUTPUT, f"unexpected extraction: {result!r}"
+    return latencies
+
+
+async def bench_bulk(llm, server: StubLLMServer, args):
+    """1 extraction/lần (vòng for cũ của /ideas/generate-embeddings) vs extract_batch"""
+    texts = [f"{SAMPLE_TEXT} Lần {i}." for i in range(args.bulk)]
+    server.fail_rate = args.fail_rate
+    print(f"\n📦 Bulk {args.bulk} texts, stub lỗi {args.fail_rate:.0%} (429/503), "
+          f"rate {args.rate}/s, concurrency {args.concurrency}")
+
+    def report(name: str, results: list, wall: float):
+        ok = sum(1 for r in results if r == STUB_OUTPUT)
+        print(f"  {name:<28} wall={wall:6.2f}s  ok={ok}/{len(results)}  "
+              f"requests={server.requests} (lỗi {server.errors}), {server.requests / wall:.1f} req/s")
+        server.reset()
+        return ok
+
+    start = time.perf_counter()
+    sequential = [await llm.extract_core_issue(t) for t in texts]
+    report("sequential, no retry", sequential, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    results = await llm.extract_batch(texts, concurrency=args.concurrency, rate=args.rate)
+    wall = time.perf_counter() - start
+    requests = server.requests
+    ok = report("extract_batch", results, wall)
+
+    # Token bucket: tổng request <= burst + rate * thời gian
+    allowed = llm.LLM_BULK_BURST + args.rate * wall
+    assert requests <= allowed + 1, f"rate limit exceeded: {requests} requests > {allowed:.0f}"
+    if ok < len(results):
+        print(f"  ⚠️ {len(results) - ok} texts vẫn lỗi sau {llm.LLM_MAX_RETRIES} lần retry (trả nguyên văn)")
+    server.fail_rate = 0.0
+
+
+async def bench_breaker(llm, server: StubLLMServer, args):
+    breaker = llm.circuit_breaker
+    print(f"\n🔌 Circuit breaker: stub treo > timeout {llm.LLM_INTERACTIVE_TIMEOUT}s, "
+          f"mở sau {breaker.failure_threshold} lỗi, thử lại sau {breaker.reset_seconds}s")
+    breaker.record_success()  # Bắt đầu từ trạng thái closed
+    server.delay_ms = llm.LLM_INTERACTIVE_TIMEOUT * 1000 + 300
+
+    failing, short_circuited = [], []
+    for _ in range(breaker.failure_threshold + 5):
+        was_closed = breaker.state == 'closed'
+        start = time.perf_counter()
+        result = await llm.extract_core_issue(SAMPLE_TEXT)
+        (failing if was_closed else short_circuited).append(time.perf_counter() - start)
+        assert result == SAMPLE_TEXT, f"expected fallback, got {result!r}"
+    assert breaker.state == 'open', f"breaker should be open, is {breaker.state}"
+    summarize("timeouts (closed)", failing, server)
+    summarize("fallback (open)", short_circuited, server)
+    assert server.requests == 0
+
+    server.delay_ms = args.delay_ms
+    await asyncio.sleep(breaker.reset_seconds)
+    result = await llm.extract_core_issue(SAMPLE_TEXT)
+    assert result == STUB_OUTPUT and breaker.state == 'closed', f"probe failed: {breaker.get_stats()}"
+    print(f"  probe half-open -> {breaker.state} ({server.requests} request)")
+    server.reset()
+
+
+async def run_async(llm, server: StubLLMServer, args):
+    summarize("new client per call", await bench_new_client(llm, args.calls), server)
+
+    await llm.start_client()
+    summarize("shared client", await bench_shared_client(llm, args.calls), server)
+    latencies, wall = await bench_concurrent(llm, args.calls, args.concurrency)
+    summarize(f"shared client x{args.concurrency}", latencies, server, wall)
+    if args.bulk:
+        await bench_bulk(llm, server, args)
+    if args.breaker:
+        await bench_breaker(llm, server, args)
+    await llm.close_client()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM extractor latency against a local stub server")
+    parser.add_argument('--calls', type=int, default=50)
+    parser.add_argument('--delay-ms', type=float, default=20.0, help="Simulated model time per request")
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--bulk', type=int, default=100, help="So text cho bulk extraction (0 = bo qua)")
+    parser.add_argument('--fail-rate', type=float, default=0.2, help="Ty le request stub tra 429/503 trong bulk")
+    parser.add_argument('--rate', type=float, default=50.0, help="Token bucket (request/giay) cho bulk")
+    parser.add_argument('--no-breaker', dest='breaker', action='store_false', help="Bo qua test circuit breaker")
+    args = parser.parse_args()
+
+    server = start_stub(args.delay_ms)
+
+    # Trỏ extractor vào stub trước khi import (config đọc lúc import)
+    os.environ['MISTRAL_API_URL'] = server.url
+    os.environ['MISTRAL_API_KEY'] = 'stub'
+    os.environ['LLM_EXTRACT_ENABLED'] = 'true'
+    os.environ['LLM_CACHE_ENABLED'] = 'false'
+    os.environ['LLM_LOCAL_STRIP_ENABLED'] = 'false'  # Luôn gọi stub, không dùng fast path cục bộ
+    os.environ.setdefault('LLM_MAX_KEEPALIVE', str(args.concurrency))
+    os.environ.setdefault('LLM_BACKOFF_BASE', '0.05')
+    os.environ.setdefault('LLM_INTERACTIVE_TIMEOUT', '0.5')
+    os.environ.setdefault('LLM_BREAKER_RESET_SECONDS', '2')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import llm_extractor as llm
+
+    print("\n" + "=" * 60)
+    print("   LLM EXTRACTOR LATENCY (stub server)")
+    print("=" * 60)
+    print(f"📊 Stub: {server.url} (delay {args.delay_ms:.0f}ms)")
+    print(f"📊 Calls: {args.calls}, HTTP/2: {llm.LLM_HTTP2 and llm.HAS_H2} (stub chỉ HTTP/1.1)\n")
+
+    asyncio.run(run_async(llm, server, args))
+    summarize("sync (background loop)", bench_sync(llm, args.calls), server)
+
+    llm._background.stop()
+    server.shutdown()
+    print("\n✅ Done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,510 @@
+"""
+Local Vector Index
+Tier index trong RAM (memory-mapped) cho incidents da resolve va ideas
+
+- Embeddings luu dang float32 matrix trong file .npy, doc bang np.load(mmap_mode='r')
+  -> cac uvicorn worker dung chung page cache cua OS (read-only)
+- Metadata routing luu kem file .json
+- Dong bo incremental tu Postgres theo watermark (updated_at, id). updated_at = thoi diem
+  bat dau transaction -> row commit muon co the nam duoi watermark, nen moi lan sync quet lai
+  LOCAL_INDEX_SYNC_OVERLAP giay truoc watermark (row khong doi bi bo qua khi so sanh)
+- Chi 1 worker ghi (file lock), cac worker khac chi reload manifest
+- Tat (LOCAL_INDEX_ENABLED=false) hoac chua san sang -> fallback ve Postgres
+"""
+import os
+import json
+import time
+import threading
+import numpy as np
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional
+from contextlib import contextmanager
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False  # Windows: chi lock trong process
+
+from psycopg2.extras import RealDictCursor
+
+from config import Config
+from query_cache import query_cache
+from metrics import metrics
+from deadline import Deadline
+from database import db, open_connection, INCIDENT_FILTER_COLUMNS, IDEA_FILTER_COLUMNS, ZERO_UUID
+
+EPOCH = '1970-01-01T00:00:00+00:00'
+SYNC_BATCH_SIZE = 1000
+
+# Dinh nghia cac segment: cot metadata, nguon du lieu, dieu kien thuoc corpus
+SEGMENTS = {
+    'incidents': {
+        'columns': [
+            'id', 'title', 'description', 'location', 'incident_type', 'priority',
+            'status', 'resolution_notes', 'assigned_department_id', 'department_name'
+        ],
+        'select': """
+            i.id::text as id, i.title, i.description, i.location,
+            i.incident_type::text as incident_type, i.priority::text as priority,
+            i.status::text as status, i.resolution_notes,
+            i.assigned_department_id::text as assigned_department_id,
+            d.name as department_name
+        """,
+        'source': "incidents i LEFT JOIN departments d ON i.assigned_department_id = d.id",
+        'eligible': "i.embedding IS NOT NULL AND i.assigned_department_id IS NOT NULL",
+        'filter_columns': INCIDENT_FILTER_COLUMNS,
+    },
+    'ideas': {
+        'columns': [
+            'id', 'title', 'description', 'expected_benefit',
+            'ideabox_type', 'whitebox_subtype', 'status', 'category'
+        ],
+        'select': """
+            i.id::text as id, i.title, i.description, i.expected_benefit,
+            i.ideabox_type::text as ideabox_type, i.whitebox_subtype::text as whitebox_subtype,
+            i.status::text as status, i.category::text as category
+        """,
+        'source': "ideas i",
+        'eligible': "i.embedding IS NOT NULL",
+        'filter_columns': IDEA_FILTER_COLUMNS,
+    },
+}
+
+
+class _Segment:
+    """Snapshot read-only cua 1 segment (thay the nguyen khoi khi reload)"""
+
+    def __init__(self, generation: int, vectors: np.ndarray, rows: List[Dict], columns: List[str]):
+        self.generation = generation
+        self.vectors = vectors
+        self.rows = rows
+        # Cot metadata dang numpy array de tao filter mask vectorized
+        self.columns = {
+            col: np.array([r.get(col) for r in rows], dtype=object)
+            for col in columns
+        }
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class LocalVectorIndex:
+    """Memory-mapped vector index, dong bo incremental tu Postgres"""
+
+    def __init__(self):
+        self.enabled = Config.LOCAL_INDEX_ENABLED
+        self.index_dir = Config.get_local_index_dir()
+        self._segments: Dict[str, _Segment] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._write_lock = threading.Lock()
+        self._last_rebuild = 0.0
+        self._last_sync = None
+
+    # === Lifecycle ===
+    def start(self):
+        """Load snapshot hien co va chay thread dong bo nen"""
+        if not self.enabled or self._thread is not None:
+            return
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        self._reload_all()
+        self._thread = threading.Thread(target=self._run, name="local-index-sync", daemon=True)
+        self._thread.start()
+        print(f"[OK] Local vector index enabled at {self.index_dir}")
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def request_sync(self):
+        """Yeu cau dong bo som (goi sau khi ghi embedding moi)"""
+        if self.enabled:
+            self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"[WARN] Local index sync failed: {e}")
+            self._wake.wait(timeout=Config.LOCAL_INDEX_SYNC_INTERVAL)
+            self._wake.clear()
+
+    def is_ready(self, name: str) -> bool:
+        return self.enabled and name in self._segments
+
+    # === Search ===
+    @metrics.timed('ann')
+    def find_similar(
+        self,
+        query_embedding: np.ndarray,
+        limit: int = None,
+        min_similarity: float = None,
+        filters: Optional[Dict] = None,
+        deadline: Optional[Deadline] = None
+    ) -> List[Dict]:
+        """Giong db.find_similar - phuc vu tu RAM neu index san sang"""
+        if not self.is_ready('incidents'):
+            return db.find_similar(
+                query_embedding, limit=limit, min_similarity=min_similarity, filters=filters, deadline=deadline
+            )
+
+        if deadline is not None:
+            deadline.check('ann')
+
+        limit = limit or Config.DEFAULT_LIMIT
+        min_similarity = min_similarity or Config.MIN_SIMILARITY
+        return self._search('incidents', query_embedding, limit, min_similarity, filters)
+
+    @metrics.timed('ann')
+    def find_similar_batch(
+        self,
+        query_embeddings: List[np.ndarray],
+        limit: int = None,
+        min_similarity: float = None,
+        incident_types: Optional[List[Optional[str]]] = None,
+        type_limit: int = None
+    ) -> List[List[Dict]]:
+        """Giong db.find_similar_batch - 1 phep nhan ma tran cho ca batch"""
+        if not self.is_ready('incidents'):
+            return db.find_similar_batch(
+                query_embeddings, limit=limit, min_similarity=min_similarity,
+                incident_types=incident_types, type_limit=type_limit
+            )
+
+        limit = limit or Config.DEFAULT_LIMIT
+        min_similarity = min_similarity or Config.MIN_SIMILARITY
+        type_limit = type_limit or limit
+        segment = self._segments['incidents']
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if len(segment) == 0 or len(queries) == 0:
+            return [[] for _ in range(len(queries))]
+
+        all_scores = queries @ segment.vectors.T
+        allowed = SEGMENTS['incidents']['filter_columns']
+        results = []
+        for k, scores in enumerate(all_scores):
+            rows = self._top_k(segment, scores, limit, min_similarity)
+            incident_type = incident_types[k] if incident_types else None
+            if incident_type:
+                mask = self._filter_mask(segment, {'incident_type': incident_type}, allowed)
+                seen = {str(r['id']) for r in rows}
+                same_type = self._top_k(segment, np.where(mask, scores, -np.inf), type_limit, min_similarity)
+                rows.extend(r for r in same_type if str(r['id']) not in seen)
+                rows.sort(key=lambda r: r['similarity'], reverse=True)
+            results.append(rows)
+        return results
+
+    @metrics.timed('ann')
+    def find_similar_ideas(
+        self,
+        query_embedding: np.ndarray,
+        limit: int = None,
+        filters: Optional[Dict] = None,
+        min_similarity: float = None
+    ) -> List[Dict]:
+        """Giong db.find_similar_ideas - phuc vu tu RAM neu index san sang"""
+        if not self.is_ready('ideas'):
+            return db.find_similar_ideas(query_embedding, limit=limit, filters=filters, min_similarity=min_similarity)
+
+        limit = limit or Config.DEFAULT_LIMIT
+        threshold = min_similarity if min_similarity is not None else -1.0
+        rows = self._search('ideas', query_embedding, limit, threshold, filters)
+        keep = ('id', 'title', 'description', 'expected_benefit', 'similarity')
+        return [{k: r[k] for k in keep} for r in rows]
+
+    def _search(self, name: str, query_embedding: np.ndarray, limit: int,
+                min_similarity: float, filters: Optional[Dict]) -> List[Dict]:
+        segment = self._segments[name]
+        if len(segment) == 0:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        scores = segment.vectors @ query
+
+        mask = self._filter_mask(segment, filters, SEGMENTS[name]['filter_columns'])
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
+        return self._top_k(segment, scores, limit, min_similarity)
+
+    def _top_k(self, segment: _Segment, scores: np.ndarray, limit: int, min_similarity: float) -> List[Dict]:
+        """Top-k rows theo score (score -inf = bi filter loai)"""
+        k = min(limit, len(segment))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        results = []
+        for idx in top:
+            score = float(scores[idx])
+            if score == -np.inf or score < min_similarity:
+                break
+            row = dict(segment.rows[idx])
+            row['similarity'] = score
+            results.append(row)
+        return results
+
+    def _filter_mask(self, segment: _Segment, filters: Optional[Dict], allowed: Dict) -> Optional[np.ndarray]:
+        """Filter metadata - cung ngu nghia voi Database._build_filters"""
+        mask = None
+        for column, value in (filters or {}).items():
+            if column not in allowed:
+                raise ValueError(f"Unsupported filter column: {column}")
+            if value is None:
+                continue
+
+            values = segment.columns[column]
+            if isinstance(value, (list, tuple, set)):
+                col_mask = np.isin(values, [str(v) for v in value])
+            else:
+                col_mask = values == str(value)
+            mask = col_mask if mask is None else (mask & col_mask)
+        return mask
+
+    # === Files ===
+    def _manifest_path(self, name: str) -> Path:
+        return self.index_dir / f"{name}.manifest.json"
+
+    def _data_paths(self, name: str, generation: int) -> tuple:
+        return (
+            self.index_dir / f"{name}.{generation}.npy",
+            self.index_dir / f"{name}.{generation}.json",
+        )
+
+    def _read_manifest(self, name: str) -> Optional[Dict]:
+        path = self._manifest_path(name)
+        if not path.exists():
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _reload_all(self):
+        for name in SEGMENTS:
+            self._reload(name)
+
+    def _reload(self, name: str):
+        """Map lai segment neu manifest da sang generation moi"""
+        manifest = self._read_manifest(name)
+        if manifest is None:
+            return
+
+        current = self._segments.get(name)
+        if current is not None and current.generation == manifest['generation']:
+            return
+
+        vectors_path, rows_path = self._data_paths(name, manifest['generation'])
+        vectors = np.load(vectors_path, mmap_mode='r')
+        with open(rows_path, 'r', encoding='utf-8') as f:
+            rows = json.load(f)
+
+        self._segments[name] = _Segment(manifest['generation'], vectors, rows, SEGMENTS[name]['columns'])
+        # Ket qua search da cache tinh tren segment cu (moi worker tu reload -> chi bump local)
+        query_cache.bump(name, shared=False)
+
+    def _write_segment(self, name: str, generation: int, vectors: np.ndarray,
+                       rows: List[Dict], watermark: Dict):
+        """Ghi generation moi roi doi manifest (atomic) - reader dang map file cu khong bi anh huong"""
+        vectors_path, rows_path = self._data_paths(name, generation)
+
+        with open(vectors_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(vectors, dtype=np.float32))
+        with open(rows_path, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, ensure_ascii=False)
+
+        self._write_manifest(name, generation, len(rows), watermark)
+
+        # Don generation cu (giu 1 ban truoc cho worker chua reload)
+        for old in self.index_dir.glob(f"{name}.*.*"):
+            parts = old.name.split('.')
+            if len(parts) == 3 and parts[1].isdigit() and int(parts[1]) < generation - 1:
+                try:
+                    old.unlink()
+                except OSError:
+                    pass
+
+    def _write_manifest(self, name: str, generation: int, count: int, watermark: Dict):
+        manifest_tmp = self._manifest_path(name).with_suffix('.tmp')
+        with open(manifest_tmp, 'w', encoding='utf-8') as f:
+            json.dump({
+                'generation': generation,
+                'count': count,
+                'watermark': watermark,
+            }, f)
+        os.replace(manifest_tmp, self._manifest_path(name))
+
+    @contextmanager
+    def _writer_lock(self):
+        """Chi 1 worker dong bo tai 1 thoi diem; worker khac bo qua (yield False)"""
+        if not self._write_lock.acquire(blocking=False):
+            yield False
+            return
+        lock_file = None
+        try:
+            if HAS_FCNTL:
+                lock_file = open(self.index_dir / ".sync.lock", 'w')
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    yield False
+                    return
+            yield True
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+            self._write_lock.release()
+
+    # === Sync ===
+    def sync(self) -> Dict:
+        """Dong bo incremental tat ca segment, sau do reload snapshot"""
+        stats = {}
+        with self._writer_lock() as is_writer:
+            if is_writer:
+                full = time.time() - self._last_rebuild >= Config.LOCAL_INDEX_REBUILD_INTERVAL
+                conn = open_connection()
+                try:
+                    for name in SEGMENTS:
+                        stats[name] = self._sync_segment(conn, name, full=full)
+                finally:
+                    conn.close()
+                if full:
+                    self._last_rebuild = time.time()
+        self._reload_all()
+        self._last_sync = time.time()
+        return stats
+
+    def _sync_segment(self, conn, name: str, full: bool = False) -> Dict:
+        spec = SEGMENTS[name]
+        manifest = None if full else self._read_manifest(name)
+
+        if manifest is not None:
+            vectors_path, rows_path = self._data_paths(name, manifest['generation'])
+            vectors = np.load(vectors_path)
+            with open(rows_path, 'r', encoding='utf-8') as f:
+                rows = json.load(f)
+            watermark = manifest['watermark']
+            generation = manifest['generation']
+        else:
+            vectors = np.zeros((0, Config.VECTOR_DIM), dtype=np.float32)
+            rows = []
+            watermark = {'updated_at': EPOCH, 'id': ZERO_UUID}
+            current = self._read_manifest(name)
+            generation = current['generation'] if current else 0
+
+        positions = {r['id']: i for i, r in enumerate(rows)}
+        upserts: Dict[str, tuple] = {}
+        removed = set()
+
+        # Quet tu (watermark - overlap): bat row cua transaction bat dau truoc lan sync truoc
+        # nhung commit sau do. Watermark luu lai van la moc lon nhat da thay
+        saved_watermark = watermark
+        if manifest is not None:
+            start = datetime.fromisoformat(watermark['updated_at']) - timedelta(seconds=Config.LOCAL_INDEX_SYNC_OVERLAP)
+            scan = {'updated_at': start.isoformat(), 'id': ZERO_UUID}
+        else:
+            scan = watermark
+
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            while True:
+                cur.execute(f"""
+                    SELECT {spec['select']},
+                        i.embedding,
+                        ({spec['eligible']}) as eligible,
+                        COALESCE(i.updated_at, i.created_at, 'epoch'::timestamptz) as watermark_ts
+                    FROM {spec['source']}
+                    WHERE (COALESCE(i.updated_at, i.created_at, 'epoch'::timestamptz), i.id)
+                          > (%s::timestamptz, %s::uuid)
+                    ORDER BY COALESCE(i.updated_at, i.created_at, 'epoch'::timestamptz), i.id
+                    LIMIT %s
+                """, (scan['updated_at'], scan['id'], SYNC_BATCH_SIZE))
+                batch = cur.fetchall()
+
+                for row in batch:
+                    row_id = row['id']
+                    if row['eligible']:
+                        meta = {col: row[col] for col in spec['columns']}
+                        vector = _to_vector(row['embedding'])
+                        pos = positions.get(row_id)
+                        if pos is not None and rows[pos] == meta and np.array_equal(vectors[pos], vector):
+                            continue  # Row trong vung overlap, da co trong index
+                        upserts[row_id] = (meta, vector)
+                        removed.discard(row_id)
+                    else:
+                        upserts.pop(row_id, None)
+                        removed.add(row_id)
+
+                if batch:
+                    last = batch[-1]
+                    scan = {'updated_at': last['watermark_ts'].isoformat(), 'id': last['id']}
+                if len(batch) < SYNC_BATCH_SIZE:
+                    break
+
+            watermark = max(
+                saved_watermark, scan,
+                key=lambda w: (datetime.fromisoformat(w['updated_at']), w['id'])
+            )
+
+            cur.execute(f"SELECT COUNT(*) as count FROM {spec['source']} WHERE {spec['eligible']}")
+            db_count = cur.fetchone()['count']
+        conn.commit()
+
+        if not upserts and not (removed & positions.keys()) and manifest is not None and len(rows) == db_count:
+            # Chi co row ngoai corpus thay doi -> luu watermark, khong can generation moi
+            if watermark != manifest['watermark']:
+                self._write_manifest(name, generation, len(rows), watermark)
+            return {'changed': 0, 'count': len(rows)}
+
+        # Ap dung thay doi: xoa, cap nhat tai cho, them moi
+        keep = [i for i, r in enumerate(rows) if r['id'] not in removed]
+        new_rows = [rows[i] for i in keep]
+        new_vectors = [vectors[keep]] if keep else []
+        new_positions = {r['id']: i for i, r in enumerate(new_rows)}
+        base = np.vstack(new_vectors) if new_vectors else np.zeros((0, Config.VECTOR_DIM), dtype=np.float32)
+
+        appended_rows, appended_vectors = [], []
+        for row_id, (meta, vec) in upserts.items():
+            if row_id in new_positions:
+                new_rows[new_positions[row_id]] = meta
+                base[new_positions[row_id]] = vec
+            else:
+                appended_rows.append(meta)
+                appended_vectors.append(vec)
+
+        if appended_vectors:
+            base = np.vstack([base, np.stack(appended_vectors)]) if len(base) else np.stack(appended_vectors)
+        new_rows.extend(appended_rows)
+
+        # Xoa cung trong DB khong co updated_at -> lech so luong thi rebuild toan bo
+        if len(new_rows) != db_count and not full:
+            print(f"[INFO] Local index '{name}' out of sync ({len(new_rows)} != {db_count}), rebuilding...")
+            return self._sync_segment(conn, name, full=True)
+
+        self._write_segment(name, generation + 1, base, new_rows, watermark)
+        return {'changed': len(upserts) + len(removed), 'count': len(new_rows)}
+
+    def get_stats(self) -> Dict:
+        return {
+            'enabled': self.enabled,
+            'last_sync': self._last_sync,
+            'segments': {
+                name: {'generation': seg.generation, 'count': len(seg)}
+                for name, seg in self._segments.items()
+            }
+        }
+
+
+def _to_vector(value) -> np.ndarray:
+    """pgvector tra ve ndarray (da register_vector) hoac chuoi '[...]'"""
+    if isinstance(value, str):
+        value = json.loads(value)
+    vec = np.asarray(value, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
+
+
+# Singleton instance
+local_index = LocalVectorIndex()